@@ -44,12 +44,8 @@ class CVTrainer:
         criterion = nn.CrossEntropyLoss()
         optimizer, scheduler = self.build_optimizer(epoch, self.pipe_model)
 
-        # measure latency with cuda event:
-        # https://discuss.pytorch.org/t/distributed-training-slower-than-dataparallel/81539/4
-        self.pipe_model.train()
-        if self.frozen_model is not None:
-            self.frozen_model.eval()
-
+        # iteration_num and the timing counters cover the whole epoch,
+        # across the train data loaders re-created by the transformations in the middle of the epoch
         iteration_num = 0
         num_sample_processed_in_total = 0
         communication_count = 0.0
@@ -58,72 +54,91 @@ class CVTrainer:
         forward_time_accumulate = 0.0
 
         backwards_time_accumulate = 0.0
-        for batch_idx, (sample_index_list, x, target) in enumerate(self.train_dl):
-            communication_count += 1
-            iteration_num += 1
+        is_transformed = True
+        while is_transformed:
+            is_transformed = False
+            # measure latency with cuda event:
+            # https://discuss.pytorch.org/t/distributed-training-slower-than-dataparallel/81539/4
+            self.pipe_model.train()
+            if self.frozen_model is not None:
+                self.frozen_model.eval()
+
+            for batch_idx, (sample_index_list, x, target) in enumerate(self.train_dl):
+                communication_count += 1
+                iteration_num += 1
+
+                if batch_idx == 0:
+                    starting_time = time.time()
+                    self.pipe_model._sync_params()
 
-            if batch_idx == 0:
-                starting_time = time.time()
-                self.pipe_model._sync_params()
+                if batch_idx > 0:
+                    backwards_time_accumulate += time.time() - starting_time_forward
+                    backwards_time_per_batch = backwards_time_accumulate / iteration_num
+                    logging.critical("(epoch = %d) backwards_time_per_batch = %s" % (epoch, backwards_time_per_batch))
 
-            if batch_idx > 0:
-                backwards_time_accumulate += time.time() - starting_time_forward
-                backwards_time_per_batch = backwards_time_accumulate / (batch_idx+1)
-                logging.critical("(epoch = %d) backwards_time_per_batch = %s" % (epoch, backwards_time_per_batch))
+                logging.info("--------------global_rank = %d. Epoch %d, batch index %d Statistics: " % (
+                    self.args.global_rank, epoch, batch_idx))
+                logging.info("global_rank = %d. epoch = %d, batch index = %d/%d" % (
+                    self.args.global_rank, epoch, batch_idx, len(self.train_dl) - 1))
+                num_sample_processed_in_total += len(x)
 
-            logging.info("--------------global_rank = %d. Epoch %d, batch index %d Statistics: " % (
-                self.args.global_rank, epoch, batch_idx))
-            logging.info("global_rank = %d. epoch = %d, batch index = %d/%d" % (
-                self.args.global_rank, epoch, batch_idx, len(self.train_dl) - 1))
-            num_sample_processed_in_total += len(x)
+                sample_index_list = sample_index_list.cpu().numpy()
+                x = x.to(self.device_first)
+                target = target.to(self.device_last)
 
-            sample_index_list = sample_index_list.cpu().numpy()
-            x = x.to(self.device_first)
-            target = target.to(self.device_last)
+                optimizer.zero_grad()
 
-            optimizer.zero_grad()
+                starting_time_forward = time.time()
+                log_probs = self.pipe_transformer.forward(epoch, batch_idx, sample_index_list, x, True, True)
 
-            starting_time_forward = time.time()
-            log_probs = self.pipe_transformer.forward(epoch, batch_idx, sample_index_list, x, True, True)
+                end_time_forward = time.time()
+                forward_time_accumulate += (end_time_forward - starting_time_forward)
+                forward_time_per_batch = forward_time_accumulate / iteration_num
+                logging.critical("(epoch = %d) forward_time_per_batch = %s" % (epoch, forward_time_per_batch))
 
-            end_time_forward = time.time()
-            forward_time_accumulate += (end_time_forward - starting_time_forward)
-            forward_time_per_batch = forward_time_accumulate / (batch_idx + 1)
-            logging.critical("(epoch = %d) forward_time_per_batch = %s" % (epoch, forward_time_per_batch))
+                loss = criterion(log_probs, target)
+                loss.backward()
+                # this clip will cost 0.6 second, can be skipped?
+                torch.nn.utils.clip_grad_norm_(self.pipe_model.parameters(), 1.0)
+                optimizer.step()
+                scheduler.step()
 
-            loss = criterion(log_probs, target)
-            loss.backward()
-            # this clip will cost 0.6 second, can be skipped?
-            torch.nn.utils.clip_grad_norm_(self.pipe_model.parameters(), 1.0)
-            optimizer.step()
-            scheduler.step()
+                self.pipe_transformer.collect_freeze_info()
 
-            self.pipe_transformer.collect_freeze_info()
+                if batch_idx == 0:
+                    logging.info("global_rank = %d. data loading cost = %s" % (
+                        self.args.global_rank, str(time.time() - starting_time)))
+                    if iteration_num == 1:
+                        time_finish_prepare_ddp = time.time()
 
-            if batch_idx == 0:
-                time_finish_prepare_ddp = time.time()
-                logging.info("global_rank = %d. data loading cost = %s" % (
-                    self.args.global_rank, str(time_finish_prepare_ddp - starting_time)))
+                sample_num_throughput = int(num_sample_processed_in_total / (time.time() - time_finish_prepare_ddp)) * self.pipe_transformer.get_active_world_size()
+                logging.critical("global_rank = %d. sample_num_throughput (images/second): %d" % (self.args.local_rank, sample_num_throughput))
 
-            sample_num_throughput = int(num_sample_processed_in_total / (time.time() - time_finish_prepare_ddp)) * self.pipe_transformer.get_active_world_size()
-            logging.critical("global_rank = %d. sample_num_throughput (images/second): %d" % (self.args.local_rank, sample_num_throughput))
+                comm_freq = communication_count / (time.time() - time_finish_prepare_ddp)
+                logging.critical("global_rank = %d. communication frequency (cross machine sync/second): %f" % (self.args.global_rank, comm_freq))
 
-            comm_freq = communication_count / (time.time() - time_finish_prepare_ddp)
-            logging.critical("global_rank = %d. communication frequency (cross machine sync/second): %f" % (self.args.global_rank, comm_freq))
+                if batch_idx == len(self.train_dl) - 1 and self.args.global_rank == 0:
+                    wandb.log({"comm_frequency": comm_freq, "epoch": epoch})
+                    wandb.log({"sample_throughput": sample_num_throughput, "epoch": epoch})
 
-            if batch_idx == len(self.train_dl) - 1 and self.args.global_rank == 0:
-                wandb.log({"comm_frequency": comm_freq, "epoch": epoch})
-                wandb.log({"sample_throughput": sample_num_throughput, "epoch": epoch})
+                    forward_time_per_batch = forward_time_accumulate / iteration_num
+                    logging.critical("(epoch = %d) forward_time_per_batch = %s" % (epoch, forward_time_per_batch))
+                    wandb.log({"forward_time_per_batch": forward_time_per_batch, "epoch": epoch})
 
-                forward_time_per_batch = forward_time_accumulate / len(self.train_dl)
-                logging.critical("(epoch = %d) forward_time_per_batch = %s" % (epoch, forward_time_per_batch))
-                wandb.log({"forward_time_per_batch": forward_time_per_batch, "epoch": epoch})
+                logging.info("-------------------------------------")
+                if iteration_num == 3 and self.args.is_debug_mode:
+                    break
 
-            logging.info("-------------------------------------")
-            if iteration_num == 3 and self.args.is_debug_mode:
-                break
-        if self.args.global_rank == 0:
-            backwards_time_per_batch = backwards_time_accumulate / len(self.train_dl)
+                if self.pipe_transformer.transform_in_epoch(epoch, batch_idx + 1):
+                    # continue the epoch with the transformed pipe and the samples which are not trained yet
+                    self.frozen_model, self.pipe_model, \
+                    self.train_dl, self.test_dl, \
+                    self.device_first, self.device_last = self.pipe_transformer.get_new_model_and_dataset()
+                    self.pipe_transformer.update_optimizer(optimizer)
+                    is_transformed = True
+                    break
+        if self.args.global_rank == 0 and iteration_num > 0:
+            backwards_time_per_batch = backwards_time_accumulate / iteration_num
             wandb.log({"backwards_time_per_batch": backwards_time_per_batch, "epoch": epoch})
             logging.critical("(epoch = %d) backwards_time_per_batch = %s" % (epoch, backwards_time_per_batch))
 
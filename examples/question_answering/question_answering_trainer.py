@@ -76,47 +76,63 @@ class QuestionAnsweringTrainer:
 
             optimizer, scheduler = self.build_optimizer(self.pipe_model, iteration_in_total)
 
-            self.pipe_model.train()
-            if self.frozen_model is not None:
-                self.frozen_model.eval()
-
-            for batch_idx, batch in enumerate(self.train_dl):
-                batch = tuple(t for t in batch)
-                # inputs = {"original_id": batch[0], "input_ids": batch[1], "attention_mask": batch[2],
-                #           "token_type_ids": batch[3], "start_positions": batch[4], "end_positions": batch[5]}
-
-                sample_index_list = batch[0].to(self.device_first).cpu().numpy()
-                x = batch[1].to(self.device_first)
-                start_positions = batch[4].to(self.device_last)
-                end_positions = batch[5].to(self.device_last)
-
-                logits = self.pipe_transformer.forward(epoch, batch_idx, sample_index_list, x, True, True)
-
-                loss, _, _ = self._calculate_loss(logits, start_positions, end_positions)
-
-                logging.info("epoch = %d, batch_idx = %d/%d, loss = %s" % (epoch, batch_idx,
-                                                                           len(self.train_dl), loss))
-                if self.args.gradient_accumulation_steps > 1:
-                    loss = loss / self.args.gradient_accumulation_steps
-
-                loss.backward()
-
-                tr_loss += loss.item()
-                if (batch_idx + 1) % self.args.gradient_accumulation_steps == 0:
-                    torch.nn.utils.clip_grad_norm_(self.pipe_model.parameters(), self.args.max_grad_norm)
-                    optimizer.step()
-                    scheduler.step()  # Update learning rate schedule
-                    self.pipe_model.zero_grad()
-                    global_step += 1
-
-                    if self.args.evaluate_during_training and (self.args.evaluate_during_training_steps > 0
-                                                               and global_step % self.args.evaluate_during_training_steps == 0):
-                        # results, _ = self.eval_model(eval_data, **kwargs)
-                        result = self.eval_model_by_offical_script(epoch, global_step)
-                        if result is not None:
-                            logging.info("epoch = %d, global_step = %d, result = %s" % (epoch, global_step, str(result)))
-                if global_step > 3 and self.args.is_debug_mode:
-                    break
+            # the epoch continues in segments: a transformation in the middle of the epoch (config.freeze_step_interval)
+            # re-creates the train data loader with the samples which are not trained yet
+            is_transformed = True
+            while is_transformed:
+                is_transformed = False
+                self.pipe_model.train()
+                if self.frozen_model is not None:
+                    self.frozen_model.eval()
+
+                for batch_idx, batch in enumerate(self.train_dl):
+                    batch = tuple(t for t in batch)
+                    # inputs = {"original_id": batch[0], "input_ids": batch[1], "attention_mask": batch[2],
+                    #           "token_type_ids": batch[3], "start_positions": batch[4], "end_positions": batch[5]}
+
+                    sample_index_list = batch[0].to(self.device_first).cpu().numpy()
+                    x = batch[1].to(self.device_first)
+                    start_positions = batch[4].to(self.device_last)
+                    end_positions = batch[5].to(self.device_last)
+
+                    logits = self.pipe_transformer.forward(epoch, batch_idx, sample_index_list, x, True, True)
+
+                    loss, _, _ = self._calculate_loss(logits, start_positions, end_positions)
+
+                    logging.info("epoch = %d, batch_idx = %d/%d, loss = %s" % (epoch, batch_idx,
+                                                                               len(self.train_dl), loss))
+                    if self.args.gradient_accumulation_steps > 1:
+                        loss = loss / self.args.gradient_accumulation_steps
+
+                    loss.backward()
+
+                    tr_loss += loss.item()
+                    if (batch_idx + 1) % self.args.gradient_accumulation_steps == 0:
+                        torch.nn.utils.clip_grad_norm_(self.pipe_model.parameters(), self.args.max_grad_norm)
+                        optimizer.step()
+                        scheduler.step()  # Update learning rate schedule
+                        self.pipe_model.zero_grad()
+                        global_step += 1
+
+                        if self.args.evaluate_during_training and (self.args.evaluate_during_training_steps > 0
+                                                                   and global_step % self.args.evaluate_during_training_steps == 0):
+                            # results, _ = self.eval_model(eval_data, **kwargs)
+                            result = self.eval_model_by_offical_script(epoch, global_step)
+                            if result is not None:
+                                logging.info("epoch = %d, global_step = %d, result = %s" % (epoch, global_step, str(result)))
+
+                    if (batch_idx + 1) % self.args.gradient_accumulation_steps == 0 and \
+                            self.pipe_transformer.transform_in_epoch(epoch, batch_idx + 1):
+                        # continue the epoch with the transformed pipe and the samples which are not trained yet
+                        self.frozen_model, self.pipe_model, \
+                        self.train_dl, self.test_dl, \
+                        self.device_first, self.device_last = self.pipe_transformer.get_new_model_and_dataset()
+                        self.pipe_transformer.update_optimizer(optimizer)
+                        is_transformed = True
+                        break
+
+                    if global_step > 3 and self.args.is_debug_mode:
+                        break
         result = self.eval_model_by_offical_script(self.args.num_train_epochs-1, global_step)
         if result is not None:
             logging.info("epoch = %d, global_step = %d, result = %s" % (self.args.num_train_epochs-1, global_step, str(result)))
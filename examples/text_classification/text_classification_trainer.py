@@ -65,55 +65,70 @@ class TextClassificationTrainer:
 
             optimizer, scheduler = self.build_optimizer(self.pipe_model, iteration_in_total)
 
-            self.pipe_model.train()
-            if self.frozen_model is not None:
-                self.frozen_model.eval()
-
-            for batch_idx, batch in enumerate(self.train_dl):
-                if batch_idx == 0:
-                    self.pipe_model._sync_params()
-
-                batch = tuple(t for t in batch)
-                # inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
-                sample_index_list = batch[0].to(self.device_first).cpu().numpy()
-                x = batch[1].to(self.device_first)
-                labels = batch[4].to(self.device_last)
-
-                # logging.info(batch)
-                # logging.info(sample_index_list)
-
-                logits = self.pipe_transformer.forward(epoch, batch_idx, sample_index_list, x, True, True)
-                # logits = self.pipe_model(x)
-                loss_fct = CrossEntropyLoss()
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-
-                # model outputs are always tuple in pytorch-transformers (see doc)
-                # loss = outputs[0]
-                # logging.info(loss)
-                current_loss = loss.item()
-                logging.info("epoch = %d, batch_idx = %d/%d, loss = %s" % (epoch, batch_idx,
-                                                                           len(self.train_dl), current_loss))
-
-                if self.args.gradient_accumulation_steps > 1:
-                    loss = loss / self.args.gradient_accumulation_steps
-
-                loss.backward()
-
-                tr_loss += loss.item()
-                if (batch_idx + 1) % self.args.gradient_accumulation_steps == 0:
-                    torch.nn.utils.clip_grad_norm_(self.pipe_model.parameters(), self.args.max_grad_norm)
-                    optimizer.step()
-                    scheduler.step()  # Update learning rate schedule
-                    self.pipe_model.zero_grad()
-                    global_step += 1
-
-                    if self.args.evaluate_during_training and (self.args.evaluate_during_training_steps > 0
-                                                               and global_step % self.args.evaluate_during_training_steps == 0):
-                        results, _, _ = self.eval_model(epoch, global_step)
-                        logging.info(results)
-
-                if self.args.is_debug_mode == 1 and global_step > 3:
-                    break
+            # the epoch continues in segments: a transformation in the middle of the epoch (config.freeze_step_interval)
+            # re-creates the train data loader with the samples which are not trained yet
+            is_transformed = True
+            while is_transformed:
+                is_transformed = False
+                self.pipe_model.train()
+                if self.frozen_model is not None:
+                    self.frozen_model.eval()
+
+                for batch_idx, batch in enumerate(self.train_dl):
+                    if batch_idx == 0:
+                        self.pipe_model._sync_params()
+
+                    batch = tuple(t for t in batch)
+                    # inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
+                    sample_index_list = batch[0].to(self.device_first).cpu().numpy()
+                    x = batch[1].to(self.device_first)
+                    labels = batch[4].to(self.device_last)
+
+                    # logging.info(batch)
+                    # logging.info(sample_index_list)
+
+                    logits = self.pipe_transformer.forward(epoch, batch_idx, sample_index_list, x, True, True)
+                    # logits = self.pipe_model(x)
+                    loss_fct = CrossEntropyLoss()
+                    loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+
+                    # model outputs are always tuple in pytorch-transformers (see doc)
+                    # loss = outputs[0]
+                    # logging.info(loss)
+                    current_loss = loss.item()
+                    logging.info("epoch = %d, batch_idx = %d/%d, loss = %s" % (epoch, batch_idx,
+                                                                               len(self.train_dl), current_loss))
+
+                    if self.args.gradient_accumulation_steps > 1:
+                        loss = loss / self.args.gradient_accumulation_steps
+
+                    loss.backward()
+
+                    tr_loss += loss.item()
+                    if (batch_idx + 1) % self.args.gradient_accumulation_steps == 0:
+                        torch.nn.utils.clip_grad_norm_(self.pipe_model.parameters(), self.args.max_grad_norm)
+                        optimizer.step()
+                        scheduler.step()  # Update learning rate schedule
+                        self.pipe_model.zero_grad()
+                        global_step += 1
+
+                        if self.args.evaluate_during_training and (self.args.evaluate_during_training_steps > 0
+                                                                   and global_step % self.args.evaluate_during_training_steps == 0):
+                            results, _, _ = self.eval_model(epoch, global_step)
+                            logging.info(results)
+
+                    if (batch_idx + 1) % self.args.gradient_accumulation_steps == 0 and \
+                            self.pipe_transformer.transform_in_epoch(epoch, batch_idx + 1):
+                        # continue the epoch with the transformed pipe and the samples which are not trained yet
+                        self.frozen_model, self.pipe_model, \
+                        self.train_dl, self.test_dl, \
+                        self.device_first, self.device_last = self.pipe_transformer.get_new_model_and_dataset()
+                        self.pipe_transformer.update_optimizer(optimizer)
+                        is_transformed = True
+                        break
+
+                    if self.args.is_debug_mode == 1 and global_step > 3:
+                        break
         results, _, _ = self.eval_model(self.args.num_train_epochs-1, global_step)
         logging.info(results)
         return global_step, tr_loss / global_step
@@ -0,0 +1,111 @@
+import logging
+import queue
+import threading
+
+import torch
+
+"""
+On a cache miss, the hidden feature computed by the frozen layers is needed by the pipe model on the device,
+and by the cache on the host. Copying it to the host synchronously puts a device-to-host copy
+on the critical path of every miss step.
+
+AsyncCacheWriter is a write-behind cache writer:
+1. the batch is encoded on the device (on the current stream), and the caller continues with the device tensor;
+2. the encoded records are copied into a pinned buffer on a side CUDA stream;
+3. a background thread waits for the copy and writes the records into the ring buffer of the CacheDaemon.
+
+On CPU, the background thread does the copy into the ring buffer.
+At most `cache_max_in_flight_writes` batches are in flight, submit() blocks when the window is full (backpressure).
+"""
+
+
+class AsyncCacheWriter:
+    def __init__(self, config, ring_buffer, codec, stats=None):
+        self.config = config
+        self.ring_buffer = ring_buffer
+        self.codec = codec
+        # CacheStats of the trainer, the queue depth and the dropped batches are counted by the background thread
+        self.stats = stats
+        self.max_in_flight = config.cache_max_in_flight_writes
+
+        self.window = threading.BoundedSemaphore(self.max_in_flight)
+        self.pinned_buffers = queue.Queue()
+        for _ in range(self.max_in_flight):
+            self.pinned_buffers.put(None)
+        # device -> the side CUDA stream for the device-to-host copy
+        self.copy_streams = dict()
+
+        self.write_q = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, msg_type, epoch, batch_idx, batch_sample_idx, hidden_feature, cached_layer_id,
+               num_frozen_layer):
+        self.window.acquire()
+        records = self.codec.encode(hidden_feature)
+        event = None
+        buffer = None
+        if records.is_cuda:
+            buffer = self._get_pinned_buffer(len(batch_sample_idx))
+            copy_stream = self._get_copy_stream(records.device)
+            copy_stream.wait_stream(torch.cuda.current_stream(records.device))
+            with torch.cuda.stream(copy_stream):
+                buffer[0:len(batch_sample_idx)].copy_(records, non_blocking=True)
+                # the memory of records must not be reused before the copy finishes
+                records.record_stream(copy_stream)
+                event = torch.cuda.Event()
+                event.record(copy_stream)
+            records = buffer[0:len(batch_sample_idx)]
+        self.write_q.put((msg_type, epoch, batch_idx, batch_sample_idx, records, cached_layer_id, num_frozen_layer,
+                          event, buffer))
+
+    def flush(self):
+        """wait until all the submitted batches are written into the ring buffer"""
+        self.write_q.join()
+
+    def cleanup(self):
+        self.flush()
+        self.write_q.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.write_q.get()
+            if item is None:
+                self.write_q.task_done()
+                break
+            msg_type, epoch, batch_idx, batch_sample_idx, records, cached_layer_id, num_frozen_layer, \
+                event, buffer = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                if self.stats is not None:
+                    self.stats.observe("daemon_queue_depth", self.ring_buffer.get_num_used_slots())
+                if not self.ring_buffer.put(msg_type, epoch, batch_idx, batch_sample_idx, records.cpu(),
+                                            cached_layer_id, num_frozen_layer):
+                    # the daemon is behind, this batch will be cached when it is used next time
+                    if self.stats is not None:
+                        self.stats.inc("dropped_batches")
+                    logging.info("the cache ring buffer is full, drop the batch. epoch = %d, batch_idx = %d" % (
+                        epoch, batch_idx))
+            except Exception as e:
+                logging.error("failed to write the batch into the cache: %s" % str(e))
+            finally:
+                if event is not None:
+                    self.pinned_buffers.put(buffer)
+                del records, item
+                self.window.release()
+                self.write_q.task_done()
+
+    def _get_pinned_buffer(self, batch_size):
+        # one buffer per in-flight batch, so a free buffer always exists after acquiring the window
+        buffer = self.pinned_buffers.get()
+        if buffer is None or len(buffer) < batch_size:
+            buffer = torch.empty((max(batch_size, self.config.batch_size), self.codec.get_record_size()),
+                                 dtype=torch.uint8, pin_memory=True)
+        return buffer
+
+    def _get_copy_stream(self, device):
+        if device not in self.copy_streams:
+            self.copy_streams[device] = torch.cuda.Stream(device)
+        return self.copy_streams[device]
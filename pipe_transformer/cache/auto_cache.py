@@ -52,5 +52,9 @@ class AutoCache:
                 log_probs = pipe_model(hidden_feature)
         return log_probs
 
+    def get_stats(self):
+        # hit rate, latency, and the daemon counters of the current epoch
+        return self.cache_manager.get_stats()
+
     def cleanup(self):
         self.cache_manager.cleanup()
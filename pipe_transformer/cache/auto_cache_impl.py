@@ -1,15 +1,21 @@
 import argparse
-import copy
 import logging
 import time
 
-import numpy
+import numpy as np
+import psutil
 import torch
 import torch.multiprocessing as mp
 
-from .cache_daemon_process import CacheDaemon
+from .async_cache_writer import AsyncCacheWriter
+from .cache_codec import CacheCodec
+from .cache_daemon_process import CacheDaemon, build_arena_name, build_daemon_counters_name, \
+    build_ring_buffer_name
 from .cache_msg import Message
-from .shared_memory_manager import SharedMemoryManager
+from .cache_policy import get_num_slots_with_budget
+from .cache_stats import CacheStats, SharedCounters, dump_stats_as_json_line
+from .shared_memory_arena import SharedMemoryArena
+from .shared_memory_ring_buffer import SharedMemoryRingBuffer
 from pipe_transformer.data.cv_data_manager import CVDatasetManager
 
 """
@@ -77,18 +83,48 @@ class AutoCacheImpl:
         self.config = config
         self.data_manager = data_manager
 
+        # only the small control messages are sent by the queue, the hidden features are sent by the ring buffer
         self.msg_q = mp.Queue()
 
-        self.cache_daemon = CacheDaemon(config, self.msg_q)
+        # sample uid is the index of the sample in the dataset
+        train_sample_num = self.data_manager.get_train_sample_num()
+        test_sample_num = self.data_manager.get_test_sample_num()
+        # the shared memory tier is bounded by an explicit byte budget
+        train_num_slots, test_num_slots = get_num_slots_with_budget(self.config, train_sample_num, test_sample_num,
+                                                                    psutil.virtual_memory().available)
+
+        self.cache_daemon = CacheDaemon(config, self.msg_q, train_sample_num, test_sample_num,
+                                        train_num_slots, test_num_slots)
         self.cache_daemon.daemon = True
         self.cache_daemon.start()
 
-        self.shared_memory_mgr_hidden_feature_train = SharedMemoryManager(self.config, "hidden_feature_train")
-        self.shared_memory_mgr_hidden_feature_test = SharedMemoryManager(self.config, "hidden_feature_test")
+        self.ring_buffer = SharedMemoryRingBuffer(self.config, build_ring_buffer_name(self.config),
+                                                  self.config.cache_ring_buffer_size, self.config.batch_size)
+        self.shared_memory_mgr_hidden_feature_train = SharedMemoryArena(
+            self.config, build_arena_name(self.config, "hidden_feature_train"), train_sample_num, train_num_slots)
+        self.shared_memory_mgr_hidden_feature_test = SharedMemoryArena(
+            self.config, build_arena_name(self.config, "hidden_feature_test"), test_sample_num, test_num_slots)
 
         self.count_mismatch = 0
 
+        self.codec = CacheCodec(self.config)
+        self.hidden_feature_buffer = None
+
+        # statistics of the current epoch, see cache_stats.py
+        self.stats = CacheStats()
+        self.stats_epoch = -1
+        self.daemon_counters = SharedCounters(build_daemon_counters_name(self.config))
+        self.daemon_counters_at_epoch_start = self.daemon_counters.snapshot()
+
+        if self.config.cache_async_write:
+            self.async_cache_writer = AsyncCacheWriter(self.config, self.ring_buffer, self.codec, self.stats)
+        else:
+            self.async_cache_writer = None
+
     def reset_status(self, epoch):
+        if self.async_cache_writer is not None:
+            self.async_cache_writer.flush()
+        self._reset_stats(epoch)
         train_sample_index = self.data_manager.get_train_sample_index(epoch)
         test_sample_index = self.data_manager.get_test_sample_index(epoch)
         msg = Message(Message.MSG_TYPE_UPDATE_INDEX)
@@ -98,99 +134,173 @@ class AutoCacheImpl:
         self.msg_q.put(msg)
 
     def cleanup(self):
+        if self.async_cache_writer is not None:
+            self.async_cache_writer.cleanup()
         msg = Message(Message.MSG_TYPE_FINISH)
         self.msg_q.put(msg)
 
         self.cache_daemon.join()
+        # the last epoch, the daemon has handled all the batches
+        self._reset_stats(-1)
 
         self.cache_daemon.terminate()
         self.cache_daemon.kill()
         self.msg_q.close()
 
+        self.ring_buffer.cleanup()
+        self.daemon_counters.cleanup()
+        self.shared_memory_mgr_hidden_feature_train.cleanup()
+        self.shared_memory_mgr_hidden_feature_test.cleanup()
+
+    def get_stats(self):
+        """
+        The cache statistics of the current epoch (since the last reset_status()).
+        The daemon counters lag behind by the batches which are still in the ring buffer.
+        """
+        stats = self.stats.to_dict()
+        stats["epoch"] = self.stats_epoch
+        stats["global_rank"] = self.config.global_rank
+        daemon_counters = self.daemon_counters.snapshot()
+        for name, value in daemon_counters.items():
+            stats[name] = value - self.daemon_counters_at_epoch_start[name]
+        return stats
+
+    def _reset_stats(self, epoch):
+        if self.config.cache_stats_path and self.stats_epoch >= 0:
+            dump_stats_as_json_line(self.config.cache_stats_path, self.get_stats())
+        self.stats.reset()
+        self.stats_epoch = epoch
+        self.daemon_counters_at_epoch_start = self.daemon_counters.snapshot()
+
+    def _is_tracing(self, batch_idx):
+        return self.config.cache_trace_interval > 0 and batch_idx % self.config.cache_trace_interval == 0
+
     def get_hidden_feature(self, num_frozen_layer_last_epoch, num_frozen_layer, model, epoch, batch_idx,
                            batch_sample_idx, x, device, is_train_mode, is_train_data):
-        if is_train_mode:
-            cached_num_frozen_layer = num_frozen_layer_last_epoch
+        """
+        The frozen layers are never unfrozen, so a hidden feature cached at any layer <= num_frozen_layer is valid.
+        The samples of a batch are grouped by their deepest cached layer, and each group is advanced to
+        num_frozen_layer by FrozenLayer.forward(x, layer_id) separately (the missed samples start from layer 0).
+        """
+        batch_sample_idx = np.asarray(batch_sample_idx, dtype=np.int64)
+        gather_start = time.perf_counter()
+        cached_layer_ids, cached_hidden_feature = self._get_a_cached_batch_sample(num_frozen_layer, batch_sample_idx,
+                                                                                  is_train_data, device)
+        self.stats.observe("gather_latency", time.perf_counter() - gather_start)
+        self._count_cached_samples(cached_layer_ids, num_frozen_layer)
+        if (cached_layer_ids == num_frozen_layer).all():
+            hidden_feature = cached_hidden_feature
         else:
-            cached_num_frozen_layer = num_frozen_layer
-        hidden_feature = self._get_a_cached_batch_sample(cached_num_frozen_layer, batch_sample_idx, is_train_data)
-        if hidden_feature is not None:
-            logging.critical("(global_rank = %s, epoch = %s, batch_idx = %s, is_train_mode = %s, is_train_data = %s, "
-                             "num_frozen_layer_last_epoch = %s, num_frozen_layer = %s) "
-                             "NO need to compute FP (layer 0-%d), "
-                             "frozen layer number = %d (START)"
-                             % (str(self.config.global_rank), str(epoch), str(batch_idx), str(is_train_mode), str(is_train_data),
-                                str(num_frozen_layer_last_epoch), str(num_frozen_layer),
-                                cached_num_frozen_layer - 1, num_frozen_layer))
-
-            # if self.config.is_debug_mode:
-            #     self._check_the_tensor_during_debug_mode(model, x, batch_idx, hidden_feature,
-            #                                              cached_num_frozen_layer, device)
-
-            if num_frozen_layer > cached_num_frozen_layer:
-                hidden_feature = model(hidden_feature.to(device), cached_num_frozen_layer).detach().cpu()
-                self._send_to_daemon_for_cache(epoch, batch_idx, batch_sample_idx, hidden_feature,
-                                               cached_num_frozen_layer, num_frozen_layer, is_train_data)
-                logging.critical("(global_rank = %d) cached layer %d" % (self.config.global_rank, num_frozen_layer))
-            logging.critical("(global_rank = %d) NO need to compute FP (END)" % self.config.global_rank)
-        else:
-            logging.critical("(global_rank = %s, epoch = %s, batch_idx = %s, is_train_mode = %s, is_train_data = %s, "
-                             "num_frozen_layer_last_epoch = %s, num_frozen_layer = %s) "
-                             "cache to shared memory (START)"
-                             % (str(self.config.global_rank), str(epoch), str(batch_idx), str(is_train_mode), str(is_train_data),
-                                str(num_frozen_layer_last_epoch), str(num_frozen_layer)))
+            hidden_feature = None
             with torch.no_grad():
-                hidden_feature = model(x).detach().cpu()
-            self._send_to_daemon_for_cache(epoch, batch_idx, batch_sample_idx, hidden_feature,
-                                           cached_num_frozen_layer, num_frozen_layer, is_train_data)
-            logging.critical("(global_rank = %d) cache to shared memory (END)" % self.config.global_rank)
+                for layer_id in np.unique(cached_layer_ids).tolist():
+                    group = torch.from_numpy(np.nonzero(cached_layer_ids == layer_id)[0])
+                    if layer_id < 0:
+                        hidden_feature_group = model(x[group.to(x.device)])
+                    elif layer_id < num_frozen_layer:
+                        hidden_feature_group = model(cached_hidden_feature[group].to(device), layer_id)
+                    else:
+                        hidden_feature_group = cached_hidden_feature[group]
+                    if hidden_feature is None:
+                        hidden_feature = torch.empty((len(batch_sample_idx),) + tuple(hidden_feature_group.shape[1:]),
+                                                     dtype=hidden_feature_group.dtype,
+                                                     device=hidden_feature_group.device)
+                    hidden_feature[group] = hidden_feature_group.detach().to(hidden_feature.device)
+
+            # cache the samples which are advanced to num_frozen_layer
+            sample_idx_to_cache = np.nonzero(cached_layer_ids != num_frozen_layer)[0]
+            write_start = time.perf_counter()
+            self._send_to_daemon_for_cache(epoch, batch_idx, batch_sample_idx[sample_idx_to_cache],
+                                           hidden_feature[torch.from_numpy(sample_idx_to_cache)],
+                                           max(0, int(cached_layer_ids.min())), num_frozen_layer, is_train_data)
+            self.stats.observe("write_latency", time.perf_counter() - write_start)
+        if self._is_tracing(batch_idx):
+            logging.info("(global_rank = %s, epoch = %s, batch_idx = %s, is_train_mode = %s, is_train_data = %s, "
+                         "num_frozen_layer = %s) cached layers of the batch: %s, hit rate of the epoch = %f" % (
+                             str(self.config.global_rank), str(epoch), str(batch_idx), str(is_train_mode),
+                             str(is_train_data), str(num_frozen_layer),
+                             str(dict(zip(*[v.tolist() for v in np.unique(cached_layer_ids, return_counts=True)]))),
+                             self.stats.to_dict()["hit_rate"]))
+
+        if self.config.is_debug_mode:
+            self._check_the_tensor_during_debug_mode(model, x, batch_idx, hidden_feature)
         return hidden_feature
 
-    def _check_the_tensor_during_debug_mode(self, model, x, batch_idx, hidden_feature, num_frozen_layer_last_epoch,
-                                            device):
+    def _check_the_tensor_during_debug_mode(self, model, x, batch_idx, hidden_feature):
         # check correctness
         with torch.no_grad():
             hidden_feature_without_cache = model(x).detach().cpu()
-            hidden_feature = model(hidden_feature.to(device), num_frozen_layer_last_epoch).detach().cpu()
-            if not torch.equal(hidden_feature_without_cache, hidden_feature):
+            hidden_feature = hidden_feature.cpu()
+            max_error = (hidden_feature_without_cache - hidden_feature).abs().max().item()
+            logging.info("(global_rank = %d, batch_idx = %d) cache_dtype = %s, max error = %f" % (
+                self.config.global_rank, batch_idx, self.config.cache_dtype, max_error))
+            # fp16/bf16/int8 caches are lossy, so only the float32 cache must be exactly the same
+            if self.codec.is_lossless() and not torch.equal(hidden_feature_without_cache, hidden_feature):
                 logging.info(
                     "(global_rank = %d, batch_idx = %d) tensor does not match" % (self.config.global_rank, batch_idx))
                 self.count_mismatch += 1
                 logging.info("self.count_mismatch = %d" % self.count_mismatch)
                 raise Exception("not equal with inference from layer 0")
-            else:
-                logging.info("$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$")
 
-    def _get_a_cached_batch_sample(self, num_frozen_layer_last_epoch, batch_sample_idx, is_train):
+    def _count_cached_samples(self, cached_layer_ids, num_frozen_layer):
+        num_hit = int((cached_layer_ids == num_frozen_layer).sum())
+        num_miss = int((cached_layer_ids < 0).sum())
+        self.stats.inc("hit_samples", num_hit)
+        self.stats.inc("miss_samples", num_miss)
+        self.stats.inc("partial_hit_samples", len(cached_layer_ids) - num_hit - num_miss)
+        if num_hit == len(cached_layer_ids):
+            self.stats.inc("hit_batches")
+        elif num_miss == len(cached_layer_ids):
+            self.stats.inc("miss_batches")
+        else:
+            self.stats.inc("partial_hit_batches")
+
+    def _get_a_cached_batch_sample(self, num_frozen_layer, batch_sample_idx, is_train, device):
+        """
+        Return the deepest cached layer id (<= num_frozen_layer, -1: not cached) of each sample,
+        and the decoded cached hidden features of the batch (None if no sample is cached).
+        """
         if is_train:
             shared_memory_mgr_hidden_feature = self.shared_memory_mgr_hidden_feature_train
         else:
             shared_memory_mgr_hidden_feature = self.shared_memory_mgr_hidden_feature_test
-        sample_idx_in_batch = 0
-        hidden_tensor_np = numpy.ndarray(
-            (len(batch_sample_idx), self.config.seq_len, self.config.hidden_size),
-            dtype=numpy.float32
-        )
-        for sample_uid in batch_sample_idx:
-            cache_hidden_feature = shared_memory_mgr_hidden_feature.get_tensor(sample_uid, num_frozen_layer_last_epoch)
-            if cache_hidden_feature is None:
-                logging.info("tensor is none")
-                return None
-            hidden_tensor_np[sample_idx_in_batch] = copy.deepcopy(cache_hidden_feature)
-            sample_idx_in_batch += 1
-        return torch.from_numpy(hidden_tensor_np).cpu()
+        hidden_feature_buffer = self._get_hidden_feature_buffer(len(batch_sample_idx))
+        cached_layer_ids = shared_memory_mgr_hidden_feature.get_batch_tensor(batch_sample_idx, num_frozen_layer,
+                                                                             hidden_feature_buffer.numpy())
+        if (cached_layer_ids < 0).all():
+            return cached_layer_ids, None
+        # the encoded records (2-4x smaller than float32 for fp16/bf16/int8) are copied to the device,
+        # and decoded there. The copy is synchronous since the buffer is reused by the next lookup.
+        return cached_layer_ids, self.codec.decode(hidden_feature_buffer.to(device))
+
+    def _get_hidden_feature_buffer(self, batch_size):
+        """
+        The encoded records of a cached batch are gathered into a preallocated (pinned when CUDA is available) buffer,
+        which is reused by the following batches.
+        """
+        if self.hidden_feature_buffer is None or len(self.hidden_feature_buffer) < batch_size:
+            self.hidden_feature_buffer = torch.empty(
+                (max(batch_size, self.config.batch_size), self.codec.get_record_size()),
+                dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+        return self.hidden_feature_buffer[:batch_size]
 
     def _send_to_daemon_for_cache(self, epoch, batch_idx, batch_sample_idx, hidden_feature, cached_layer_id,
                                   num_frozen_layer, is_train):
-        logging.info("_send_training_progress_to_daemon. epoch = %d, batch_idx = %d" % (epoch, batch_idx))
         if is_train:
-            msg = Message(Message.MSG_TYPE_TRAINING_PROGRESS)
+            msg_type = Message.MSG_TYPE_TRAINING_PROGRESS
         else:
-            msg = Message(Message.MSG_TYPE_TEST_PROGRESS)
-        msg.set(Message.MSG_KEY_EPOCH, epoch)
-        msg.set(Message.MSG_KEY_BATCH_INDEX, batch_idx)
-        msg.set(Message.MSG_KEY_BATCH_SAMPLE_INDEX, batch_sample_idx)
-        msg.set(Message.MSG_KEY_HIDDEN_FEATURE, hidden_feature)
-        msg.set(Message.MSG_KEY_NUM_FROZEN_LAYER, num_frozen_layer)
-        msg.set(Message.MSG_KEY_CACHED_NUM_FROZEN_LAYER, cached_layer_id)
-        self.msg_q.put(msg)
+            msg_type = Message.MSG_TYPE_TEST_PROGRESS
+        if self.async_cache_writer is not None:
+            # write-behind, the caller continues with the hidden feature on the device
+            self.async_cache_writer.submit(msg_type, epoch, batch_idx, batch_sample_idx, hidden_feature,
+                                           cached_layer_id, num_frozen_layer)
+            return
+        # encoding before copying to the host makes the copy smaller
+        hidden_feature = self.codec.encode(hidden_feature).cpu()
+        self.stats.observe("daemon_queue_depth", self.ring_buffer.get_num_used_slots())
+        if not self.ring_buffer.put(msg_type, epoch, batch_idx, batch_sample_idx, hidden_feature,
+                                    cached_layer_id, num_frozen_layer):
+            # the daemon is behind, this batch will be cached when it is used next time
+            self.stats.inc("dropped_batches")
+            logging.info("the cache ring buffer is full, drop the batch. epoch = %d, batch_idx = %d" % (
+                epoch, batch_idx))
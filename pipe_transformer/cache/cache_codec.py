@@ -0,0 +1,84 @@
+import torch
+
+"""
+The cached hidden features of the frozen layers are stored as fixed-size byte records,
+so that the shared memory slots and the disk records hold fp16/bf16/int8 features without knowing the dtype.
+
+config.cache_dtype:
+    float32  - [seq_len * hidden_size * 4] bytes, lossless
+    float16  - [seq_len * hidden_size * 2] bytes
+    bfloat16 - [seq_len * hidden_size * 2] bytes
+    int8     - [seq_len * 4] bytes of per-row (per-token) float32 scales, followed by [seq_len * hidden_size] int8,
+               x ~= q * scale, scale = max(|x|) / 127 of the row
+
+The records are encoded once when they are cached, and decoded when a batch is read from the cache,
+typically after the (smaller) gathered records are copied to the GPU.
+"""
+
+
+class CacheCodec:
+    SUPPORTED_DTYPES = ["float32", "float16", "bfloat16", "int8"]
+
+    # the records are padded to keep the float32 scales aligned in a batch of records
+    RECORD_ALIGNMENT = 8
+
+    def __init__(self, config):
+        self.dtype_name = config.cache_dtype
+        if self.dtype_name not in self.SUPPORTED_DTYPES:
+            raise Exception("cache_dtype %s is not supported. options: %s" % (self.dtype_name,
+                                                                              str(self.SUPPORTED_DTYPES)))
+        self.seq_len = config.seq_len
+        self.hidden_size = config.hidden_size
+        self.num_elements = self.seq_len * self.hidden_size
+
+        if self.dtype_name == "int8":
+            self.storage_dtype = torch.int8
+            self.scale_size = self.seq_len * 4
+        else:
+            self.storage_dtype = getattr(torch, self.dtype_name)
+            self.scale_size = 0
+        payload_size = self.num_elements * torch.tensor([], dtype=self.storage_dtype).element_size()
+        self.payload_size = payload_size
+        self.record_size = (self.scale_size + payload_size + self.RECORD_ALIGNMENT - 1) \
+                           // self.RECORD_ALIGNMENT * self.RECORD_ALIGNMENT
+
+    def is_lossless(self):
+        return self.dtype_name == "float32"
+
+    def get_record_size(self):
+        return self.record_size
+
+    def encode(self, hidden_feature):
+        """[B, seq_len, hidden_size] float tensor -> [B, record_size] uint8 tensor on the same device"""
+        batch_size = hidden_feature.shape[0]
+        hidden_feature = hidden_feature.detach().reshape(batch_size, self.seq_len, self.hidden_size)
+        records = torch.zeros((batch_size, self.record_size), dtype=torch.uint8, device=hidden_feature.device)
+        if self.dtype_name == "int8":
+            hidden_feature = hidden_feature.float()
+            scale = hidden_feature.abs().amax(dim=-1).clamp_min(1e-12) / 127.0
+            q = torch.round(hidden_feature / scale.unsqueeze(-1)).clamp_(-127, 127).to(torch.int8)
+            records[:, 0:self.scale_size] = scale.view(torch.uint8).reshape(batch_size, self.scale_size)
+            records[:, self.scale_size:self.scale_size + self.payload_size] = q.view(torch.uint8).reshape(
+                batch_size, self.payload_size)
+        else:
+            payload = hidden_feature.to(self.storage_dtype).contiguous()
+            records[:, 0:self.payload_size] = payload.view(torch.uint8).reshape(batch_size, self.payload_size)
+        return records
+
+    def decode(self, records, out=None):
+        """[B, record_size] uint8 tensor -> [B, seq_len, hidden_size] float32 tensor on the same device"""
+        batch_size = records.shape[0]
+        if self.dtype_name == "float32" and self.record_size == self.payload_size and out is None:
+            # zero copy
+            return records.view(torch.float32).view(batch_size, self.seq_len, self.hidden_size)
+        if out is None:
+            out = torch.empty((batch_size, self.seq_len, self.hidden_size), dtype=torch.float32,
+                              device=records.device)
+        payload = records[:, self.scale_size:self.scale_size + self.payload_size].view(self.storage_dtype)
+        payload = payload.view(batch_size, self.seq_len, self.hidden_size)
+        if self.dtype_name == "int8":
+            scale = records[:, 0:self.scale_size].view(torch.float32).view(batch_size, self.seq_len, 1)
+            torch.mul(payload, scale, out=out)
+        else:
+            out.copy_(payload)
+        return out
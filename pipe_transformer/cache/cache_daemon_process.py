@@ -1,76 +1,101 @@
 import logging
+import queue
 import shutil
 
-import psutil
+import numpy as np
+import torch
 import torch.multiprocessing as mp
 
+from .cache_codec import CacheCodec
 from .cache_msg import Message
+from .cache_policy import create_cache_policy
+from .cache_stats import SharedCounters
 from .disk_memory_manager import DiskMemoryManager
-from .shared_memory_manager import SharedMemoryManager
+from .shared_memory_arena import SharedMemoryArena
+from .shared_memory_ring_buffer import SharedMemoryRingBuffer
+
+
+def build_ring_buffer_name(config):
+    # each trainer process has its own CacheDaemon
+    return "hidden_feature_rank" + str(config.global_rank)
+
+
+def build_arena_name(config, name):
+    # the arenas are per trainer process as well: the free slot stack of an arena has a single writer
+    # (the CacheDaemon of the rank), and a daemon only evicts and spills the samples of its own rank
+    return name + "_rank" + str(config.global_rank)
+
+
+def build_daemon_counters_name(config):
+    return build_ring_buffer_name(config) + "_stats"
 
 
 class CacheDaemon(mp.Process):
-    def __init__(self, config, msg_q):
+    # the ring buffer is polled while there is no control message
+    RING_BUFFER_POLLING_INTERVAL = 0.001
+
+    def __init__(self, config, msg_q, train_sample_num, test_sample_num, train_num_slots, test_num_slots):
         super().__init__()
+        # control messages (update index, reset, finish)
         self.msg_q = msg_q
-        self.shared_memory_mgr_hidden_feature_train = SharedMemoryManager(config, "hidden_feature_train")
-        self.shared_memory_mgr_hidden_feature_test = SharedMemoryManager(config, "hidden_feature_test")
+        # hidden features of the trained/tested batches
+        self.ring_buffer = SharedMemoryRingBuffer(config, build_ring_buffer_name(config),
+                                                  config.cache_ring_buffer_size, config.batch_size)
+        self.shared_memory_mgr_hidden_feature_train = SharedMemoryArena(
+            config, build_arena_name(config, "hidden_feature_train"), train_sample_num, train_num_slots)
+        self.shared_memory_mgr_hidden_feature_test = SharedMemoryArena(
+            config, build_arena_name(config, "hidden_feature_test"), test_sample_num, test_num_slots)
+        # read by the trainer, see cache_stats.py
+        self.daemon_counters = SharedCounters(build_daemon_counters_name(config))
+        # admission and eviction of the shared memory tier
+        self.cache_policy_train = create_cache_policy(config)
+        self.cache_policy_test = create_cache_policy(config)
 
-        self.disk_memory_mgr = DiskMemoryManager("hidden_feature")
+        self.disk_memory_mgr_hidden_feature_train = DiskMemoryManager(config, "hidden_feature_train")
+        self.disk_memory_mgr_hidden_feature_test = DiskMemoryManager(config, "hidden_feature_test")
+        # key: sample_uid; value: layer id of the hidden feature which is spilled to the disk
+        self.disk_cached_layer_id_train = dict()
+        self.disk_cached_layer_id_test = dict()
 
         self.epoch = 0
         self.train_sample_index = []
         self.test_sample_index = []
 
-        self.host_memory_percentage = 0.65
+        self.batch_size = config.batch_size
+        self.sliding_window_size = config.cache_sliding_window_size
+
+        # both tiers hold the records encoded by the trainer
+        self.codec = CacheCodec(config)
+        # reused by the prefetching, which reads the disk records into it with preadv()
+        self.disk_read_buffer = None
+
         self.disk_memory_percentage = 0.85
 
+        # one of every trace_interval batches is traced by logging
+        self.trace_interval = config.cache_trace_interval
+        self.is_tracing = False
 
     def run(self) -> None:
         while True:
-            message = self.msg_q.get()
+            message = self.ring_buffer.get()
+            if message is not None:
+                self._handle_progress_message(message)
+                self.ring_buffer.release()
+                continue
+            try:
+                message = self.msg_q.get(timeout=self.RING_BUFFER_POLLING_INTERVAL)
+            except queue.Empty:
+                continue
+            # the batches written to the ring buffer before this control message are handled first
+            self._drain_ring_buffer()
             msg_type = message.get_type()
-            if msg_type == Message.MSG_TYPE_TRAINING_PROGRESS:
-                logging.info("Message.MSG_TYPE_TRAINING_PROGRESS")
-                epoch = message.get(Message.MSG_KEY_EPOCH)
-                batch_idx = message.get(Message.MSG_KEY_BATCH_INDEX)
-                batch_sample_idx = message.get(Message.MSG_KEY_BATCH_SAMPLE_INDEX)
-                hidden_feature = message.get(Message.MSG_KEY_HIDDEN_FEATURE)
-                num_frozen_layer = message.get(Message.MSG_KEY_NUM_FROZEN_LAYER)
-                cached_layer_id = message.get(Message.MSG_KEY_CACHED_NUM_FROZEN_LAYER)
-
-                # add new tensor to cache, and delete the old ones
-                # self._delete_previous_cached_batch(batch_sample_idx, cached_layer_id)
-                self._cache_a_batch_sample(cached_layer_id, batch_sample_idx, hidden_feature, num_frozen_layer, True)
-
-                sample_index_list_to_disk, \
-                sample_index_list_to_memory = self._determine_sample_location_with_sliding_window(epoch, batch_idx)
-                self._move_shared_memory_to_disk(sample_index_list_to_disk)
-                self._move_disk_memory_to_shared_memory(sample_index_list_to_memory)
-
-            elif msg_type == Message.MSG_TYPE_TEST_PROGRESS:
-                logging.info("Message.MSG_TYPE_TEST_PROGRESS")
-                epoch = message.get(Message.MSG_KEY_EPOCH)
-                batch_idx = message.get(Message.MSG_KEY_BATCH_INDEX)
-                batch_sample_idx = message.get(Message.MSG_KEY_BATCH_SAMPLE_INDEX)
-                hidden_feature = message.get(Message.MSG_KEY_HIDDEN_FEATURE)
-                num_frozen_layer = message.get(Message.MSG_KEY_NUM_FROZEN_LAYER)
-                cached_layer_id = message.get(Message.MSG_KEY_CACHED_NUM_FROZEN_LAYER)
-
-                # add new tensor to cache, and delete the old ones
-                # self._delete_previous_cached_batch(batch_sample_idx, cached_layer_id)
-                self._cache_a_batch_sample(cached_layer_id, batch_sample_idx, hidden_feature, num_frozen_layer, False)
-
-                sample_index_list_to_disk, \
-                sample_index_list_to_memory = self._determine_sample_location_with_sliding_window(epoch, batch_idx)
-                self._move_shared_memory_to_disk(sample_index_list_to_disk)
-                self._move_disk_memory_to_shared_memory(sample_index_list_to_memory)
-
-            elif msg_type == Message.MSG_TYPE_UPDATE_INDEX:
+            if msg_type == Message.MSG_TYPE_UPDATE_INDEX:
                 logging.info("Message.MSG_TYPE_UPDATE_INDEX")
                 self.epoch = message.get(Message.MSG_KEY_EPOCH)
                 self.train_sample_index = message.get(Message.MSG_KEY_TRAIN_SAMPLE_INDEX)
-                self.test_sample_index = message.get(Message.MSG_KEY_TRAIN_SAMPLE_INDEX)
+                self.test_sample_index = message.get(Message.MSG_KEY_TEST_SAMPLE_INDEX)
+                self.cache_policy_train.update_sample_index(self.train_sample_index)
+                self.cache_policy_test.update_sample_index(self.test_sample_index)
                 # logging.info(self.train_sample_index)
                 # logging.info(self.test_sample_index)
 
@@ -78,34 +103,145 @@ class CacheDaemon(mp.Process):
                 logging.info("Message.MSG_TYPE_RESET")
                 self._delete_all_cache()
             elif msg_type == Message.MSG_TYPE_FINISH:
+                self._delete_disk_cache(True)
+                self._delete_disk_cache(False)
+                self.disk_memory_mgr_hidden_feature_train.cleanup()
+                self.disk_memory_mgr_hidden_feature_test.cleanup()
                 self.shared_memory_mgr_hidden_feature_train.cleanup()
                 self.shared_memory_mgr_hidden_feature_test.cleanup()
+                self.ring_buffer.cleanup()
+                self.daemon_counters.cleanup()
                 break
             else:
                 raise Exception("no such message")
-            logging.info("subprocess is running")
 
-    def _determine_sample_location_with_sliding_window(self, epoch, current_batch_idx):
+    def _drain_ring_buffer(self):
+        message = self.ring_buffer.get()
+        while message is not None:
+            self._handle_progress_message(message)
+            self.ring_buffer.release()
+            message = self.ring_buffer.get()
+
+    def _handle_progress_message(self, message):
+        msg_type = message.get_type()
+        if msg_type == Message.MSG_TYPE_TRAINING_PROGRESS:
+            is_train = True
+        elif msg_type == Message.MSG_TYPE_TEST_PROGRESS:
+            is_train = False
+        else:
+            raise Exception("no such message")
+        epoch = message.get(Message.MSG_KEY_EPOCH)
+        batch_idx = message.get(Message.MSG_KEY_BATCH_INDEX)
+        self.is_tracing = self.trace_interval > 0 and batch_idx % self.trace_interval == 0
+        self.daemon_counters.inc("handled_batches")
+        batch_sample_idx = message.get(Message.MSG_KEY_BATCH_SAMPLE_INDEX)
+        hidden_feature = message.get(Message.MSG_KEY_HIDDEN_FEATURE)
+        num_frozen_layer = message.get(Message.MSG_KEY_NUM_FROZEN_LAYER)
+        cached_layer_id = message.get(Message.MSG_KEY_CACHED_NUM_FROZEN_LAYER)
+
+        # add new tensor to cache, and delete the old ones
+        # self._delete_previous_cached_batch(batch_sample_idx, cached_layer_id)
+        self._cache_a_batch_sample(cached_layer_id, batch_idx, batch_sample_idx, hidden_feature, num_frozen_layer,
+                                   is_train)
+
+        sample_index_list_to_disk, \
+        sample_index_list_to_memory = self._determine_sample_location_with_sliding_window(epoch, batch_idx,
+                                                                                          is_train)
+        self._move_shared_memory_to_disk(sample_index_list_to_disk, is_train)
+        self._move_disk_memory_to_shared_memory(sample_index_list_to_memory, is_train)
+
+    def _determine_sample_location_with_sliding_window(self, epoch, current_batch_idx, is_train):
+        """
+        The sample order of an epoch is known in advance (train_sample_index/test_sample_index),
+        so the samples of the next `sliding_window_size` batches are prefetched from the disk to the shared memory,
+        and the cache policy decides which samples in the shared memory are spilled to the disk to make room for them.
+        """
         sample_index_list_to_disk = []
         sample_index_list_to_memory = []
+        sample_index = self.train_sample_index if is_train else self.test_sample_index
+        if len(sample_index) == 0:
+            return sample_index_list_to_disk, sample_index_list_to_memory
+        shared_memory_mgr, _, disk_cached_layer_id = self._get_cache_managers(is_train)
+        cache_policy = self._get_cache_policy(is_train)
+
+        window_start = (current_batch_idx + 1) * self.batch_size
+        window_end = window_start + min(self.sliding_window_size * self.batch_size, len(sample_index))
+        # the window wraps around to the beginning of the next epoch
+        for position in range(window_start, window_end):
+            sample_uid = sample_index[position % len(sample_index)]
+            if sample_uid in disk_cached_layer_id:
+                sample_index_list_to_memory.append(sample_uid)
+
+        if len(sample_index_list_to_memory) > 0:
+            admitted, sample_index_list_to_disk = cache_policy.make_room(shared_memory_mgr,
+                                                                         sample_index_list_to_memory, window_start)
+            sample_index_list_to_memory = [sample_uid for sample_uid, is_admitted in
+                                           zip(sample_index_list_to_memory, admitted) if is_admitted]
+        if self.is_tracing:
+            logging.info("epoch = %d, batch_idx = %d, is_train = %s, len(sample_index_list_to_disk) = %d, "
+                         "len(sample_index_list_to_memory) = %d, free slots = %d" % (
+                             epoch, current_batch_idx, str(is_train), len(sample_index_list_to_disk),
+                             len(sample_index_list_to_memory), shared_memory_mgr.get_num_free_slots()))
         return sample_index_list_to_disk, sample_index_list_to_memory
 
-    def _cache_a_batch_sample(self, cached_layer_id, batch_sample_idx, hidden_feature, num_frozen_layer, is_train):
-        if self._is_host_memory_full():
-            return
-        if cached_layer_id > num_frozen_layer:
-            raise Exception("cached_layer_id illegal")
+    def _get_cache_managers(self, is_train):
         if is_train:
-            shared_memory_mgr = self.shared_memory_mgr_hidden_feature_train
+            return self.shared_memory_mgr_hidden_feature_train, self.disk_memory_mgr_hidden_feature_train, \
+                   self.disk_cached_layer_id_train
         else:
-            shared_memory_mgr = self.shared_memory_mgr_hidden_feature_test
-        sample_idx_in_batch = 0
-        for sample_uid in batch_sample_idx:
-            # [197, 768]
-            sample = hidden_feature[sample_idx_in_batch, :, :]
-            shared_memory_mgr.add_tensor(sample_uid, num_frozen_layer, sample)
-            sample_idx_in_batch += 1
-        logging.info("successfully!")
+            return self.shared_memory_mgr_hidden_feature_test, self.disk_memory_mgr_hidden_feature_test, \
+                   self.disk_cached_layer_id_test
+
+    def _get_cache_policy(self, is_train):
+        return self.cache_policy_train if is_train else self.cache_policy_test
+
+    def _cache_a_batch_sample(self, cached_layer_id, batch_idx, batch_sample_idx, hidden_feature, num_frozen_layer,
+                              is_train):
+        if cached_layer_id > num_frozen_layer:
+            raise Exception("cached_layer_id illegal")
+        shared_memory_mgr, disk_memory_mgr, disk_cached_layer_id = self._get_cache_managers(is_train)
+        # [B, record_size], encoded by the trainer
+        sample_idx_in_batch_new = []
+        for sample_idx_in_batch, sample_uid in enumerate(batch_sample_idx):
+            # a deeper layer has been cached (e.g., by a newer batch), keep it
+            if shared_memory_mgr.get_layer_id(sample_uid) > num_frozen_layer or \
+                    disk_cached_layer_id.get(sample_uid, -1) > num_frozen_layer:
+                continue
+
+            # the hidden feature on the disk (if any) is out of date
+            if sample_uid in disk_cached_layer_id:
+                disk_memory_mgr.delete(sample_uid, disk_cached_layer_id.pop(sample_uid))
+
+            if shared_memory_mgr.get_slot(sample_uid) >= 0:
+                # the superseded layer is overwritten in place
+                shared_memory_mgr.add_tensor(sample_uid, num_frozen_layer, hidden_feature[sample_idx_in_batch])
+                self.daemon_counters.inc("bytes_stored", self.codec.get_record_size())
+            else:
+                sample_idx_in_batch_new.append(sample_idx_in_batch)
+
+        # the samples which are not admitted by the cache policy go to the disk
+        sample_uid_list_new = [batch_sample_idx[i] for i in sample_idx_in_batch_new]
+        admitted, victims = self._get_cache_policy(is_train).make_room(shared_memory_mgr, sample_uid_list_new,
+                                                                       (batch_idx + 1) * self.batch_size)
+        self._move_shared_memory_to_disk(victims, is_train)
+        sample_idx_in_batch_to_disk = []
+        for sample_idx_in_batch, is_admitted in zip(sample_idx_in_batch_new, admitted):
+            if is_admitted and shared_memory_mgr.add_tensor(batch_sample_idx[sample_idx_in_batch], num_frozen_layer,
+                                                            hidden_feature[sample_idx_in_batch]):
+                self.daemon_counters.inc("bytes_stored", self.codec.get_record_size())
+            else:
+                sample_idx_in_batch_to_disk.append(sample_idx_in_batch)
+
+        if len(sample_idx_in_batch_to_disk) > 0:
+            if self._is_disk_storage_full():
+                self.daemon_counters.inc("dropped_samples", len(sample_idx_in_batch_to_disk))
+            else:
+                sample_uid_list_to_disk = [batch_sample_idx[i] for i in sample_idx_in_batch_to_disk]
+                disk_memory_mgr.set_batch(sample_uid_list_to_disk, num_frozen_layer,
+                                          hidden_feature[sample_idx_in_batch_to_disk].contiguous())
+                self.daemon_counters.inc("bytes_spilled", len(sample_uid_list_to_disk) * self.codec.get_record_size())
+                for sample_uid in sample_uid_list_to_disk:
+                    disk_cached_layer_id[sample_uid] = num_frozen_layer
 
     def _delete_previous_cached_batch(self, batch_sample_idx, cached_layer_id):
         sample_idx_in_batch = 0
@@ -119,22 +255,71 @@ class CacheDaemon(mp.Process):
         # logging.info("is_disk_storage_full. Percentage = " + str(used_storage_percentage))
         return True if used_storage_percentage > self.disk_memory_percentage else False
 
-    def _is_host_memory_full(self):
-        memory_cost_percent = 1 - psutil.virtual_memory()[4] / psutil.virtual_memory()[0]
-        # logging.info("is_host_memory_full. Percentage = " + str(memory_cost_percent))
-        return True if memory_cost_percent > self.host_memory_percentage else False
-
     def _calculate_num_of_sample_in_shared_memory(self, available_host_memory, hidden_feature_size):
         pass
 
     def _calculate_num_of_sample_in_disk_memory(self, available_disk_memory, hidden_feature_size):
         pass
 
-    def _move_shared_memory_to_disk(self, sample_index_list_to_disk):
-        pass
+    def _move_shared_memory_to_disk(self, sample_index_list_to_disk, is_train):
+        shared_memory_mgr, disk_memory_mgr, disk_cached_layer_id = self._get_cache_managers(is_train)
+        if len(sample_index_list_to_disk) == 0:
+            return
+        self.daemon_counters.inc("evicted_samples", len(sample_index_list_to_disk))
+        if self._is_disk_storage_full():
+            # no space on the disk, the evicted samples are dropped
+            for sample_uid in sample_index_list_to_disk:
+                shared_memory_mgr.delete_tensor(sample_uid)
+            self.daemon_counters.inc("dropped_samples", len(sample_index_list_to_disk))
+            return
+        # the samples spilled together are written to consecutive records, grouped by layer id
+        layer_to_samples = dict()
+        for sample_uid in sample_index_list_to_disk:
+            layer_id = shared_memory_mgr.get_layer_id(sample_uid)
+            if layer_id < 0:
+                continue
+            hidden_feature = shared_memory_mgr.get_tensor(sample_uid, layer_id)
+            if hidden_feature is None:
+                continue
+            layer_to_samples.setdefault(layer_id, []).append((sample_uid, hidden_feature))
+        for layer_id, samples in layer_to_samples.items():
+            sample_uid_list = [sample_uid for sample_uid, _ in samples]
+            disk_memory_mgr.set_batch(sample_uid_list, layer_id,
+                                      torch.stack([hidden_feature for _, hidden_feature in samples]))
+            self.daemon_counters.inc("bytes_spilled", len(sample_uid_list) * self.codec.get_record_size())
+            for sample_uid in sample_uid_list:
+                disk_cached_layer_id[sample_uid] = layer_id
+                shared_memory_mgr.delete_tensor(sample_uid, layer_id)
 
-    def _move_disk_memory_to_shared_memory(self, sample_index_list_to_memory):
-        pass
+    def _move_disk_memory_to_shared_memory(self, sample_index_list_to_memory, is_train):
+        shared_memory_mgr, disk_memory_mgr, disk_cached_layer_id = self._get_cache_managers(is_train)
+        if len(sample_index_list_to_memory) == 0:
+            return
+        num_samples = min(len(sample_index_list_to_memory), shared_memory_mgr.get_num_free_slots())
+        sample_index_list_to_memory = sample_index_list_to_memory[0:num_samples]
+        hidden_feature = disk_memory_mgr.get_batch(sample_index_list_to_memory,
+                                                   self._get_disk_read_buffer(num_samples))
+        for sample_idx_in_batch, sample_uid in enumerate(sample_index_list_to_memory):
+            layer_id = disk_cached_layer_id[sample_uid]
+            if not shared_memory_mgr.add_tensor(sample_uid, layer_id, hidden_feature[sample_idx_in_batch]):
+                break
+            disk_memory_mgr.delete(sample_uid, layer_id)
+            del disk_cached_layer_id[sample_uid]
+            self.daemon_counters.inc("prefetched_samples")
+
+    def _get_disk_read_buffer(self, num_samples):
+        if self.disk_read_buffer is None or self.disk_read_buffer.shape[0] < num_samples:
+            self.disk_read_buffer = np.empty((num_samples, self.codec.get_record_size()), dtype=np.uint8)
+        return self.disk_read_buffer[0:num_samples]
+
+    def _delete_disk_cache(self, is_train):
+        _, disk_memory_mgr, disk_cached_layer_id = self._get_cache_managers(is_train)
+        for sample_uid, layer_id in disk_cached_layer_id.items():
+            disk_memory_mgr.delete(sample_uid, layer_id)
+        disk_cached_layer_id.clear()
 
     def _delete_all_cache(self):
-        pass
+        self.shared_memory_mgr_hidden_feature_train.delete_all_tensors()
+        self.shared_memory_mgr_hidden_feature_test.delete_all_tensors()
+        self._delete_disk_cache(True)
+        self._delete_disk_cache(False)
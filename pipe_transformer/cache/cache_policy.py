@@ -0,0 +1,195 @@
+import logging
+
+import numpy as np
+
+from .cache_codec import CacheCodec
+
+"""
+Admission and eviction policies of the shared memory tier (SharedMemoryArena).
+
+The size of the shared memory tier is an explicit byte budget (config.cache_host_memory_budget),
+so a sample needs a free slot, or a victim which is evicted (spilled to the disk tier, or dropped) for it.
+The CacheDaemon asks the policy to make room when a batch is cached or prefetched:
+
+    admitted, victims = policy.make_room(arena, new_sample_uids, position)
+
+    new_sample_uids - the samples which need a slot
+    position        - the position of the next sample to be read in the sample order of the epoch
+    admitted        - bool mask of new_sample_uids, the samples which get a slot
+    victims         - the sample uids to be evicted, len(victims) <= the number of admitted samples
+
+The arenas are per rank (see build_arena_name()), so the residents of an arena are the samples of this rank.
+A victim is spilled to the disk shard of the same rank, which the daemon of the rank prefetches from.
+A resident which is not in the sample order of the epoch (e.g., its sample moved to another rank after
+the data parallel width changed) is never read by this rank again, so it is the first victim.
+
+Policies:
+    lru    - evict the least recently used samples (the trainer stamps the slots of the hit samples)
+    clock  - second chance: a hand sweeps the slots, clears the reference bits, and evicts the unreferenced ones
+    belady - the sample order of an epoch is known (and repeated), so the next use of a sample is
+             (position_in_epoch(uid) - position) mod N. Evict the samples whose next use is the farthest,
+             and only admit a new sample if it is used earlier than the victim.
+"""
+
+
+class CachePolicy:
+    def __init__(self, config):
+        self.config = config
+
+    def update_sample_index(self, sample_index):
+        pass
+
+    def make_room(self, arena, new_sample_uids, position):
+        new_sample_uids = np.asarray(new_sample_uids, dtype=np.int64)
+        admitted = np.zeros(len(new_sample_uids), dtype=bool)
+        num_free_slots = arena.get_num_free_slots()
+        num_victims = max(0, len(new_sample_uids) - num_free_slots)
+        victims = self.select_victims(arena, num_victims, new_sample_uids, position) if num_victims > 0 else []
+        admitted[0:min(len(new_sample_uids), num_free_slots + len(victims))] = True
+        return admitted, victims
+
+    def select_victims(self, arena, num_victims, excluded_sample_uids, position):
+        raise NotImplementedError()
+
+    def _get_occupied_slots(self, arena, excluded_sample_uids):
+        occupied = (arena.slot_to_uid >= 0) & (arena.slot_layer >= 0)
+        if len(excluded_sample_uids) > 0:
+            occupied &= ~np.isin(arena.slot_to_uid, excluded_sample_uids)
+        return np.nonzero(occupied)[0]
+
+
+class LRUPolicy(CachePolicy):
+    def select_victims(self, arena, num_victims, excluded_sample_uids, position):
+        slots = self._get_occupied_slots(arena, excluded_sample_uids)
+        num_victims = min(num_victims, len(slots))
+        if num_victims == 0:
+            return []
+        last_access = arena.slot_access[slots]
+        victim_slots = slots[np.argpartition(last_access, num_victims - 1)[0:num_victims]]
+        return arena.slot_to_uid[victim_slots].tolist()
+
+
+class CLOCKPolicy(CachePolicy):
+    def __init__(self, config):
+        super().__init__(config)
+        self.hand = 0
+
+    def select_victims(self, arena, num_victims, excluded_sample_uids, position):
+        num_slots = arena.get_num_slots()
+        slots = (self.hand + np.arange(num_slots)) % num_slots
+        candidate = np.zeros(num_slots, dtype=bool)
+        candidate[self._get_occupied_slots(arena, excluded_sample_uids)] = True
+        candidate = candidate[slots]
+        num_victims = min(num_victims, int(candidate.sum()))
+        if num_victims == 0:
+            return []
+        is_unreferenced = candidate & (arena.slot_access[slots] == 0)
+        positions = np.nonzero(is_unreferenced)[0]
+        if len(positions) >= num_victims:
+            last = positions[num_victims - 1]
+            # the hand gives a second chance to the referenced slots it passes
+            arena.slot_access[slots[0:last + 1]] = 0
+        else:
+            # a full sweep clears all reference bits, then the hand continues from the start
+            arena.slot_access[:] = 0
+            positions = np.nonzero(candidate)[0]
+            last = positions[num_victims - 1]
+        victim_slots = slots[positions[0:num_victims]]
+        self.hand = int((slots[last] + 1) % num_slots)
+        return arena.slot_to_uid[victim_slots].tolist()
+
+
+class BeladyPolicy(CachePolicy):
+    def __init__(self, config):
+        super().__init__(config)
+        # sample_uid -> position in the sample order of an epoch (-1: not in the order)
+        self.position_of_sample = np.zeros(0, dtype=np.int64)
+        self.epoch_len = 0
+
+    def update_sample_index(self, sample_index):
+        sample_index = np.asarray(sample_index, dtype=np.int64)
+        self.epoch_len = len(sample_index)
+        if self.epoch_len == 0:
+            self.position_of_sample = np.zeros(0, dtype=np.int64)
+            return
+        self.position_of_sample = np.full(int(sample_index.max()) + 1, -1, dtype=np.int64)
+        self.position_of_sample[sample_index] = np.arange(self.epoch_len, dtype=np.int64)
+
+    def make_room(self, arena, new_sample_uids, position):
+        new_sample_uids = np.asarray(new_sample_uids, dtype=np.int64)
+        num_free_slots = arena.get_num_free_slots()
+        admitted = np.zeros(len(new_sample_uids), dtype=bool)
+        new_distance = self._get_next_use_distance(new_sample_uids, position)
+        order = np.argsort(new_distance, kind="stable")
+        # the free slots are given to the samples which are used the earliest
+        admitted[order[0:num_free_slots]] = True
+        order = order[num_free_slots:]
+        if len(order) == 0:
+            return admitted, []
+
+        slots = self._get_occupied_slots(arena, new_sample_uids)
+        resident_distance = self._get_next_use_distance(arena.slot_to_uid[slots], position)
+        farthest = self._get_farthest(resident_distance, len(order))
+        # pair the earliest new samples with the farthest residents, evict while the new one is used earlier
+        is_earlier = new_distance[order[0:len(farthest)]] < resident_distance[farthest]
+        num_victims = len(farthest) if is_earlier.all() else int(np.argmin(is_earlier))
+        admitted[order[0:num_victims]] = True
+        return admitted, arena.slot_to_uid[slots[farthest[0:num_victims]]].tolist()
+
+    def select_victims(self, arena, num_victims, excluded_sample_uids, position):
+        slots = self._get_occupied_slots(arena, excluded_sample_uids)
+        num_victims = min(num_victims, len(slots))
+        if num_victims == 0:
+            return []
+        resident_distance = self._get_next_use_distance(arena.slot_to_uid[slots], position)
+        return arena.slot_to_uid[slots[self._get_farthest(resident_distance, num_victims)]].tolist()
+
+    def _get_farthest(self, distance, k):
+        k = min(k, len(distance))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        farthest = np.argpartition(-distance, k - 1)[0:k]
+        return farthest[np.argsort(-distance[farthest], kind="stable")]
+
+    def _get_next_use_distance(self, sample_uids, position):
+        distance = np.full(len(sample_uids), self.epoch_len, dtype=np.int64)
+        if self.epoch_len == 0:
+            return distance
+        in_range = sample_uids < len(self.position_of_sample)
+        sample_position = np.full(len(sample_uids), -1, dtype=np.int64)
+        sample_position[in_range] = self.position_of_sample[sample_uids[in_range]]
+        # the samples which are not in the order of this rank are never used again by it
+        is_used = sample_position >= 0
+        distance[is_used] = (sample_position[is_used] - position) % self.epoch_len
+        return distance
+
+
+def create_cache_policy(config):
+    policy_name = config.cache_eviction_policy
+    if policy_name == "lru":
+        return LRUPolicy(config)
+    elif policy_name == "clock":
+        return CLOCKPolicy(config)
+    elif policy_name == "belady":
+        return BeladyPolicy(config)
+    else:
+        raise Exception("no such cache eviction policy: %s" % policy_name)
+
+
+def get_num_slots_with_budget(config, train_sample_num, test_sample_num, available_host_memory):
+    """
+    Split the byte budget of the shared memory tier between the processes of the node (each one has its own arenas),
+    and then between the train and test arenas in proportion to the number of samples.
+    """
+    budget = config.cache_host_memory_budget
+    if budget <= 0:
+        budget = int(available_host_memory * config.cache_host_memory_fraction)
+    budget //= max(1, config.world_size // max(1, config.num_nodes))
+    record_size = CacheCodec(config).get_record_size()
+    total_num_slots = budget // record_size
+    total_sample_num = max(1, train_sample_num + test_sample_num)
+    train_num_slots = min(train_sample_num, max(1, total_num_slots * train_sample_num // total_sample_num))
+    test_num_slots = min(test_sample_num, max(1, total_num_slots - train_num_slots))
+    logging.info("cache budget = %d bytes, record size = %d, train_num_slots = %d, test_num_slots = %d" % (
+        budget, record_size, train_num_slots, test_num_slots))
+    return train_num_slots, test_num_slots
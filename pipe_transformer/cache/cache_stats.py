@@ -0,0 +1,139 @@
+# https://docs.python.org/3/library/multiprocessing.shared_memory.html
+import json
+import logging
+import math
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+"""
+Counters and latency histograms of AutoCache, exported per epoch by AutoCache.get_stats(),
+and appended to config.cache_stats_path as JSON lines (one line per epoch) when it is set.
+
+trainer side (CacheStats, in the trainer process):
+    hit_batches, partial_hit_batches, miss_batches  - batches whose samples are all / partly / not cached
+    hit_samples, partial_hit_samples, miss_samples  - cached at num_frozen_layer / at a shallower layer / not cached
+    dropped_batches                                 - the ring buffer to the daemon is full
+    gather_latency                                  - cache lookup + gather + decode of a batch (second)
+    write_latency                                   - handing a batch over to the daemon (second)
+    daemon_queue_depth                              - used slots of the ring buffer when a batch is written
+
+daemon side (SharedCounters, int64 in shared memory, written by the CacheDaemon and read by the trainer):
+    handled_batches, bytes_stored, bytes_spilled, prefetched_samples, evicted_samples, dropped_samples
+"""
+
+
+class LogHistogram:
+    """
+    bucket i holds the values in [2^(i-1), 2^i) units, and bucket 0 holds the values < 1 unit,
+    where a unit is 1 / unit_scale (e.g., unit_scale = 1e6 for the latency in second with 1 us buckets).
+    """
+    NUM_BUCKETS = 32
+
+    def __init__(self, unit_scale=1.0):
+        self.unit_scale = unit_scale
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        value_in_unit = value * self.unit_scale
+        bucket = 0 if value_in_unit < 1.0 else min(self.NUM_BUCKETS - 1, int(math.log2(value_in_unit)) + 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """the upper bound of the bucket where the q-th percentile falls"""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100.0 * self.count
+        accumulated = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            accumulated += bucket_count
+            if accumulated >= rank:
+                return min(self.max, (1 << bucket) / self.unit_scale)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets": self.buckets,
+        }
+
+
+class CacheStats:
+    COUNTER_NAMES = ["hit_batches", "partial_hit_batches", "miss_batches", "hit_samples", "partial_hit_samples",
+                     "miss_samples", "dropped_batches"]
+    # name -> unit scale of the histogram
+    HISTOGRAMS = {"gather_latency": 1e6, "write_latency": 1e6, "daemon_queue_depth": 1.0}
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.reset()
+
+    def reset(self):
+        self.counters = {name: 0 for name in self.COUNTER_NAMES}
+        self.histograms = {name: LogHistogram(unit_scale) for name, unit_scale in self.HISTOGRAMS.items()}
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def to_dict(self):
+        stats = dict(self.counters)
+        for name, histogram in self.histograms.items():
+            stats[name] = histogram.to_dict()
+        num_samples = self.counters["hit_samples"] + self.counters["partial_hit_samples"] + \
+                      self.counters["miss_samples"]
+        stats["hit_rate"] = self.counters["hit_samples"] / num_samples if num_samples > 0 else 0.0
+        return stats
+
+
+class SharedCounters:
+    COUNTER_NAMES = ["handled_batches", "bytes_stored", "bytes_spilled", "prefetched_samples", "evicted_samples",
+                     "dropped_samples"]
+
+    def __init__(self, name):
+        self.name = name
+        size = len(self.COUNTER_NAMES) * np.dtype(np.int64).itemsize
+        try:
+            self.shm = SharedMemory(name=name, create=True, size=size)
+            self.is_owner = True
+            self.values = np.ndarray([len(self.COUNTER_NAMES)], dtype=np.int64, buffer=self.shm.buf)
+            self.values[:] = 0
+        except FileExistsError:
+            self.shm = SharedMemory(name=name)
+            self.is_owner = False
+            self.values = np.ndarray([len(self.COUNTER_NAMES)], dtype=np.int64, buffer=self.shm.buf)
+        self.index = {counter_name: i for i, counter_name in enumerate(self.COUNTER_NAMES)}
+
+    def inc(self, name, value=1):
+        # only the daemon writes the counters
+        self.values[self.index[name]] += value
+
+    def snapshot(self):
+        return {name: int(self.values[i]) for i, name in enumerate(self.COUNTER_NAMES)}
+
+    def cleanup(self):
+        del self.values
+        self.shm.close()
+        if self.is_owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                logging.info("%s does not exist" % self.name)
+
+
+def dump_stats_as_json_line(path, stats):
+    with open(path, "a") as f:
+        f.write(json.dumps(stats) + "\n")
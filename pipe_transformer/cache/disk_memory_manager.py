@@ -1,54 +1,204 @@
+import logging
 import os
-import pickle
 
+import numpy as np
 import torch
 
+from .cache_codec import CacheCodec
+
+"""
+Pickling one [seq_len, hidden_size] array per file needs one open/unpickle per sample,
+and a big chunk cannot be serialized by pickle at all ("cannot serialize a bytes object larger than 4 GiB").
+
+DiskMemoryManager stores the hidden features in large memory-mapped shard files with a fixed record size:
+
+    record  = [record_size] uint8, the hidden feature encoded by CacheCodec
+    shard k = ./.cache/<name>_rank<global_rank>_shard_<k>.fea, holding `records_per_shard` records
+    index   : sample_uid -> (record id, layer id); shard = record // records_per_shard,
+              offset = (record % records_per_shard) * record_size
+
+Deleted records are reused: a spilled batch takes the longest runs of consecutive free records first,
+and only the shortfall is appended at the tail of the last shard, so the shards do not grow beyond the records
+which are in use at the same time. Each run of consecutive records is read back with a single preadv() call.
+"""
+
 
 class DiskMemoryManager:
-    def __init__(self, name):
+    # the size of a single shard file
+    MAX_SHARD_SIZE = 1 << 32
+
+    def __init__(self, config, name):
+        self.config = config
         self.name = name
+        self.cache_dir = config.cache_disk_dir
+
+        self.record_size = CacheCodec(config).get_record_size()
+        self.record_shape = (self.record_size,)
+        self.record_dtype = np.uint8
+        self.records_per_shard = max(1, self.MAX_SHARD_SIZE // self.record_size)
+
+        # key: sample_uid; value: (record id, layer id)
+        self.index = dict()
+        self.free_records = []
+        self.num_records = 0
+
+        # shard id -> (file descriptor, np.memmap with shape [records_per_shard, record_size])
+        self.shards = dict()
 
     def set(self, sample_uid, layer_id, hidden_tensor):
-        file_path = self._build_path(sample_uid, layer_id)
+        self.delete(sample_uid)
+        record = self.free_records.pop() if len(self.free_records) > 0 else self._append_records(1)
+        _, shard = self._get_shard(record // self.records_per_shard)
+        shard[record % self.records_per_shard] = hidden_tensor.numpy()
+        self.index[sample_uid] = (record, layer_id)
+
+    def set_batch(self, batch_sample_idx, layer_id, hidden_tensor):
+        """Write a batch of records [B, record_size], into runs of consecutive records as long as possible."""
+        for sample_uid in batch_sample_idx:
+            self.delete(sample_uid)
         hidden_np = hidden_tensor.numpy()
-        pickle.dump(hidden_np, open(file_path, "wb"))
+        records = self._allocate_records(len(batch_sample_idx))
+        start = 0
+        while start < len(records):
+            end = start + 1
+            shard_id = records[start] // self.records_per_shard
+            while end < len(records) and records[end] == records[end - 1] + 1 and \
+                    records[end] // self.records_per_shard == shard_id:
+                end += 1
+            row = records[start] % self.records_per_shard
+            _, shard = self._get_shard(shard_id)
+            shard[row:row + end - start] = hidden_np[start:end]
+            start = end
+        for sample_idx_in_batch, sample_uid in enumerate(batch_sample_idx):
+            self.index[sample_uid] = (int(records[sample_idx_in_batch]), layer_id)
 
     def get(self, sample_uid, layer_id):
-        file_path = self._build_path(sample_uid, layer_id)
-        hidden_np = pickle.load(open(file_path, "rb"))
-        tensor = torch.from_numpy(hidden_np).cpu()
-        return tensor
-
-    def delete(self, sample_uid, layer_id):
-        file_path = self._build_path(sample_uid, layer_id)
-        if os.path.exists(file_path):
-            print("delete")
-            os.remove(file_path)
-
-    def _build_path(self, sample_uid, layer_id):
-        path_level1 = sample_uid // 100 + 1
-        path_level2 = path_level1 // 100 + 1
-        path_level3 = path_level2 // 100 + 1
-        cache_path = os.path.join("./.cache", str(path_level3 % 100), str(path_level2 % 100),
-                                  str(path_level1 % 100))
-        if not os.path.exists(cache_path):
-            os.makedirs(cache_path, exist_ok=True)
-        file_path = cache_path + "/" + self.name + "_" + str(sample_uid) + "_" + str(layer_id) + ".fea"
-        print(file_path)
-        return file_path
+        record, cached_layer_id = self.index[sample_uid]
+        if cached_layer_id != layer_id:
+            raise Exception("layer id does not match!")
+        _, shard = self._get_shard(record // self.records_per_shard)
+        return torch.from_numpy(np.array(shard[record % self.records_per_shard]))
+
+    def get_batch(self, batch_sample_idx, out):
+        """
+        Read the records of a batch into a preallocated uint8 ndarray out ([B, record_size]).
+        Consecutive records are read with one preadv() call.
+        """
+        records = np.asarray([self.index[sample_uid][0] for sample_uid in batch_sample_idx], dtype=np.int64)
+        order = np.argsort(records, kind="stable")
+        start = 0
+        while start < len(order):
+            end = start + 1
+            shard_id = records[order[start]] // self.records_per_shard
+            while end < len(order) and records[order[end]] == records[order[end - 1]] + 1 and \
+                    records[order[end]] // self.records_per_shard == shard_id:
+                end += 1
+            fd, shard = self._get_shard(shard_id)
+            row = records[order[start]] % self.records_per_shard
+            if hasattr(os, "preadv"):
+                buffers = [memoryview(out[i]).cast("B") for i in order[start:end]]
+                os.preadv(fd, buffers, int(row) * self.record_size)
+            else:
+                out[order[start:end]] = shard[row:row + end - start]
+            start = end
+        return torch.from_numpy(out)
+
+    def get_layer_id(self, sample_uid):
+        if sample_uid not in self.index:
+            return -1
+        return self.index[sample_uid][1]
+
+    def delete(self, sample_uid, layer_id=None):
+        if sample_uid not in self.index:
+            return
+        record, cached_layer_id = self.index[sample_uid]
+        if layer_id is not None and cached_layer_id != layer_id:
+            return
+        del self.index[sample_uid]
+        self.free_records.append(record)
+
+    def cleanup(self):
+        self.index.clear()
+        self.free_records.clear()
+        self.num_records = 0
+        for shard_id in list(self.shards.keys()):
+            fd, shard = self.shards.pop(shard_id)
+            del shard
+            os.close(fd)
+            os.remove(self._build_path(shard_id))
+
+    def _allocate_records(self, num_records):
+        """
+        Take the free records, the longest runs of consecutive records (in the same shard) first,
+        and append the shortfall at the tail.
+        """
+        runs_taken = []
+        num_to_append = num_records
+        if len(self.free_records) > 0:
+            free_records = np.sort(np.asarray(self.free_records, dtype=np.int64))
+            run_starts = np.nonzero((np.diff(free_records) != 1) |
+                                    (free_records[1:] % self.records_per_shard == 0))[0] + 1
+            runs = sorted(np.split(free_records, run_starts), key=len, reverse=True)
+            runs_left = []
+            for run in runs:
+                if num_to_append > 0:
+                    runs_taken.append(run[:num_to_append])
+                    num_to_append -= len(runs_taken[-1])
+                    run = run[len(runs_taken[-1]):]
+                if len(run) > 0:
+                    runs_left.append(run)
+            self.free_records = np.concatenate(runs_left).tolist() if len(runs_left) > 0 else []
+        if num_to_append > 0:
+            first_record = self._append_records(num_to_append)
+            runs_taken.append(np.arange(first_record, first_record + num_to_append, dtype=np.int64))
+        return np.concatenate(runs_taken).tolist()
+
+    def _append_records(self, num_records):
+        # a run of records does not cross the shards, which keeps the batch readable with one preadv()
+        row = self.num_records % self.records_per_shard
+        if num_records <= self.records_per_shard and row + num_records > self.records_per_shard:
+            for record in range(self.num_records, self.num_records + self.records_per_shard - row):
+                self.free_records.append(record)
+            self.num_records += self.records_per_shard - row
+        first_record = self.num_records
+        self.num_records += num_records
+        return first_record
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            file_path = self._build_path(shard_id)
+            shard_size = self.records_per_shard * self.record_size
+            fd = os.open(file_path, os.O_RDWR | os.O_CREAT)
+            # sparse file, the disk space is allocated when the records are written
+            os.ftruncate(fd, shard_size)
+            shard = np.memmap(file_path, dtype=self.record_dtype, mode="r+",
+                              shape=(self.records_per_shard,) + self.record_shape)
+            self.shards[shard_id] = (fd, shard)
+            logging.info("create a disk cache shard: %s" % file_path)
+        return self.shards[shard_id]
+
+    def _build_path(self, shard_id):
+        return os.path.join(self.cache_dir, "%s_rank%s_shard_%d.fea" % (
+            self.name, str(getattr(self.config, "global_rank", 0)), shard_id))
 
 
 if __name__ == "__main__":
-    disk_cache = DiskMemoryManager("hidden_feature")
-    blocks = 2000
+    from pipe_transformer.config_args import ConfigArgs
+
+    config = ConfigArgs()
+    disk_cache = DiskMemoryManager(config, "hidden_feature")
+    codec = CacheCodec(config)
+    blocks = 20
     for i in range(blocks):
-        hidden_tensor_set = torch.randn([500, 197, 768])
-        disk_cache.set(i, i, hidden_tensor_set)
+        hidden_tensor_set = codec.encode(torch.randn([500, 197, 768]))
+        batch_sample_idx = [i * 500 + j for j in range(500)]
+        disk_cache.set_batch(batch_sample_idx, i, hidden_tensor_set)
 
-        hidden_tensor = disk_cache.get(i, i)
+        hidden_tensor = disk_cache.get_batch(batch_sample_idx,
+                                             np.empty([500, codec.get_record_size()], dtype=np.uint8))
         if torch.equal(hidden_tensor, hidden_tensor_set):
             print("equal")
 
     print("************")
-    # for i in range(blocks):
-    #     disk_cache.delete(i, i)
+    disk_cache.cleanup()
@@ -0,0 +1,302 @@
+# https://docs.python.org/3/library/multiprocessing.shared_memory.html
+import logging
+import math
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+
+from .cache_codec import CacheCodec
+from .lock import lock
+
+"""
+SharedMemoryManager creates one POSIX shared memory segment per (sample_uid, layer_id).
+For ImageNet + ViT-B/16 this means more than one million named segments (one mmap and one /dev/shm inode each),
+which is slow to open by name and hits the kernel limits of shared memory.
+
+SharedMemoryArena keeps all hidden features in a few big pre-sized slabs,
+which are split into fixed-size slots. A slot holds the byte record of one hidden feature encoded by CacheCodec
+(float32/float16/bfloat16/int8, see config.cache_dtype).
+A compact index segment is shared by the trainer and the CacheDaemon of a rank (see build_arena_name()):
+
+    header      = [magic, num_samples, num_slots, free_top]
+    uid_to_slot = [num_samples]  sample_uid -> slot (-1: not cached)
+    slot_to_uid = [num_slots]    slot -> sample_uid (-1: free)
+    slot_layer  = [num_slots]    slot -> layer id of the cached hidden feature (-1: free or being written)
+    slot_access = [num_slots]    slot -> time of the last access (monotonic ns, 0: not referenced), see cache_policy.py
+    free_slots  = [num_slots]    stack of free slots, free_slots[0:free_top] are available
+
+A sample keeps only its deepest cached layer: a deeper hidden feature overwrites the slot of the sample in place,
+so the superseded layer is freed right away, and uid_to_slot + slot_layer is the per-sample layer-version index.
+
+A slot is addressed by offset: slot // slots_per_slab is the slab, slot % slots_per_slab is the row inside the slab.
+Slabs are created lazily by the writer, so the host memory is only committed when a slot is written.
+The CacheDaemon is the only writer of the free slot stack, so free_top is read and updated without a lock.
+"""
+
+
+class SharedMemoryArena:
+    ARENA_MAGIC = 0x50495045
+    HEADER_LEN = 4
+    HEADER_IDX_MAGIC = 0
+    HEADER_IDX_NUM_SAMPLES = 1
+    HEADER_IDX_NUM_SLOTS = 2
+    HEADER_IDX_FREE_TOP = 3
+
+    # the size of a single slab is bounded to keep each mmap reasonable
+    MAX_SLAB_SIZE = 1 << 31
+
+    def __init__(self, config, name, num_samples, num_slots=None):
+        self.config = config
+        self.name = name
+        self.num_samples = int(num_samples)
+        self.num_slots = int(num_samples if num_slots is None else num_slots)
+
+        self.codec = CacheCodec(self.config)
+        self.slot_shape = (self.codec.get_record_size(),)
+        self.slot_dtype = np.uint8
+        self.slot_size = self.codec.get_record_size()
+
+        self.is_owner = False
+        self.index_shm = self._create_or_attach_index()
+        self.slots_per_slab = max(1, min(self.num_slots, self.MAX_SLAB_SIZE // self.slot_size))
+        self.num_slabs = max(1, math.ceil(self.num_slots / self.slots_per_slab))
+        self._build_index_view()
+
+        # slab id -> (SharedMemory, ndarray view with shape [slots_per_slab, record_size])
+        self.slabs = dict()
+
+    def get_num_slots(self):
+        return self.num_slots
+
+    def get_num_free_slots(self):
+        return int(self.header[self.HEADER_IDX_FREE_TOP])
+
+    def is_full(self):
+        return self.get_num_free_slots() == 0
+
+    def get_slot(self, sample_uid):
+        return int(self.uid_to_slot[sample_uid])
+
+    def get_layer_id(self, sample_uid):
+        slot = int(self.uid_to_slot[sample_uid])
+        if slot < 0:
+            return -1
+        return int(self.slot_layer[slot])
+
+    @lock
+    def add_tensor(self, sample_uid, layer_id, tensor):
+        """tensor is the [record_size] uint8 record encoded by CacheCodec"""
+        if tuple(tensor.shape) != self.slot_shape:
+            logging.info(tensor.shape)
+            logging.info(self.config)
+            raise Exception("size does not match!")
+        slot = int(self.uid_to_slot[sample_uid])
+        if slot < 0:
+            slot = self._allocate_slot()
+            if slot < 0:
+                return False
+        # mark the slot as being written so that readers treat it as a miss until the copy finishes
+        self.slot_layer[slot] = -1
+        np.copyto(self._get_slot_view(slot), tensor.numpy())
+        self.slot_to_uid[slot] = sample_uid
+        self.uid_to_slot[sample_uid] = slot
+        self.slot_access[slot] = time.monotonic_ns()
+        self.slot_layer[slot] = layer_id
+        return True
+
+    def get_tensor(self, sample_uid, layer_id):
+        slot = int(self.uid_to_slot[sample_uid])
+        if slot < 0 or self.slot_layer[slot] != layer_id:
+            return None
+        tensor = torch.from_numpy(np.array(self._get_slot_view(slot)))
+        # the daemon may overwrite the slot during the copy
+        if self.slot_layer[slot] != layer_id or self.slot_to_uid[slot] != sample_uid:
+            return None
+        return tensor
+
+    def get_batch_tensor(self, batch_sample_idx, max_layer_id, out):
+        """
+        Gather the records of a whole batch into a preallocated uint8 ndarray out ([B, record_size])
+        with one fancy-indexing pass per slab.
+        Return the cached layer id of each sample, which is the deepest cached layer <= max_layer_id
+        (-1: not cached, and out[i] is undefined).
+        """
+        batch_sample_idx = np.asarray(batch_sample_idx, dtype=np.int64)
+        slots = self.uid_to_slot[batch_sample_idx]
+        is_hit = slots >= 0
+        layer_ids = np.full(len(batch_sample_idx), -1, dtype=np.int64)
+        layer_ids[is_hit] = self.slot_layer[slots[is_hit]]
+        layer_ids[layer_ids > max_layer_id] = -1
+        is_hit = layer_ids >= 0
+        if not is_hit.any():
+            return layer_ids
+        slab_ids = slots // self.slots_per_slab
+        rows = slots % self.slots_per_slab
+        first_slab_id = int(slab_ids[0])
+        if is_hit.all() and (slab_ids == first_slab_id).all():
+            _, slab = self._get_slab(first_slab_id)
+            np.take(slab, rows, axis=0, out=out)
+        else:
+            for slab_id in np.unique(slab_ids[is_hit]):
+                _, slab = self._get_slab(int(slab_id))
+                mask = is_hit & (slab_ids == slab_id)
+                out[mask] = slab[rows[mask]]
+        # the daemon may overwrite some slots during the gather
+        is_changed = np.zeros(len(batch_sample_idx), dtype=bool)
+        is_changed[is_hit] = (self.slot_layer[slots[is_hit]] != layer_ids[is_hit]) | \
+                             (self.slot_to_uid[slots[is_hit]] != batch_sample_idx[is_hit])
+        layer_ids[is_changed] = -1
+        is_hit &= ~is_changed
+        self.slot_access[slots[is_hit]] = time.monotonic_ns()
+        return layer_ids
+
+    @lock
+    def delete_tensor(self, sample_uid, layer_id=None):
+        slot = int(self.uid_to_slot[sample_uid])
+        if slot < 0:
+            logging.info("%d does not exist" % sample_uid)
+            return
+        if layer_id is not None and self.slot_layer[slot] != layer_id:
+            return
+        self._free_slot(slot)
+
+    @lock
+    def delete_all_tensors(self):
+        self.slot_layer[:] = -1
+        self.slot_access[:] = 0
+        self.uid_to_slot[:] = -1
+        self.slot_to_uid[:] = -1
+        self.free_slots[:] = np.arange(self.num_slots - 1, -1, -1, dtype=np.int64)
+        self.header[self.HEADER_IDX_FREE_TOP] = self.num_slots
+
+    @lock
+    def cleanup(self):
+        for slab_id in list(self.slabs.keys()):
+            slab_shm, slab = self.slabs.pop(slab_id)
+            # the ndarray view must be released before closing the shared memory
+            del slab
+            slab_shm.close()
+            if self.is_owner:
+                self._unlink(slab_shm)
+        del self.header, self.uid_to_slot, self.slot_to_uid, self.slot_layer, self.slot_access, self.free_slots
+        self.index_shm.close()
+        if self.is_owner:
+            # the slabs created by other processes are also released by the owner of the index
+            for slab_id in range(self.num_slabs):
+                try:
+                    slab_shm = SharedMemory(name=self._build_slab_memory_name(slab_id))
+                    slab_shm.close()
+                    self._unlink(slab_shm)
+                except FileNotFoundError:
+                    pass
+            self._unlink(self.index_shm)
+
+    def _create_or_attach_index(self):
+        index_len = self._get_index_len()
+        index_size = index_len * np.dtype(np.int64).itemsize
+        index_name = self._build_index_memory_name()
+        try:
+            index_shm = SharedMemory(name=index_name, create=True, size=index_size)
+            self.is_owner = True
+            index = np.ndarray([index_len], dtype=np.int64, buffer=index_shm.buf)
+            index[:] = -1
+            index[self.HEADER_LEN + self.num_samples + 2 * self.num_slots:
+                  self.HEADER_LEN + self.num_samples + 3 * self.num_slots] = 0
+            free_slots = index[self.HEADER_LEN + self.num_samples + 3 * self.num_slots:]
+            # pop order is 0, 1, 2, ... so that the slabs are filled one after another
+            free_slots[:] = np.arange(self.num_slots - 1, -1, -1, dtype=np.int64)
+            index[self.HEADER_IDX_NUM_SAMPLES] = self.num_samples
+            index[self.HEADER_IDX_NUM_SLOTS] = self.num_slots
+            index[self.HEADER_IDX_FREE_TOP] = self.num_slots
+            # the magic number is written at last, and other processes wait for it before using the index
+            index[self.HEADER_IDX_MAGIC] = self.ARENA_MAGIC
+            del index, free_slots
+            logging.info("%s is created. num_samples = %d, num_slots = %d" % (
+                index_name, self.num_samples, self.num_slots))
+        except FileExistsError:
+            index_shm = SharedMemory(name=index_name)
+            header = np.ndarray([self.HEADER_LEN], dtype=np.int64, buffer=index_shm.buf)
+            waiting_time = 0.0
+            while header[self.HEADER_IDX_MAGIC] != self.ARENA_MAGIC:
+                if waiting_time > 10.0:
+                    raise Exception("%s is not initialized!" % index_name)
+                time.sleep(0.01)
+                waiting_time += 0.01
+            if header[self.HEADER_IDX_NUM_SAMPLES] != self.num_samples:
+                raise Exception("%s exists with a different size, please remove the stale /dev/shm/%s" %
+                                (index_name, index_name))
+            # the number of slots (the memory budget) is decided by the creator
+            if header[self.HEADER_IDX_NUM_SLOTS] != self.num_slots:
+                logging.info("%s has %d slots (%d requested)" % (index_name, header[self.HEADER_IDX_NUM_SLOTS],
+                                                                 self.num_slots))
+                self.num_slots = int(header[self.HEADER_IDX_NUM_SLOTS])
+            del header
+        return index_shm
+
+    def _get_index_len(self):
+        return self.HEADER_LEN + self.num_samples + 4 * self.num_slots
+
+    def _build_index_view(self):
+        index = np.ndarray([self._get_index_len()], dtype=np.int64, buffer=self.index_shm.buf)
+        offset = self.HEADER_LEN
+        self.header = index[0:offset]
+        self.uid_to_slot = index[offset:offset + self.num_samples]
+        offset += self.num_samples
+        self.slot_to_uid = index[offset:offset + self.num_slots]
+        offset += self.num_slots
+        self.slot_layer = index[offset:offset + self.num_slots]
+        offset += self.num_slots
+        self.slot_access = index[offset:offset + self.num_slots]
+        offset += self.num_slots
+        self.free_slots = index[offset:offset + self.num_slots]
+
+    def _allocate_slot(self):
+        free_top = int(self.header[self.HEADER_IDX_FREE_TOP])
+        if free_top == 0:
+            return -1
+        free_top -= 1
+        slot = int(self.free_slots[free_top])
+        self.header[self.HEADER_IDX_FREE_TOP] = free_top
+        return slot
+
+    def _free_slot(self, slot):
+        sample_uid = int(self.slot_to_uid[slot])
+        self.slot_layer[slot] = -1
+        self.slot_access[slot] = 0
+        self.slot_to_uid[slot] = -1
+        if sample_uid >= 0 and self.uid_to_slot[sample_uid] == slot:
+            self.uid_to_slot[sample_uid] = -1
+        free_top = int(self.header[self.HEADER_IDX_FREE_TOP])
+        self.free_slots[free_top] = slot
+        self.header[self.HEADER_IDX_FREE_TOP] = free_top + 1
+
+    def _get_slot_view(self, slot):
+        slab_id = slot // self.slots_per_slab
+        _, slab = self._get_slab(slab_id)
+        return slab[slot % self.slots_per_slab]
+
+    def _get_slab(self, slab_id):
+        if slab_id not in self.slabs:
+            slab_name = self._build_slab_memory_name(slab_id)
+            slab_size = self.slots_per_slab * self.slot_size
+            try:
+                slab_shm = SharedMemory(name=slab_name, create=True, size=slab_size)
+            except FileExistsError:
+                slab_shm = SharedMemory(name=slab_name)
+            slab = np.ndarray((self.slots_per_slab,) + self.slot_shape, dtype=self.slot_dtype, buffer=slab_shm.buf)
+            self.slabs[slab_id] = (slab_shm, slab)
+        return self.slabs[slab_id]
+
+    def _unlink(self, shm):
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            logging.info("%s does not exist" % shm.name)
+
+    def _build_index_memory_name(self):
+        return self.name + "_arena_index"
+
+    def _build_slab_memory_name(self, slab_id):
+        return self.name + "_arena_slab_" + str(slab_id)
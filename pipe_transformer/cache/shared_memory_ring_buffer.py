@@ -0,0 +1,176 @@
+# https://docs.python.org/3/library/multiprocessing.shared_memory.html
+import logging
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+
+from .cache_codec import CacheCodec
+from .cache_msg import Message
+
+"""
+Putting a Message with the [B, 197, 768] hidden feature on torch.multiprocessing.Queue pickles the tensor
+and passes its storage by a file descriptor, which fails under load with
+"received 0 items of ancdata" and "unable to open shared memory object" (see auto_cache_impl.py).
+
+SharedMemoryRingBuffer is a lock-free single-producer (trainer) / single-consumer (CacheDaemon) ring buffer.
+The trainer writes the encoded records of a batch once into a slot, and only a fixed-size slot header crosses
+the process boundary:
+
+    control     = [magic, num_slots, max_batch_size, record_size, head, tail]
+    slot_header = [num_slots, SLOT_HEADER_LEN]         msg_type, epoch, batch_idx, batch_size,
+                                                       cached_layer_id, num_frozen_layer, uids offset
+    uids        = [num_slots * max_batch_size]         sample uids of the batch in the slot
+    payload     = [num_slots, max_batch_size, record_size] uint8 (a separate segment)
+
+head is only written by the producer and tail is only written by the consumer.
+A slot is published by increasing head after its payload and header are written,
+and it is given back to the producer by increasing tail after the consumer finishes reading it.
+When the ring is full, the producer drops the batch (caching is best-effort) instead of blocking the training.
+"""
+
+
+class SharedMemoryRingBuffer:
+    RING_MAGIC = 0x52494E47
+    CONTROL_LEN = 8
+    CONTROL_IDX_MAGIC = 0
+    CONTROL_IDX_NUM_SLOTS = 1
+    CONTROL_IDX_MAX_BATCH_SIZE = 2
+    CONTROL_IDX_RECORD_SIZE = 3
+    CONTROL_IDX_HEAD = 4
+    CONTROL_IDX_TAIL = 5
+
+    SLOT_HEADER_LEN = 7
+    SLOT_IDX_MSG_TYPE = 0
+    SLOT_IDX_EPOCH = 1
+    SLOT_IDX_BATCH_INDEX = 2
+    SLOT_IDX_BATCH_SIZE = 3
+    SLOT_IDX_CACHED_NUM_FROZEN_LAYER = 4
+    SLOT_IDX_NUM_FROZEN_LAYER = 5
+    SLOT_IDX_UIDS_OFFSET = 6
+
+    def __init__(self, config, name, num_slots, max_batch_size):
+        self.config = config
+        self.name = name
+        self.num_slots = int(num_slots)
+        self.max_batch_size = int(max_batch_size)
+        self.record_size = CacheCodec(config).get_record_size()
+
+        self.is_owner = False
+        self.index_shm, self.payload_shm = self._create_or_attach()
+        self._build_view()
+
+    def put(self, msg_type, epoch, batch_idx, batch_sample_idx, hidden_feature, cached_layer_id, num_frozen_layer):
+        """
+        hidden_feature is the [B, record_size] uint8 tensor encoded by CacheCodec.
+        Return False if the ring buffer is full or the batch does not fit in a slot.
+        """
+        batch_size = len(batch_sample_idx)
+        if batch_size > self.max_batch_size:
+            logging.info("batch size %d is larger than the slot of the ring buffer (%d)" % (
+                batch_size, self.max_batch_size))
+            return False
+        head = int(self.control[self.CONTROL_IDX_HEAD])
+        if head - int(self.control[self.CONTROL_IDX_TAIL]) >= self.num_slots:
+            return False
+        slot = head % self.num_slots
+        uids_offset = slot * self.max_batch_size
+        np.copyto(self.payload[slot, 0:batch_size], hidden_feature.numpy())
+        self.uids[uids_offset:uids_offset + batch_size] = np.asarray(batch_sample_idx, dtype=np.int64)
+        self.slot_header[slot] = [msg_type, epoch, batch_idx, batch_size, cached_layer_id, num_frozen_layer,
+                                  uids_offset]
+        # publish the slot after the payload and the header are written
+        self.control[self.CONTROL_IDX_HEAD] = head + 1
+        return True
+
+    def get(self):
+        """
+        Return the Message in the oldest slot, or None if the ring buffer is empty.
+        MSG_KEY_HIDDEN_FEATURE refers to the slot without copying, so release() must be called after using it.
+        """
+        tail = int(self.control[self.CONTROL_IDX_TAIL])
+        if tail == int(self.control[self.CONTROL_IDX_HEAD]):
+            return None
+        slot = tail % self.num_slots
+        header = self.slot_header[slot].tolist()
+        batch_size = header[self.SLOT_IDX_BATCH_SIZE]
+        uids_offset = header[self.SLOT_IDX_UIDS_OFFSET]
+        msg = Message(header[self.SLOT_IDX_MSG_TYPE])
+        msg.set(Message.MSG_KEY_EPOCH, header[self.SLOT_IDX_EPOCH])
+        msg.set(Message.MSG_KEY_BATCH_INDEX, header[self.SLOT_IDX_BATCH_INDEX])
+        msg.set(Message.MSG_KEY_BATCH_SAMPLE_INDEX, self.uids[uids_offset:uids_offset + batch_size].tolist())
+        msg.set(Message.MSG_KEY_HIDDEN_FEATURE, torch.from_numpy(self.payload[slot, 0:batch_size]))
+        msg.set(Message.MSG_KEY_NUM_FROZEN_LAYER, header[self.SLOT_IDX_NUM_FROZEN_LAYER])
+        msg.set(Message.MSG_KEY_CACHED_NUM_FROZEN_LAYER, header[self.SLOT_IDX_CACHED_NUM_FROZEN_LAYER])
+        return msg
+
+    def release(self):
+        self.control[self.CONTROL_IDX_TAIL] = int(self.control[self.CONTROL_IDX_TAIL]) + 1
+
+    def get_num_used_slots(self):
+        return int(self.control[self.CONTROL_IDX_HEAD]) - int(self.control[self.CONTROL_IDX_TAIL])
+
+    def cleanup(self):
+        # the ndarray views must be released before closing the shared memory
+        del self.control, self.slot_header, self.uids, self.payload
+        self.index_shm.close()
+        self.payload_shm.close()
+        if self.is_owner:
+            for shm in [self.index_shm, self.payload_shm]:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    logging.info("%s does not exist" % shm.name)
+
+    def _get_index_len(self):
+        return self.CONTROL_LEN + self.num_slots * self.SLOT_HEADER_LEN + self.num_slots * self.max_batch_size
+
+    def _create_or_attach(self):
+        index_len = self._get_index_len()
+        index_size = index_len * np.dtype(np.int64).itemsize
+        payload_size = self.num_slots * self.max_batch_size * self.record_size
+        index_name = self.name + "_ring_index"
+        payload_name = self.name + "_ring_payload"
+        try:
+            index_shm = SharedMemory(name=index_name, create=True, size=index_size)
+            payload_shm = SharedMemory(name=payload_name, create=True, size=payload_size)
+            self.is_owner = True
+            index = np.ndarray([index_len], dtype=np.int64, buffer=index_shm.buf)
+            index[:] = 0
+            index[self.CONTROL_IDX_NUM_SLOTS] = self.num_slots
+            index[self.CONTROL_IDX_MAX_BATCH_SIZE] = self.max_batch_size
+            index[self.CONTROL_IDX_RECORD_SIZE] = self.record_size
+            # the magic number is written at last, and other processes wait for it before using the ring buffer
+            index[self.CONTROL_IDX_MAGIC] = self.RING_MAGIC
+            del index
+            logging.info("%s is created. num_slots = %d, max_batch_size = %d, record_size = %d" % (
+                index_name, self.num_slots, self.max_batch_size, self.record_size))
+        except FileExistsError:
+            index_shm = SharedMemory(name=index_name)
+            control = np.ndarray([self.CONTROL_LEN], dtype=np.int64, buffer=index_shm.buf)
+            waiting_time = 0.0
+            while control[self.CONTROL_IDX_MAGIC] != self.RING_MAGIC:
+                if waiting_time > 10.0:
+                    raise Exception("%s is not initialized!" % index_name)
+                time.sleep(0.01)
+                waiting_time += 0.01
+            if control[self.CONTROL_IDX_NUM_SLOTS] != self.num_slots or \
+                    control[self.CONTROL_IDX_MAX_BATCH_SIZE] != self.max_batch_size or \
+                    control[self.CONTROL_IDX_RECORD_SIZE] != self.record_size:
+                raise Exception("%s exists with a different size, please remove the stale /dev/shm/%s" %
+                                (index_name, index_name))
+            del control
+            payload_shm = SharedMemory(name=payload_name)
+        return index_shm, payload_shm
+
+    def _build_view(self):
+        index = np.ndarray([self._get_index_len()], dtype=np.int64, buffer=self.index_shm.buf)
+        offset = self.CONTROL_LEN
+        self.control = index[0:offset]
+        self.slot_header = index[offset:offset + self.num_slots * self.SLOT_HEADER_LEN].reshape(
+            self.num_slots, self.SLOT_HEADER_LEN)
+        offset += self.num_slots * self.SLOT_HEADER_LEN
+        self.uids = index[offset:offset + self.num_slots * self.max_batch_size]
+        self.payload = np.ndarray((self.num_slots, self.max_batch_size, self.record_size), dtype=np.uint8,
+                                  buffer=self.payload_shm.buf)
@@ -0,0 +1,274 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from pipe_transformer.cache.cache_codec import CacheCodec
+from pipe_transformer.cache.cache_msg import Message
+from pipe_transformer.cache.cache_policy import BeladyPolicy, CLOCKPolicy, LRUPolicy
+from pipe_transformer.cache.disk_memory_manager import DiskMemoryManager
+from pipe_transformer.cache.shared_memory_arena import SharedMemoryArena
+from pipe_transformer.cache.shared_memory_ring_buffer import SharedMemoryRingBuffer
+from pipe_transformer.config_args import ConfigArgs
+
+"""
+Behavioural tests of the cache layers on the CPU (no GPU and no training are needed):
+
+    python -m pytest pipe_transformer/cache/test.py
+    python -m pipe_transformer.cache.test
+"""
+
+SEQ_LEN = 4
+HIDDEN_SIZE = 8
+
+
+def build_config(cache_dtype="float32"):
+    config = ConfigArgs()
+    config.seq_len = SEQ_LEN
+    config.hidden_size = HIDDEN_SIZE
+    config.cache_dtype = cache_dtype
+    config.cache_disk_dir = tempfile.mkdtemp()
+    return config
+
+
+def build_name(name):
+    # the shared memory segments of a test must not collide with a training or another test on the node
+    return "test_%s_%d" % (name, os.getpid())
+
+
+def build_records(codec, batch_size, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return codec.encode(torch.randn([batch_size, SEQ_LEN, HIDDEN_SIZE], generator=generator))
+
+
+def test_codec_round_trip():
+    hidden_feature = torch.randn([3, SEQ_LEN, HIDDEN_SIZE])
+    for cache_dtype, atol in [("float32", 0.0), ("float16", 1e-2), ("bfloat16", 5e-2), ("int8", None)]:
+        codec = CacheCodec(build_config(cache_dtype))
+        records = codec.encode(hidden_feature)
+        assert records.dtype == torch.uint8
+        assert tuple(records.shape) == (3, codec.get_record_size())
+        assert codec.get_record_size() % CacheCodec.RECORD_ALIGNMENT == 0
+        decoded = codec.decode(records)
+        if atol is None:
+            # the error of int8 is half a step of the per-row scale
+            atol = float((hidden_feature.abs().amax(dim=-1, keepdim=True) / 127.0 / 2.0).max()) + 1e-6
+        assert torch.allclose(decoded, hidden_feature, atol=atol, rtol=0.0), cache_dtype
+        # decoding into a preallocated buffer gives the same values
+        out = torch.empty_like(hidden_feature)
+        assert torch.equal(codec.decode(records, out), decoded)
+
+
+def test_arena_free_slots():
+    config = build_config()
+    codec = CacheCodec(config)
+    arena = SharedMemoryArena(config, build_name("arena"), num_samples=10, num_slots=3)
+    try:
+        records = build_records(codec, 4, 0)
+        for sample_uid in range(3):
+            assert arena.add_tensor(sample_uid, 1, records[sample_uid])
+        assert arena.is_full()
+        # no free slot: the sample is not cached
+        assert not arena.add_tensor(3, 1, records[3])
+        assert arena.get_slot(3) == -1
+
+        # a deleted slot is reused
+        slot = arena.get_slot(1)
+        arena.delete_tensor(1)
+        assert arena.get_num_free_slots() == 1 and arena.get_layer_id(1) == -1
+        assert arena.add_tensor(3, 1, records[3])
+        assert arena.get_slot(3) == slot and arena.is_full()
+
+        # a deeper layer overwrites the slot of the sample in place
+        slot = arena.get_slot(0)
+        assert arena.add_tensor(0, 2, records[1])
+        assert arena.get_slot(0) == slot and arena.get_layer_id(0) == 2
+        assert arena.get_tensor(0, 1) is None
+        assert torch.equal(arena.get_tensor(0, 2), records[1])
+
+        # deleting another layer than the cached one does nothing
+        arena.delete_tensor(0, 1)
+        assert arena.get_layer_id(0) == 2
+
+        arena.delete_all_tensors()
+        assert arena.get_num_free_slots() == 3
+        assert all(arena.get_slot(sample_uid) == -1 for sample_uid in range(10))
+    finally:
+        arena.cleanup()
+
+
+def test_arena_get_batch_tensor():
+    config = build_config()
+    codec = CacheCodec(config)
+    arena = SharedMemoryArena(config, build_name("arena_batch"), num_samples=10, num_slots=10)
+    # small slabs, so that a batch is gathered from several slabs
+    arena.slots_per_slab = 3
+    try:
+        records = build_records(codec, 6, 1)
+        for sample_uid, layer_id in zip([0, 1, 2, 3, 4], [1, 1, 2, 1, 1]):
+            arena.add_tensor(sample_uid, layer_id, records[sample_uid])
+        batch_sample_idx = [4, 2, 5, 0, 3, 1]
+        out = np.empty([len(batch_sample_idx), codec.get_record_size()], dtype=np.uint8)
+        layer_ids = arena.get_batch_tensor(batch_sample_idx, 1, out)
+        # sample 2 is cached deeper than max_layer_id, and sample 5 is not cached
+        assert layer_ids.tolist() == [1, -1, -1, 1, 1, 1]
+        for i, sample_uid in enumerate(batch_sample_idx):
+            if layer_ids[i] >= 0:
+                assert np.array_equal(out[i], records[sample_uid].numpy())
+
+        # the daemon frees and reuses a slot while the trainer gathers the batch:
+        # the sample of the reused slot must be re-validated as a miss
+        get_slab = arena._get_slab
+
+        def get_slab_while_writing(slab_id):
+            if arena.get_slot(3) >= 0:
+                arena.delete_tensor(3)
+                arena.add_tensor(5, 1, records[5])
+            return get_slab(slab_id)
+
+        arena._get_slab = get_slab_while_writing
+        layer_ids = arena.get_batch_tensor([0, 3, 4], 1, out[0:3])
+        arena._get_slab = get_slab
+        assert layer_ids.tolist() == [1, -1, 1]
+        assert np.array_equal(out[0], records[0].numpy()) and np.array_equal(out[2], records[4].numpy())
+    finally:
+        arena.cleanup()
+
+
+def test_ring_buffer_wrap_around():
+    config = build_config()
+    codec = CacheCodec(config)
+    max_batch_size = 4
+    ring_buffer = SharedMemoryRingBuffer(config, build_name("ring"), 2, max_batch_size)
+    try:
+        assert ring_buffer.get() is None
+        # a batch larger than a slot is dropped
+        assert not ring_buffer.put(Message.MSG_TYPE_TRAINING_PROGRESS, 0, 0, list(range(5)),
+                                   build_records(codec, 5, 0), 0, 1)
+        batch_idx_to_put = 0
+        batch_idx_to_get = 0
+        # several turns around the ring, with the ring full and empty in between
+        for _ in range(5):
+            while ring_buffer.put(Message.MSG_TYPE_TRAINING_PROGRESS, 7, batch_idx_to_put,
+                                  [batch_idx_to_put * 10 + i for i in range(1 + batch_idx_to_put % max_batch_size)],
+                                  build_records(codec, 1 + batch_idx_to_put % max_batch_size, batch_idx_to_put),
+                                  0, 1):
+                batch_idx_to_put += 1
+            assert ring_buffer.get_num_used_slots() == 2
+            while True:
+                msg = ring_buffer.get()
+                if msg is None:
+                    break
+                batch_size = 1 + batch_idx_to_get % max_batch_size
+                assert msg.get(Message.MSG_KEY_BATCH_INDEX) == batch_idx_to_get
+                assert msg.get(Message.MSG_KEY_EPOCH) == 7
+                assert msg.get(Message.MSG_KEY_BATCH_SAMPLE_INDEX) == [batch_idx_to_get * 10 + i
+                                                                       for i in range(batch_size)]
+                assert torch.equal(msg.get(Message.MSG_KEY_HIDDEN_FEATURE),
+                                   build_records(codec, batch_size, batch_idx_to_get))
+                ring_buffer.release()
+                batch_idx_to_get += 1
+            assert ring_buffer.get_num_used_slots() == 0
+        assert batch_idx_to_get == batch_idx_to_put == 10
+    finally:
+        ring_buffer.cleanup()
+
+
+def test_disk_record_reuse():
+    config = build_config()
+    codec = CacheCodec(config)
+    disk_memory_mgr = DiskMemoryManager(config, build_name("disk"))
+    # small shards, so that the runs of records are split by the shards
+    disk_memory_mgr.records_per_shard = 7
+    rng = np.random.default_rng(0)
+    cached_records = dict()
+    try:
+        for r in range(100):
+            batch_sample_idx = list(range(r * 10, r * 10 + 10))
+            records = build_records(codec, 10, r)
+            disk_memory_mgr.set_batch(batch_sample_idx, 1, records)
+            for i, sample_uid in enumerate(batch_sample_idx):
+                cached_records[sample_uid] = records[i].clone()
+            num_to_delete = 10 if r % 3 else 7
+            for sample_uid in rng.choice(list(cached_records), size=num_to_delete, replace=False).tolist():
+                disk_memory_mgr.delete(sample_uid)
+                del cached_records[sample_uid]
+
+            batch_sample_idx = list(cached_records)
+            out = np.empty([len(batch_sample_idx), codec.get_record_size()], dtype=np.uint8)
+            records = disk_memory_mgr.get_batch(batch_sample_idx, out)
+            for i, sample_uid in enumerate(batch_sample_idx):
+                assert torch.equal(records[i], cached_records[sample_uid])
+        # the freed records are reused, so the shards hold the cached records and a partial run at most
+        assert disk_memory_mgr.num_records <= len(cached_records) + disk_memory_mgr.records_per_shard
+        assert disk_memory_mgr.num_records == len(cached_records) + len(disk_memory_mgr.free_records)
+    finally:
+        disk_memory_mgr.cleanup()
+
+
+def build_full_arena(config, name, sample_uids):
+    codec = CacheCodec(config)
+    arena = SharedMemoryArena(config, build_name(name), num_samples=10, num_slots=len(sample_uids))
+    records = build_records(codec, len(sample_uids), 0)
+    for i, sample_uid in enumerate(sample_uids):
+        arena.add_tensor(sample_uid, 1, records[i])
+    return arena
+
+
+def test_lru_policy():
+    config = build_config()
+    arena = build_full_arena(config, "lru", [0, 1, 2, 3])
+    try:
+        for sample_uid, access_time in zip([0, 1, 2, 3], [40, 10, 30, 20]):
+            arena.slot_access[arena.get_slot(sample_uid)] = access_time
+        admitted, victims = LRUPolicy(config).make_room(arena, [5, 6], 0)
+        assert admitted.tolist() == [True, True]
+        assert sorted(victims) == [1, 3]
+        # the samples which need a slot are not the victims
+        victims = LRUPolicy(config).select_victims(arena, 1, np.asarray([1]), 0)
+        assert victims == [3]
+    finally:
+        arena.cleanup()
+
+
+def test_clock_policy():
+    config = build_config()
+    arena = build_full_arena(config, "clock", [0, 1, 2, 3])
+    try:
+        policy = CLOCKPolicy(config)
+        # 0 and 2 are referenced, so the hand gives them a second chance
+        arena.slot_access[:] = 0
+        arena.slot_access[[arena.get_slot(0), arena.get_slot(2)]] = 1
+        assert policy.select_victims(arena, 1, np.asarray([], dtype=np.int64), 0) == [1]
+        assert arena.slot_access[arena.get_slot(0)] == 0 and arena.slot_access[arena.get_slot(2)] == 1
+        assert policy.select_victims(arena, 1, np.asarray([], dtype=np.int64), 0) == [3]
+        # the reference bit of 0 was cleared by the first sweep
+        assert policy.select_victims(arena, 1, np.asarray([], dtype=np.int64), 0) == [0]
+    finally:
+        arena.cleanup()
+
+
+def test_belady_policy():
+    config = build_config()
+    arena = build_full_arena(config, "belady", [0, 1, 2, 3])
+    try:
+        policy = BeladyPolicy(config)
+        # the sample order of the epoch: 9 is not in the order, so it is never used again by this rank
+        policy.update_sample_index([3, 0, 5, 2, 6, 1, 4, 7, 8])
+        # at position 2, the distances to the next uses are 2: 1, 1: 3, 3: 7, 0: 8 (in the next epoch),
+        # and 5: 0, 6: 2, 4: 4 for the new samples
+        admitted, victims = policy.make_room(arena, [5, 4, 6], 2)
+        # 5 and 6 replace the farthest residents (0 and 3), and 4 is used after the third farthest one (1)
+        assert admitted.tolist() == [True, False, True]
+        assert victims == [0, 3]
+        assert policy.select_victims(arena, 2, np.asarray([], dtype=np.int64), 2) == [0, 3]
+    finally:
+        arena.cleanup()
+
+
+if __name__ == "__main__":
+    for test_name, test in list(globals().items()):
+        if test_name.startswith("test_") and callable(test):
+            test()
+            print("%s: passed" % test_name)
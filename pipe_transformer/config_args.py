@@ -26,10 +26,25 @@ class ConfigArgs:
     node_rank: int = 0
     world_size: int = 16
     local_rank: int = 0
+    # frozen weights are broadcast to the newly activated processes in buckets of this size (MB)
+    frozen_weight_bucket_size_mb: int = 25
 
     # Pipe Related
     pipe_len_at_the_beginning: int = 8
     num_chunks_of_micro_batches: int = 32
+    # tune the number of micro-batches by timing the candidates on the training steps after the pipe length changes
+    # (see chunk_tuner.py), and cache the choices in a JSON table ("": not cached on the disk).
+    # opt-in: each process times its own steps, so the data parallel replicas may choose different numbers
+    b_tune_chunks: bool = False
+    chunk_tuner_cache_path: str = ""
+    chunk_tuner_num_probe_steps: int = 3
+    chunk_tuner_max_memory_ratio: float = 0.95
+    # partitions per device, assigned round-robin and interleaved by Pipe to shrink the pipeline bubble (1: disabled)
+    num_virtual_stages: int = 1
+    # run the frozen layers as fused inference-only blocks (see frozen_layer_fusion.py), compiled by torch.jit.script
+    # (opt-in: the fused QKV and the folded LayerNorm change the numerics slightly)
+    b_fuse_frozen_layers: bool = False
+    b_jit_frozen_layers: bool = False
 
     # model related
     learning_task: str = LEARNING_TASK_IMAGE_CLASSIFICATION
@@ -41,7 +56,47 @@ class ConfigArgs:
     seq_len: int = 197
     epochs: int = 10
 
+    # cache related
+    # number of upcoming batches which are prefetched from the disk to the shared memory
+    cache_sliding_window_size: int = 8
+    # directory of the memory-mapped shard files which hold the hidden features spilled from the shared memory
+    cache_disk_dir: str = "./.cache"
+    # dtype of the cached hidden features: float32, float16, bfloat16, or int8 (per-row scales)
+    cache_dtype: str = "float32"
+    # number of batches which can be in flight from the trainer to the cache daemon
+    cache_ring_buffer_size: int = 4
+    # write the missed batches into the cache in the background (write-behind, opt-in)
+    cache_async_write: bool = False
+    # number of batches which are being written in the background, the training step waits when it is exceeded
+    cache_max_in_flight_writes: int = 2
+    # bytes of the shared memory for the cached hidden features (train + test) of a node, split between its processes.
+    # 0: cache_host_memory_fraction of the available host memory when the cache is created
+    cache_host_memory_budget: int = 0
+    cache_host_memory_fraction: float = 0.5
+    # eviction policy of the shared memory tier: lru, clock, or belady (opt-in, uses the sample order of this rank)
+    cache_eviction_policy: str = "lru"
+    # one of every cache_trace_interval batches is logged by the cache (0: no tracing)
+    cache_trace_interval: int = 100
+    # append the cache statistics of each epoch to this file as a JSON line ("": no dump)
+    cache_stats_path: str = ""
+
     is_debug_mode: bool = False
 
+    # hand_crafted: the closed-form schedule of freeze_strategy_alpha;
+    # grad_norm: freeze the layers whose gradient norm converges;
+    # cost_aware: among the converged layers, freeze the number of layers which minimizes the projected training time
+    freeze_scheduler: str = "hand_crafted"
+    # cost_aware: the fewest frozen layers whose projected time is within this ratio of the fastest one are chosen
+    freeze_cost_tolerance: float = 0.05
+    # freeze and transform the pipe every freeze_step_interval training steps inside an epoch (0: only between epochs)
+    freeze_step_interval: int = 0
     freeze_strategy_alpha: float = 0.5
+    # the number of frozen layers by epoch is memory-mapped to this file, re-created by each run ("": shared memory only)
+    freeze_history_path: str = ""
+    # the gradient norms of the layers are accumulated every freeze_grad_norm_interval training steps
+    freeze_grad_norm_interval: int = 1
+    # a layer is frozen when its gradient norm changes by no more than this percentile of the unfrozen layers
+    freeze_grad_norm_percentile: float = 50
+    # record the gradient norms of the freeze decisions to this file for freeze_replay.py ("": no record)
+    freeze_grad_norm_record_path: str = ""
 
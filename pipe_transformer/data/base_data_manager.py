@@ -6,7 +6,9 @@ class BaseDataManager(ABC):
         pass
 
     @abstractmethod
-    def get_data_loader_with_node_rank(self, epoch, batch_size, node_rank, num_replicas, local_rank):
+    def get_data_loader_with_node_rank(self, epoch, batch_size, node_rank, num_replicas, local_rank,
+                                       num_consumed_samples=0):
+        """num_consumed_samples: the samples of the epoch which are trained before the data loader is re-created"""
         pass
 
     @abstractmethod
@@ -16,3 +18,9 @@ class BaseDataManager(ABC):
     @abstractmethod
     def get_test_sample_index(self, epoch):
         pass
+
+    def get_train_sample_num(self):
+        return len(self.train_dataset)
+
+    def get_test_sample_num(self):
+        return len(self.test_dataset)
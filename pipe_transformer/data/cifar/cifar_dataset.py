@@ -113,29 +113,9 @@ class CIFAR10(VisionDataset):
             self.data = self.data[starting_idx:end_idx]
             self.targets = self.targets[starting_idx:end_idx]
 
-        # for PipeTransformer: to make sure in each machine, the dataset can be divided by nproc_per_node*batch_size
-        data_len = len(self.data)
+        # for PipeTransformer: the dataset is not padded to be divided by nproc_per_node * batch_size,
+        # since the last batch of a process can be short (Pipe splits it into balanced micro-batches)
         logging.info("nproc_per_node = %d" % nproc_per_node)
-        gap = (data_len / nproc_per_node) % batch_size
-        if gap > 0:
-            subset_len = math.ceil((data_len / nproc_per_node) / batch_size)
-            even_len = int(subset_len * nproc_per_node * batch_size)
-            logging.info(even_len)
-            temp = self.data[:even_len - data_len]
-            self.data = np.concatenate((self.data, temp), axis=0)
-            temp_target = self.targets[:even_len - data_len]
-            self.targets = np.concatenate((self.targets, temp_target), axis=0)
-
-        data_len = len(self.data)
-
-        # simulate the transformation
-        worker_num_in_parallel = 1
-        while worker_num_in_parallel <= nproc_per_node:
-            if int(data_len / worker_num_in_parallel) % batch_size != 0:
-                raise Exception("could not be divided by more parallel processes")
-            else:
-                logging.info("Good. Worker_num_in_parallel = %d is dividable!" % worker_num_in_parallel)
-            worker_num_in_parallel *= 2
         logging.info("data_len = %d" % len(self.data))
         logging.info("targets len = %d" % len(self.targets))
 
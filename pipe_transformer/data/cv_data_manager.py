@@ -10,6 +10,7 @@ from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 
 from .base_data_manager import BaseDataManager
+from .resumable_sampler import ResumableDistributedSampler
 from .cifar.cifar_dataset import CIFAR10, CIFAR100
 from .imagenet.imagenet_datasets import ImageNet
 
@@ -197,9 +198,10 @@ class CVDatasetManager(BaseDataManager):
 
         return trainset, testset, output_dim
 
-    def get_data_loader_with_node_rank(self, epoch, batch_size, node_rank, num_replicas, local_rank):
-        logging.info("---node_rank = %d, num_replicas = %d, local_rank = %d --------------" % (
-        node_rank, num_replicas, local_rank))
+    def get_data_loader_with_node_rank(self, epoch, batch_size, node_rank, num_replicas, local_rank,
+                                       num_consumed_samples=0):
+        logging.info("---node_rank = %d, num_replicas = %d, local_rank = %d, num_consumed_samples = %d ---" % (
+        node_rank, num_replicas, local_rank, num_consumed_samples))
         """
         Optimization:
             Pin Memory: https://pytorch.org/docs/stable/notes/cuda.html#use-pinned-memory-buffers
@@ -208,7 +210,9 @@ class CVDatasetManager(BaseDataManager):
             "train dataset len = %d, test dataset len = %d" % (len(self.train_dataset), len(self.test_dataset)))
         if self.train_sampler is not None:
             del self.train_sampler
-        self.train_sampler = DistributedSampler(self.train_dataset, num_replicas=num_replicas, rank=local_rank)
+        # the samples consumed before a transformation in the middle of the epoch are skipped
+        self.train_sampler = ResumableDistributedSampler(self.train_dataset, num_replicas=num_replicas, rank=local_rank,
+                                                         num_consumed_samples=num_consumed_samples)
         indexes = list(iter(self.train_sampler))
         logging.info("global_rank = %d. train indexes len = %d" % (self.args.global_rank, len(indexes)))
         self.train_sample_idx_list_by_epoch[epoch] = indexes
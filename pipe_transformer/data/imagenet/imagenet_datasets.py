@@ -129,25 +129,9 @@ class ImageNet(data.Dataset):
                 end_idx = subset_len * (node_rank + 1)
             self.local_data = self.local_data[starting_idx:end_idx]
 
-        # for PipeTransformer: to make sure in each machine, the dataset can be divided by nproc_per_node*batch_size
-        data_len = len(self.local_data)
+        # for PipeTransformer: the dataset is not padded to be divided by nproc_per_node * batch_size,
+        # since the last batch of a process can be short (Pipe splits it into balanced micro-batches)
         logging.info("nproc_per_node = %d" % nproc_per_node)
-        gap = (data_len / nproc_per_node) % batch_size
-        if gap > 0:
-            subset_len = math.ceil((data_len / nproc_per_node) / batch_size)
-            even_len = int(subset_len * nproc_per_node * batch_size)
-            self.local_data += self.local_data[:even_len - data_len]
-
-        data_len = len(self.local_data)
-
-        # simulate the transformation
-        worker_num_in_parallel = 1
-        while worker_num_in_parallel <= nproc_per_node:
-            if int(data_len / worker_num_in_parallel) % batch_size != 0:
-                raise Exception("could not be divided by more parallel processes")
-            else:
-                logging.info("Good. Worker_num_in_parallel = %d is dividable!" % worker_num_in_parallel)
-            worker_num_in_parallel *= 2
         logging.info("data_len = %d" % len(self.local_data))
         logging.info("targets len = %d" % len(self.local_data))
 
@@ -0,0 +1,39 @@
+import math
+
+import torch
+from torch.utils.data import DistributedSampler
+
+"""
+When the pipe is transformed in the middle of an epoch (config.freeze_step_interval > 0),
+the number of data parallel replicas changes, and the rest of the epoch must be re-sharded.
+
+DistributedSampler shards the shuffled permutation of an epoch as indices[rank::num_replicas],
+so after every replica has trained the same number of full batches,
+the consumed samples are exactly the first num_consumed_samples indices of the permutation.
+ResumableDistributedSampler shards only the rest of the same permutation among the new replicas,
+so no sample is trained twice or skipped in the epoch.
+"""
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, num_consumed_samples=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, drop_last=False)
+        self.num_consumed_samples = min(num_consumed_samples, len(self.dataset))
+        self.num_samples = math.ceil((len(self.dataset) - self.num_consumed_samples) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        # the same permutation as DistributedSampler of this epoch
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        indices = indices[self.num_consumed_samples:]
+
+        # add extra samples to make it evenly divisible
+        padding_size = self.total_size - len(indices)
+        if padding_size > 0:
+            indices += (indices * math.ceil(padding_size / max(1, len(indices))))[:padding_size]
+        return iter(indices[self.rank:self.total_size:self.num_replicas])
@@ -8,6 +8,7 @@ import torch
 from torch.utils.data import DistributedSampler, DataLoader, TensorDataset, RandomSampler
 
 from .base_data_manager import BaseDataManager
+from .resumable_sampler import ResumableDistributedSampler
 from ..data.SST_2.classification_utils import convert_examples_to_features
 from ..data.SST_2.data_loader import RawDataLoader
 
@@ -182,14 +183,17 @@ class TCDatasetManager(BaseDataManager):
 
         return dataset
 
-    def get_data_loader_with_node_rank(self, epoch, batch_size, node_rank, num_replicas, local_rank):
-        logging.info("---node_rank = %d, num_replicas = %d, local_rank = %d --------------" % (
-            node_rank, num_replicas, local_rank))
+    def get_data_loader_with_node_rank(self, epoch, batch_size, node_rank, num_replicas, local_rank,
+                                       num_consumed_samples=0):
+        logging.info("---node_rank = %d, num_replicas = %d, local_rank = %d, num_consumed_samples = %d ---" % (
+            node_rank, num_replicas, local_rank, num_consumed_samples))
         logging.info("train dataset len = %d, test dataset len = %d" % (len(self.train_dataset), len(self.test_dataset)))
 
         if self.train_sampler is not None:
             del self.train_sampler
-        self.train_sampler = DistributedSampler(self.train_dataset, num_replicas=num_replicas, rank=local_rank)
+        # the samples consumed before a transformation in the middle of the epoch are skipped
+        self.train_sampler = ResumableDistributedSampler(self.train_dataset, num_replicas=num_replicas, rank=local_rank,
+                                                         num_consumed_samples=num_consumed_samples)
         indexes = list(iter(self.train_sampler))
         logging.info("global_rank = %d. train indexes len = %d" % (self.args.global_rank, len(indexes)))
         self.train_sample_idx_list_by_epoch[epoch] = indexes
@@ -10,7 +10,7 @@ from torch.distributed.rpc import TensorPipeRpcBackendOptions
 from torch.nn.parallel import DistributedDataParallel as DDP
 from art import *
 
-from .distributed_communicator import dist_broadcast
+from .distributed_communicator import dist_broadcast, dist_broadcast_coalesced
 from ..pipe.model_partition.pipe_model_builder import get_ddp_ignored_params_name
 
 
@@ -40,6 +40,9 @@ class AutoDataParallel:
         self.message_len = 50
 
         self.comm_broadcast_group = None
+        # src rank -> the group of src and the newly activated ranks of its pipe
+        self.frozen_weight_handoff_groups = dict()
+        self.frozen_weight_bucket_size = config.frozen_weight_bucket_size_mb * 1024 * 1024
 
         self.init_ddp()
         self.init_rpc()
@@ -174,6 +177,32 @@ class AutoDataParallel:
         self.active_process_group = dist.new_group(ranks=self.active_ranks, backend=Backend.NCCL,
                                                    timeout=timedelta(days=365))
 
+    def create_frozen_weight_handoff_groups(self, newly_added_active_ranks):
+        """
+        The ranks of an initial pipe are on the same node, and the first one is always active
+        (see update_active_ranks()), so it hands the weights of the frozen layers over to the newly activated ranks
+        of its pipe by one NCCL broadcast, instead of a checkpoint on a shared filesystem.
+        dist.new_group() must be called by all processes in the same order, including the inactive ones.
+        """
+        self.frozen_weight_handoff_groups = dict()
+        for src in range(0, self.world_size, self.initial_pipe_len):
+            new_ranks = sorted([rank for rank in newly_added_active_ranks if src < rank < src + self.initial_pipe_len])
+            if len(new_ranks) == 0:
+                continue
+            handoff_ranks = [src] + new_ranks
+            group = dist.new_group(ranks=handoff_ranks, backend=Backend.NCCL, timeout=timedelta(days=365))
+            if self.global_rank in handoff_ranks:
+                self.frozen_weight_handoff_groups[src] = group
+        logging.info("local_rank = %d, global_rank = %d - frozen weight handoff from %s" % (
+            self.local_rank, self.global_rank, str(list(self.frozen_weight_handoff_groups.keys()))))
+
+    def handoff_frozen_weights(self, frozen_model):
+        if frozen_model is None:
+            return
+        for src, group in self.frozen_weight_handoff_groups.items():
+            tensors = list(frozen_model.parameters()) + list(frozen_model.buffers())
+            dist_broadcast_coalesced(tensors, src, group, self.frozen_weight_bucket_size)
+
     def create_broadcast_process_group(self):
         logging.info("create_broadcast_process_group - auto_pipe.get_active_ranks() = " + str(self.active_ranks))
         logging.info(
@@ -247,10 +276,7 @@ class AutoDataParallel:
         if self.compressed_pipe_len != pipe_len:
             self.compressed_pipe_len = pipe_len
             self.update_active_ranks()
-
-            # save model weights for newly active processes
-            if self.get_local_rank() == 0:
-                torch.save(frozen_model.state_dict(), self._build_path_for_frozen_layer_model_state(num_frozen_layers))
+            newly_added_active_ranks = list(self.newly_added_active_ranks)
 
             # broadcast control messages
             logging.info("####### broad cast control message (num_frozen_layers, pipe_len) to all processes #######")
@@ -270,9 +296,13 @@ class AutoDataParallel:
                 dist_broadcast(broad_cast_msg, 0, self.comm_broadcast_group)
 
             self.create_active_process_group()
+            self.create_frozen_weight_handoff_groups(newly_added_active_ranks)
             self.clear_memory()
             is_pipe_len_changed = True
         pipe_model = self.generate_ddp_model(pipe_model, pipe_len, num_frozen_layers)
+        if is_pipe_len_changed:
+            # the newly active processes receive the weights of the frozen layers after the DDP is created
+            self.handoff_frozen_weights(frozen_model)
         return frozen_model, pipe_model, is_pipe_len_changed, is_frozen_layer_changed
 
     def _inactive_process_impl(self, auto_pipe, auto_freeze):
@@ -291,6 +321,7 @@ class AutoDataParallel:
         auto_freeze.update_status(num_frozen_layers, last_grad_norm_by_layer)
 
         self.create_active_process_group()
+        self.create_frozen_weight_handoff_groups(newly_added_active_ranks)
         self.clear_memory()
 
         if self.global_rank in newly_added_active_ranks:
@@ -299,8 +330,8 @@ class AutoDataParallel:
             frozen_model, pipe_model, pipe_len = auto_pipe.transform(num_frozen_layers)
             pipe_model = self.generate_ddp_model(pipe_model, pipe_len, num_frozen_layers)
 
-            # load model state for frozen_layer
-            frozen_model.load_state_dict(torch.load(self._build_path_for_frozen_layer_model_state(num_frozen_layers)))
+            # receive the weights of the frozen layers from the first rank of the pipe
+            self.handoff_frozen_weights(frozen_model)
         else:
             frozen_model, pipe_model, is_pipe_len_changed, is_frozen_layer_changed = self._inactive_process_impl(auto_pipe, auto_freeze)
         return frozen_model, pipe_model, is_pipe_len_changed, is_frozen_layer_changed
@@ -313,25 +344,27 @@ class AutoDataParallel:
         broad_cast_msg[1] = float(pipe_len)
         broad_cast_msg[2] = float(max_parameter_per_gpu_at_beginning)
         broad_cast_msg[3] = float(freeze_point['epoch'])
-        broad_cast_msg[4] = float(len(self.newly_added_active_ranks))
+        # the newly added ranks start from the same sample of the epoch when transformed in the middle of it
+        broad_cast_msg[4] = float(freeze_point.get('num_consumed_samples', 0))
+        broad_cast_msg[5] = float(len(self.newly_added_active_ranks))
         for idx, new_active_rank in enumerate(self.newly_added_active_ranks):
-            broad_cast_msg[idx + 5] = float(new_active_rank)
+            broad_cast_msg[idx + 6] = float(new_active_rank)
         if last_grad_norm_by_layer is not None:
             for layer_idx in last_grad_norm_by_layer.keys():
-                broad_cast_msg[layer_idx + 5 + len(self.newly_added_active_ranks)] = last_grad_norm_by_layer[layer_idx]
+                broad_cast_msg[layer_idx + 6 + len(self.newly_added_active_ranks)] = last_grad_norm_by_layer[layer_idx]
         else:
-            broad_cast_msg[5 + len(self.newly_added_active_ranks)] = -1
+            broad_cast_msg[6 + len(self.newly_added_active_ranks)] = -1
 
         art = text2art("PipeTransformer!")
         logging.critical("\n%s" % art)
         logging.critical("\n################################ Congratulations! To train faster, "
                      "PipeTransformer has automatically transformed to:\n"
-                     "################################ Epoch: %d \n"
+                     "################################ Epoch: %d (consumed samples: %d) \n"
                      "################################ Number of frozen layers: %d \n"
                      "################################ Pipe length: %d/%d \n"
                      "################################ Newly added ranks: %s \n"
-                     % (freeze_point['epoch'], num_frozen_layers, pipe_len,
-                        self.initial_pipe_len, str(self.newly_added_active_ranks)))
+                     % (freeze_point['epoch'], freeze_point.get('num_consumed_samples', 0), num_frozen_layers,
+                        pipe_len, self.initial_pipe_len, str(self.newly_added_active_ranks)))
 
         return broad_cast_msg
 
@@ -351,18 +384,19 @@ class AutoDataParallel:
         epoch_start = int(frozen_message[3])
         freeze_point = dict()
         freeze_point['epoch'] = epoch_start
+        freeze_point['num_consumed_samples'] = int(frozen_message[4])
         self.freeze_point = freeze_point
 
-        size_of_newly_added_active_ranks = int(frozen_message[4])
+        size_of_newly_added_active_ranks = int(frozen_message[5])
         newly_added_active_ranks = []
         for i in range(size_of_newly_added_active_ranks):
-            newly_added_active_ranks.append(int(frozen_message[i + 5]))
+            newly_added_active_ranks.append(int(frozen_message[i + 6]))
         logging.info("newly_added_active_ranks = " + str(newly_added_active_ranks))
 
-        if frozen_message[5 + size_of_newly_added_active_ranks] != -1:
+        if frozen_message[6 + size_of_newly_added_active_ranks] != -1:
             last_grad_norm_by_layer = dict()
             for layer_idx in range(self.config.num_layer):
-                last_grad_norm_by_layer[layer_idx] = float(frozen_message[layer_idx + 5 + size_of_newly_added_active_ranks])
+                last_grad_norm_by_layer[layer_idx] = float(frozen_message[layer_idx + 6 + size_of_newly_added_active_ranks])
             logging.info("last_grad_norm_by_layer = " + str(last_grad_norm_by_layer))
         else:
             last_grad_norm_by_layer = None
@@ -391,6 +425,3 @@ class AutoDataParallel:
 
     def _diff_list(self, li1, li2):
         return (list(list(set(li1) - set(li2)) + list(set(li2) - set(li1))))
-
-    def _build_path_for_frozen_layer_model_state(self, number_frozen_layers):
-        return "./checkpoint_frozen_layers.pth_num_frozen_layers_%d.pth" % number_frozen_layers
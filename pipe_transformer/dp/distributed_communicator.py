@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 
 def dist_broadcast(object_list, src, group):
@@ -9,6 +10,35 @@ def dist_broadcast(object_list, src, group):
     return object_list
 
 
+def dist_broadcast_coalesced(tensors, src, group, bucket_size):
+    """
+    Broadcasts the tensors in place with one collective per bucket:
+    the tensors of the same device and dtype are flattened into buckets of up to bucket_size bytes.
+    """
+    is_src = dist.get_rank() == src
+    with torch.no_grad():
+        for bucket in _bucket_tensors(tensors, bucket_size):
+            flat_tensor = _flatten_dense_tensors(bucket)
+            dist.broadcast(flat_tensor, src, group=group)
+            if not is_src:
+                for tensor, synced_tensor in zip(bucket, _unflatten_dense_tensors(flat_tensor, bucket)):
+                    tensor.copy_(synced_tensor)
+
+
+def _bucket_tensors(tensors, bucket_size):
+    bucket, bucket_bytes = [], 0
+    for tensor in tensors:
+        tensor_bytes = tensor.numel() * tensor.element_size()
+        if len(bucket) > 0 and (bucket_bytes + tensor_bytes > bucket_size or tensor.device != bucket[0].device
+                                or tensor.dtype != bucket[0].dtype):
+            yield bucket
+            bucket, bucket_bytes = [], 0
+        bucket.append(tensor)
+        bucket_bytes += tensor_bytes
+    if len(bucket) > 0:
+        yield bucket
+
+
 def dist_send(dest, msg, device_id):
     """Broadcasts a given object to all parties."""
     tensor_obj = torch.from_numpy(np.array(msg))
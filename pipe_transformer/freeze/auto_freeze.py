@@ -5,7 +5,9 @@ import math
 import numpy as np
 import torch
 
-from .shared_memory_manager_int_value import SharedMemoryManagerIntValue
+from pipe_transformer.pipe.model_partition.layer_registry import resolve_layers
+from .freeze_history import FreezeHistory
+from .grad_norm_record import GradNormRecorder
 
 
 class AutoFreeze:
@@ -13,22 +15,37 @@ class AutoFreeze:
         self.model = None
         self.num_freeze_layers = 0
         self.is_freeze = config.b_freeze
-        self.is_hand_crafted = True
+        self.freeze_scheduler = config.freeze_scheduler
+        if self.freeze_scheduler not in ["hand_crafted", "grad_norm", "cost_aware"]:
+            raise Exception("no such freeze scheduler: %s" % self.freeze_scheduler)
+        self.is_hand_crafted = self.freeze_scheduler == "hand_crafted"
+        # set by set_cost_model() for the cost_aware scheduler, see freeze_cost_model.py
+        self.cost_model = None
 
         self.is_grad_norm_analysis = False
 
-        self.num_layer = 12
-        self.grad_accumulated_by_layer = dict()
-        for layer_idx in range(self.num_layer):
-            self.grad_accumulated_by_layer[layer_idx] = dict()
+        # the blocks of the model are resolved by the layer registry when the gradients are accumulated
+        self.num_layer = config.num_layer
+        # running L1 norm of the gradients by layer, see accumulate()
+        self.grad_norm_interval = max(1, config.freeze_grad_norm_interval)
+        self.num_accumulated_steps = 0
+        # the number of steps whose norms are in the accumulators
+        self.num_grad_norm_samples = 0
+        # device -> (parameters on the device, layer index of each parameter, [num_layer] accumulator on the device)
+        self.grad_norm_accumulator_by_device = None
         self.is_grad_accumulated_by_layer_updated = False
 
         self.freeze_interval = 1
 
         self.last_grad_norm_by_layer = None
-        self.percentile = 50
+        self.percentile = config.freeze_grad_norm_percentile
+        # the gradient norms of the freeze decisions are recorded for freeze_replay.py (only by the global rank 0)
+        self.grad_norm_recorder = None
+        if config.freeze_grad_norm_record_path and config.global_rank == 0:
+            self.grad_norm_recorder = GradNormRecorder(config.freeze_grad_norm_record_path)
 
-        self.shared_memory_mgr_frozen_layer_num = SharedMemoryManagerIntValue("frozen_layer_num")
+        # the number of frozen layers by epoch, shared by the processes of the node
+        self.freeze_history = FreezeHistory(config, "frozen_layer_num")
 
         self.freeze_strategy_alpha = config.freeze_strategy_alpha
 
@@ -55,12 +72,22 @@ class AutoFreeze:
     def enable(self, on):
         self.is_freeze = on
 
+    def set_cost_model(self, cost_model):
+        self.cost_model = cost_model
+
+    def record_epoch_time(self, epoch_time):
+        if self.cost_model is not None:
+            self.cost_model.record_epoch_time(self.num_freeze_layers, epoch_time)
+
+    def record_pipe_profile(self, config, auto_pipe):
+        if self.grad_norm_recorder is not None:
+            self.grad_norm_recorder.write_pipe_profile(config, auto_pipe)
+
     def is_freeze_open(self):
         return self.is_freeze
 
     def cleanup(self):
-        self.shared_memory_mgr_frozen_layer_num.cleanup()
-        pass
+        self.freeze_history.cleanup()
 
     def calculate_frozen_layer_num(self, layer_num, alpha, epoch):
         second_term = 0.0
@@ -73,26 +100,22 @@ class AutoFreeze:
 
     # def get_hand_crafted_frozen_layers_by_epoch(self, epoch):
     #     num_freeze_layers = 0
-    #     if not self.shared_memory_mgr_frozen_layer_num.is_exist(epoch):
-    #         self.shared_memory_mgr_frozen_layer_num.add_int_value(epoch, num_freeze_layers)
+    #     self.freeze_history.record(epoch, num_freeze_layers)
     #     return num_freeze_layers
 
     # def get_hand_crafted_frozen_layers_by_epoch(self, epoch):
     #     num_freeze_layers = 6
-    #     if not self.shared_memory_mgr_frozen_layer_num.is_exist(epoch):
-    #         self.shared_memory_mgr_frozen_layer_num.add_int_value(epoch, num_freeze_layers)
+    #     self.freeze_history.record(epoch, num_freeze_layers)
     #     return num_freeze_layers
 
     # def get_hand_crafted_frozen_layers_by_epoch(self, epoch):
     #     num_freeze_layers = epoch
-    #     if not self.shared_memory_mgr_frozen_layer_num.is_exist(epoch):
-    #         self.shared_memory_mgr_frozen_layer_num.add_int_value(epoch, num_freeze_layers)
+    #     self.freeze_history.record(epoch, num_freeze_layers)
     #     return num_freeze_layers
 
     def get_frozen_layer_num_by_epoch(self, epoch):
         num_freeze_layers = self.frozen_layer_num_dict[epoch]
-        if not self.shared_memory_mgr_frozen_layer_num.is_exist(epoch):
-            self.shared_memory_mgr_frozen_layer_num.add_int_value(epoch, num_freeze_layers)
+        self.freeze_history.record(epoch, num_freeze_layers)
         return num_freeze_layers
 
     # def get_hand_crafted_frozen_layers_by_epoch(self, epoch):
@@ -120,29 +143,84 @@ class AutoFreeze:
     #         num_freeze_layers = epoch
     #     else:
     #         raise Exception("no such strategy")
-    #     if not self.shared_memory_mgr_frozen_layer_num.is_exist(epoch):
-    #         self.shared_memory_mgr_frozen_layer_num.add_int_value(epoch, num_freeze_layers)
+    #     self.freeze_history.record(epoch, num_freeze_layers)
     #     return num_freeze_layers
 
     def get_num_of_frozen_layer(self, epoch):
-        return self.shared_memory_mgr_frozen_layer_num.get_int_value(epoch)
+        return self.freeze_history.get(epoch)
 
     def accumulate(self, model):
-        for layer_idx in range(self.num_layer):
-            for name, param in model.transformer.encoder.layer[layer_idx].named_parameters():
-                if param.grad is not None:
-                    if name not in self.grad_accumulated_by_layer.keys():
-                        self.grad_accumulated_by_layer[layer_idx][name] = param.grad
-                    else:
-                        self.grad_accumulated_by_layer[layer_idx][name] += param.grad
-                    # logging.info("layer_idx = %d, name = %s" % (layer_idx, name))
+        """
+        Add the L1 norms of the current gradients (every grad_norm_interval steps) to the per-layer accumulators,
+        which stay on the devices of the gradients. On each device, the norms of all the parameters are computed by
+        one torch._foreach_norm call and summed by layer with one index_add_, so no gradient is copied or kept alive,
+        and only num_layer scalars per device are copied to the host in freeze().
+        """
+        self.num_accumulated_steps += 1
+        if self.num_accumulated_steps % self.grad_norm_interval != 0:
+            return
+        if self.grad_norm_accumulator_by_device is None or self._is_param_moved():
+            self._build_grad_norm_accumulator(model)
+        for device, (params, layer_index, grad_norm_by_layer) in self.grad_norm_accumulator_by_device.items():
+            grads = [param.grad for param in params if param.grad is not None]
+            if len(grads) == 0:
+                continue
+            if len(grads) < len(params):
+                has_grad = torch.tensor([param.grad is not None for param in params], device=device)
+                grad_layer_index = layer_index[has_grad]
+            else:
+                grad_layer_index = layer_index
+            grad_norm = torch.stack(torch._foreach_norm(grads, 1)).float()
+            grad_norm_by_layer.index_add_(0, grad_layer_index, grad_norm)
+        self.num_grad_norm_samples += 1
         self.is_grad_accumulated_by_layer_updated = True
 
-    def freeze(self, epoch):
+    def _build_grad_norm_accumulator(self, model):
+        layers = resolve_layers(model)
+        if layers.get_num_layer() != self.num_layer:
+            raise Exception("the model has %d layers, but config.num_layer = %d" % (layers.get_num_layer(),
+                                                                                   self.num_layer))
+        grad_norm_accumulator_by_device = dict()
+        for layer_idx in range(self.num_layer):
+            for param in layers.blocks[layer_idx].parameters():
+                if not param.requires_grad:
+                    continue
+                if param.device not in grad_norm_accumulator_by_device:
+                    grad_norm_accumulator_by_device[param.device] = ([], [])
+                params, layer_index = grad_norm_accumulator_by_device[param.device]
+                params.append(param)
+                layer_index.append(layer_idx)
+        # the accumulated norms of a rebuilt model are kept
+        grad_norm_by_layer = self._get_accumulated_grad_norm_by_layer() \
+            if self.grad_norm_accumulator_by_device is not None else torch.zeros(self.num_layer)
+        self.grad_norm_accumulator_by_device = dict()
+        for i, (device, (params, layer_index)) in enumerate(grad_norm_accumulator_by_device.items()):
+            self.grad_norm_accumulator_by_device[device] = (
+                params, torch.tensor(layer_index, dtype=torch.long, device=device),
+                grad_norm_by_layer.to(device) if i == 0 else torch.zeros(self.num_layer, device=device))
+
+    def _is_param_moved(self):
+        # the parameters are moved when the pipe is re-partitioned
+        for device, (params, _, _) in self.grad_norm_accumulator_by_device.items():
+            if params[0].device != device:
+                return True
+        return False
+
+    def _get_accumulated_grad_norm_by_layer(self):
+        grad_norm_by_layer = torch.zeros(self.num_layer)
+        for _, _, grad_norm_by_layer_on_device in self.grad_norm_accumulator_by_device.values():
+            grad_norm_by_layer += grad_norm_by_layer_on_device.cpu()
+        return grad_norm_by_layer
+
+    def freeze(self, epoch, num_steps=0):
+        """
+        num_steps = 0: called at the beginning of the epoch;
+        num_steps > 0: called in the middle of the epoch (every config.freeze_step_interval steps).
+        """
         logging.info("-----------------------------%s" % (id(self)))
         if self.is_hand_crafted:
             return self.get_frozen_layer_num_by_epoch(epoch)
-        if epoch == 0:
+        if epoch == 0 and num_steps == 0:
             return 0
 
         if not self.is_grad_accumulated_by_layer_updated:
@@ -150,59 +228,71 @@ class AutoFreeze:
         if self.num_freeze_layers == self.num_layer:
             return self.num_freeze_layers
 
-        if (epoch + 1) % self.freeze_interval == 0:
-            # Calculate layer-wise gradient changing ratio
-            grad_norm_by_layer = dict()
-            for i in range(self.num_layer):
-                grad_norm_by_layer[i] = 0
-
-            for layer_idx in self.grad_accumulated_by_layer.keys():
-                for name in self.grad_accumulated_by_layer[layer_idx].keys():
-                    grad = self.grad_accumulated_by_layer[layer_idx][name]
-                    grad_norm_by_layer[layer_idx] += torch.norm(grad.cpu().detach(), p=1).item()
+        # freeze_interval counts the epochs, and the freezing in an epoch is scheduled by the caller
+        if num_steps > 0 or (epoch + 1) % self.freeze_interval == 0:
+            # Calculate layer-wise gradient changing ratio,
+            # averaged over the steps since the intervals in and between epochs have different lengths
+            grad_norm_by_layer = self._get_accumulated_grad_norm_by_layer() / max(1, self.num_grad_norm_samples)
+            grad_norm_by_layer = dict(enumerate(grad_norm_by_layer.tolist()))
 
             # Clear gradient accumulator
-            for layer_idx in self.grad_accumulated_by_layer.keys():
-                for name in self.grad_accumulated_by_layer[layer_idx].keys():
-                    params = self.grad_accumulated_by_layer[layer_idx][name]
-                    self.grad_accumulated_by_layer[layer_idx][name] = torch.zeros(params.shape)
+            self.grad_norm_accumulator_by_device = None
+            self.num_grad_norm_samples = 0
             self.is_grad_accumulated_by_layer_updated = False
 
             logging.info("epoch = %d, grad_norm_by_layer = %s" % (epoch, str(grad_norm_by_layer)))
-            frozen_layer_idx = -1
-            if self.last_grad_norm_by_layer is None:
-                # Set gradient dict to be compared with for the first time
-                self.last_grad_norm_by_layer = grad_norm_by_layer
+            if self.grad_norm_recorder is not None:
+                self.grad_norm_recorder.append(epoch, num_steps, self.num_freeze_layers,
+                                               list(grad_norm_by_layer.values()))
+            return self.freeze_by_grad_norm(epoch, grad_norm_by_layer)
+        logging.info("epoch = %d, num_frozen_layer = %s" % (epoch, str(self.num_freeze_layers)))
+        return self.num_freeze_layers
+
+    def freeze_by_grad_norm(self, epoch, grad_norm_by_layer):
+        """
+        The freeze decision on the gradient norms by layer averaged over the steps since the last decision.
+        It is also called by freeze_replay.py with the recorded gradient norms.
+        """
+        frozen_layer_idx = -1
+        if self.last_grad_norm_by_layer is None:
+            # Set gradient dict to be compared with for the first time
+            self.last_grad_norm_by_layer = grad_norm_by_layer
+        else:
+            grad_norm_diff = dict()
+            # Calculate gradient changing threshold
+            for key in grad_norm_by_layer.keys():
+                if grad_norm_by_layer[key] > 0:
+                    grad_norm_diff[key] = abs(self.last_grad_norm_by_layer[key] - grad_norm_by_layer[key]) / \
+                                          self.last_grad_norm_by_layer[key]
+                else:
+                    grad_norm_diff[key] = 0
+
+            logging.info(grad_norm_diff)
+            unfrozen_list = list(grad_norm_diff.values())[self.num_freeze_layers:]
+            logging.info(unfrozen_list)
+            logging.info("epoch = %d, grad_norm_diff (unfrozen_list) = %s" % (epoch, str(unfrozen_list)))
+            grad_norm_diff_percentile = np.percentile(unfrozen_list, self.percentile)
+            logging.info("grad_norm_diff_percentile = " + str(grad_norm_diff_percentile))
+
+            # Find out the first layer with ratio ge to the median value
+            for layer_idx in grad_norm_diff.keys():
+                if grad_norm_diff[layer_idx] >= grad_norm_diff_percentile:
+                    frozen_layer_idx = layer_idx
+                    break
+
+            self.last_grad_norm_by_layer = grad_norm_by_layer
+        logging.info("epoch = %d, frozen_layer_idx = %s" % (epoch, str(frozen_layer_idx)))
+        # only analyze the grad norm
+        if self.is_grad_norm_analysis:
+            return 0
+        if frozen_layer_idx != -1:
+            if self.freeze_scheduler == "cost_aware" and self.cost_model is not None:
+                # the converged layers bound the freezing, and the cost model decides how many of them to freeze
+                self.num_freeze_layers = self.cost_model.get_best_num_frozen_layer(
+                    epoch, self.num_freeze_layers, max(self.num_freeze_layers, frozen_layer_idx + 1))
             else:
-                grad_norm_diff = dict()
-                # Calculate gradient changing threshold
-                for key in grad_norm_by_layer.keys():
-                    if grad_norm_by_layer[key] > 0:
-                        grad_norm_diff[key] = abs(self.last_grad_norm_by_layer[key] - grad_norm_by_layer[key]) / \
-                                              self.last_grad_norm_by_layer[key]
-                    else:
-                        grad_norm_diff[key] = 0
-
-                logging.info(grad_norm_diff)
-                unfrozen_list = list(grad_norm_diff.values())[self.num_freeze_layers:]
-                logging.info(unfrozen_list)
-                logging.info("epoch = %d, grad_norm_diff (unfrozen_list) = %s" % (epoch, str(unfrozen_list)))
-                grad_norm_diff_percentile = np.percentile(unfrozen_list, self.percentile)
-                logging.info("grad_norm_diff_percentile = " + str(grad_norm_diff_percentile))
-
-                # Find out the first layer with ratio ge to the median value
-                for layer_idx in grad_norm_diff.keys():
-                    if grad_norm_diff[layer_idx] >= grad_norm_diff_percentile:
-                        frozen_layer_idx = layer_idx
-                        break
-
-                self.last_grad_norm_by_layer = grad_norm_by_layer
-            logging.info("epoch = %d, frozen_layer_idx = %s" % (epoch, str(frozen_layer_idx)))
-            # only analyze the grad norm
-            if self.is_grad_norm_analysis:
-                return 0
-            if frozen_layer_idx != -1:
-                self.num_freeze_layers = frozen_layer_idx + 1
-                self.shared_memory_mgr_frozen_layer_num.add_int_value(epoch, self.num_freeze_layers)
+                # the frozen layers are never unfrozen
+                self.num_freeze_layers = max(self.num_freeze_layers, frozen_layer_idx + 1)
+            self.freeze_history.record(epoch, self.num_freeze_layers)
         logging.info("epoch = %d, num_frozen_layer = %s" % (epoch, str(self.num_freeze_layers)))
         return self.num_freeze_layers
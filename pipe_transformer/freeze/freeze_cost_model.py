@@ -0,0 +1,104 @@
+import logging
+
+from pipe_transformer.pipe.load_balance import generate_parameter_size_wise_balance
+
+"""
+Cost-aware freeze scheduler (config.freeze_scheduler = "cost_aware")
+
+Freezing one more layer does not always make the training faster by the same amount:
+when it crosses a pipe compression threshold (see AutoElasticPipe.get_compressed_pipe_len()), the pipe is halved and
+the number of data parallel replicas is doubled, which is worth much more than the layers before the next threshold.
+FreezeCostModel projects the epoch time of each candidate number of frozen layers, and the scheduler freezes
+the fewest layers whose projected time is within freeze_cost_tolerance of the fastest candidate.
+The candidates are bounded by the convergence guard of the gradient signal (AutoFreeze.freeze()),
+so a layer whose gradient norm is still changing is never frozen for speed.
+
+Cost of an epoch with k frozen layers and pipe length P (relative, per GPU of the node):
+
+    epoch_time(k) ~ P / P_0 * ((chunks + P - 1) / chunks * max_stage_cost(k, P) + frozen_forward_cost(k))
+
+    max_stage_cost(k, P)  - forward + backward cost of the slowest stage of the balanced partition
+    (chunks + P - 1) / chunks - the pipeline bubble of GPipe
+    P / P_0               - with a shorter pipe, the same GPUs run more data parallel replicas
+    frozen_forward_cost(k) - forward only, and only recomputed on cache misses when AutoCache is enabled
+
+The cost of a sub layer is its forward + backward time per sample measured by AutoElasticPipe when no layer is frozen
+(see sub_layer_profiler.py), and a stage costs the sum of its sub layers in the partition by parameter size
+(the partition which AutoElasticPipe builds). Before the sub layers are profiled (or in freeze_replay.py),
+the cost of a sub layer is proportional to its parameter size, with the backward twice the forward.
+The relative cost is scaled to seconds by the measured time of the last epoch (record_epoch_time()).
+"""
+
+
+class FreezeCostModel:
+    # backward costs about twice the forward (only used before the sub layers are profiled)
+    BACKWARD_FORWARD_RATIO = 2.0
+
+    def __init__(self, config, auto_pipe):
+        self.config = config
+        self.auto_pipe = auto_pipe
+        self.tolerance = config.freeze_cost_tolerance
+        self.last_epoch_time = None
+        self.last_epoch_num_frozen_layer = None
+
+    def record_epoch_time(self, num_frozen_layer, epoch_time):
+        self.last_epoch_num_frozen_layer = num_frozen_layer
+        self.last_epoch_time = epoch_time
+
+    def get_best_num_frozen_layer(self, epoch, num_frozen_layer, max_num_frozen_layer):
+        """
+        The number of frozen layers in [num_frozen_layer, max_num_frozen_layer] which minimizes the projected
+        remaining time. Return num_frozen_layer if the costs cannot be estimated yet.
+        """
+        if max_num_frozen_layer <= num_frozen_layer:
+            return num_frozen_layer
+        if self.auto_pipe.get_pipe_model_params_size_list(0) is None:
+            logging.info("the pipe is not profiled, no cost-aware freezing")
+            return num_frozen_layer
+
+        num_remaining_epoch = max(1, self.config.epochs - epoch)
+        candidates = list(range(num_frozen_layer, max_num_frozen_layer + 1))
+        remaining_time = [num_remaining_epoch * self.estimate_epoch_time(k, num_remaining_epoch) for k in candidates]
+        fastest_time = min(remaining_time)
+        best_num_frozen_layer = num_frozen_layer
+        for k, t in zip(candidates, remaining_time):
+            # the fewest frozen layers are preferred for the accuracy
+            if t <= fastest_time * (1.0 + self.tolerance):
+                best_num_frozen_layer = k
+                break
+        logging.info("epoch = %d, projected remaining time by num_frozen_layer = %s, best = %d" % (
+            epoch, str(dict(zip(candidates, remaining_time))), best_num_frozen_layer))
+        return best_num_frozen_layer
+
+    def estimate_epoch_time(self, num_frozen_layer, num_remaining_epoch=1):
+        relative_time = self._estimate_relative_epoch_time(num_frozen_layer, num_remaining_epoch)
+        if self.last_epoch_time is None:
+            return relative_time
+        last_relative_time = self._estimate_relative_epoch_time(self.last_epoch_num_frozen_layer, num_remaining_epoch)
+        return relative_time * self.last_epoch_time / last_relative_time
+
+    def _estimate_relative_epoch_time(self, num_frozen_layer, num_remaining_epoch):
+        pipe_len = self.auto_pipe.estimate_pipe_len_after_freezing(num_frozen_layer)
+        num_chunks = self.auto_pipe.get_num_chunks(pipe_len)
+        stage_layer_num, stage_params_size, _ = generate_parameter_size_wise_balance(
+            pipe_len, self.auto_pipe.get_pipe_model_params_size_list(num_frozen_layer), 0)
+        time_list = self.auto_pipe.get_pipe_model_time_list(num_frozen_layer)
+        if time_list is None:
+            max_stage_cost = max(stage_params_size.values()) * (1.0 + self.BACKWARD_FORWARD_RATIO)
+            frozen_time = self.auto_pipe.get_frozen_params_size(num_frozen_layer)
+        else:
+            max_stage_cost = max(self._get_stage_costs(time_list, stage_layer_num))
+            frozen_time = self.auto_pipe.get_frozen_forward_time(num_frozen_layer)
+        pipe_time = (num_chunks + pipe_len - 1) / num_chunks * max_stage_cost
+        if self.config.b_cache and num_frozen_layer > 0:
+            # the frozen layers are computed in the first epoch, and then read from the cache
+            frozen_time /= num_remaining_epoch
+        return pipe_len / self.config.pipe_len_at_the_beginning * (pipe_time + frozen_time)
+
+    def _get_stage_costs(self, time_list, stage_layer_num):
+        stage_costs = []
+        start = 0
+        for stage_id in sorted(stage_layer_num.keys()):
+            stage_costs.append(sum(time_list[start:start + stage_layer_num[stage_id]]))
+            start += stage_layer_num[stage_id]
+        return stage_costs
@@ -0,0 +1,85 @@
+# https://docs.python.org/3/library/multiprocessing.shared_memory.html
+import logging
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch.distributed as dist
+
+"""
+The number of frozen layers by epoch.
+
+AutoCache.forward_with_cache() reads the number of frozen layers of the last epoch on every forward,
+so the history is a single fixed-size int32 array indexed by epoch, and a read is a plain array load.
+The processes of a node share one POSIX shared memory segment, or, when config.freeze_history_path is set,
+a memory-mapped file (which can be inspected during the training).
+The local rank 0 creates it, and the other processes attach to it after a barrier of the default process group.
+The history is not restored after a restart: the local rank 0 re-creates the file, and it unlinks the segment
+left by a crashed run before creating a new one (the segment is also named by the master port, so two jobs on the
+same node do not share it).
+
+The frozen layers are never unfrozen, so record(epoch, n) also fills the later epochs,
+and the value of an epoch without a freeze decision is the number frozen by the last decision before it.
+"""
+
+
+class FreezeHistory:
+    def __init__(self, config, name):
+        self.name = name + "_" + str(config.master_port)
+        self.path = config.freeze_history_path
+        self.num_epochs = max(1, config.epochs)
+        self.shm = None
+        # without a process group (freeze_replay.py), the only process creates the history
+        self.is_owner = not dist.is_initialized() or config.local_rank == 0
+        if self.is_owner:
+            self._create()
+        if dist.is_initialized():
+            dist.barrier()
+        if not self.is_owner:
+            self._attach()
+
+    def _create(self):
+        if self.path:
+            self.values = np.memmap(self.path, dtype=np.int32, mode="w+", shape=(self.num_epochs,))
+            self.values[:] = 0
+            self.values.flush()
+            return
+        try:
+            stale_shm = SharedMemory(name=self.name)
+            logging.info("%s is left by a previous run, unlink it" % self.name)
+            stale_shm.close()
+            stale_shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = SharedMemory(name=self.name, create=True, size=self.num_epochs * np.dtype(np.int32).itemsize)
+        self.values = np.ndarray([self.num_epochs], dtype=np.int32, buffer=self.shm.buf)
+        self.values[:] = 0
+
+    def _attach(self):
+        if self.path:
+            self.values = np.memmap(self.path, dtype=np.int32, mode="r+", shape=(self.num_epochs,))
+            return
+        self.shm = SharedMemory(name=self.name)
+        self.values = np.ndarray([self.num_epochs], dtype=np.int32, buffer=self.shm.buf)
+    def record(self, epoch, num_frozen_layer):
+        self.values[min(epoch, self.num_epochs - 1):] = num_frozen_layer
+        if self.path:
+            self.values.flush()
+
+    def get(self, epoch):
+        return int(self.values[min(epoch, self.num_epochs - 1)])
+
+    def to_list(self):
+        return self.values.tolist()
+
+    def cleanup(self):
+        if self.path:
+            self.values.flush()
+            del self.values
+            return
+        del self.values
+        self.shm.close()
+        if self.is_owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                logging.info("%s does not exist" % self.name)
@@ -0,0 +1,147 @@
+import argparse
+import logging
+import os
+import tempfile
+
+from pipe_transformer.config_args import ConfigArgs
+from pipe_transformer.freeze.auto_freeze import AutoFreeze
+from pipe_transformer.freeze.freeze_cost_model import FreezeCostModel
+from pipe_transformer.freeze.grad_norm_record import load_grad_norm_record
+from pipe_transformer.pipe.load_balance import compress_pipe_len, get_optimal_chunk_num_by_pipe_len
+
+"""
+Offline replay of the freeze decisions over the gradient norms recorded by a training run
+(config.freeze_grad_norm_record_path), to tune the freeze policy in seconds without GPUs:
+
+    python -m pipe_transformer.freeze.freeze_replay --record grad_norm.rec --scheduler grad_norm --percentile 40
+
+Each recorded decision is replayed through AutoFreeze with the given policy, and the pipe length after freezing is
+estimated from the recorded pipe profile by the same balanced partition as AutoElasticPipe (load_balance.py).
+For each decision, it reports the number of frozen layers, the pipe length, the data parallel width,
+and the epoch time relative to the one without freezing (see freeze_cost_model.py).
+"""
+
+
+class ProfiledPipe:
+    """
+    The pipe shape of AutoElasticPipe estimated from a recorded pipe profile, without building the model.
+    It provides the methods which FreezeCostModel uses.
+    """
+
+    def __init__(self, profile):
+        self.pipe_len = profile["pipe_len_at_the_beginning"]
+        self.max_parameter_per_gpu_at_beginning = profile["max_parameter_per_gpu_at_beginning"]
+        self.pipe_model_params_size_list_at_beginning = profile["pipe_model_params_size_list_at_beginning"]
+
+    def get_pipe_len(self):
+        return self.pipe_len
+
+    def transform(self, num_frozen_layers):
+        self.pipe_len = self.estimate_pipe_len_after_freezing(num_frozen_layers)
+        return self.pipe_len
+
+    def get_pipe_model_params_size_list(self, num_frozen_layers):
+        if num_frozen_layers == 0:
+            return list(self.pipe_model_params_size_list_at_beginning)
+        return self.pipe_model_params_size_list_at_beginning[num_frozen_layers * 2 + 1:]
+
+    def get_frozen_params_size(self, num_frozen_layers):
+        if num_frozen_layers == 0:
+            return 0.0
+        return sum(self.pipe_model_params_size_list_at_beginning[0:num_frozen_layers * 2 + 1])
+
+    def estimate_pipe_len_after_freezing(self, num_frozen_layers):
+        if num_frozen_layers == 0:
+            return self.pipe_len
+        return compress_pipe_len(self.pipe_len, self.get_pipe_model_params_size_list(num_frozen_layers),
+                                 self.max_parameter_per_gpu_at_beginning)
+
+    def get_num_chunks(self, pipe_len):
+        return get_optimal_chunk_num_by_pipe_len(pipe_len)
+
+    def get_pipe_model_time_list(self, num_frozen_layers):
+        # the sub layers are not timed in the record, so the costs are estimated by the parameter size
+        return None
+
+    def get_frozen_forward_time(self, num_frozen_layers):
+        return None
+
+
+def replay(profile, records, scheduler, alpha, percentile, cost_tolerance):
+    config = ConfigArgs()
+    config.num_layer = profile["num_layer"]
+    config.epochs = profile["epochs"]
+    config.world_size = profile["world_size"]
+    config.pipe_len_at_the_beginning = profile["pipe_len_at_the_beginning"]
+    config.b_cache = profile["b_cache"]
+    config.freeze_scheduler = scheduler
+    config.freeze_strategy_alpha = alpha
+    config.freeze_grad_norm_percentile = percentile
+    config.freeze_cost_tolerance = cost_tolerance
+    # not to share the freeze history of a training on the same node
+    history_file, config.freeze_history_path = tempfile.mkstemp(suffix=".freeze_history")
+    os.close(history_file)
+
+    auto_pipe = ProfiledPipe(profile)
+    auto_freeze = AutoFreeze(config)
+    cost_model = FreezeCostModel(config, auto_pipe)
+    auto_freeze.set_cost_model(cost_model)
+
+    # the same for all the epochs, since nothing is cached without freezing
+    epoch_time_without_freezing = cost_model.estimate_epoch_time(0)
+    steps = []
+    try:
+        for epoch, num_steps, recorded_num_frozen_layer, grad_norm_by_layer in records:
+            if auto_freeze.is_hand_crafted:
+                num_frozen_layer = auto_freeze.get_frozen_layer_num_by_epoch(min(epoch, config.epochs - 1))
+            else:
+                num_frozen_layer = auto_freeze.freeze_by_grad_norm(epoch, dict(enumerate(grad_norm_by_layer)))
+            num_remaining_epoch = max(1, config.epochs - epoch)
+            epoch_time = cost_model.estimate_epoch_time(num_frozen_layer, num_remaining_epoch)
+            pipe_len = auto_pipe.transform(num_frozen_layer)
+            steps.append({
+                "epoch": epoch,
+                "num_steps": num_steps,
+                "num_frozen_layer": num_frozen_layer,
+                "recorded_num_frozen_layer": recorded_num_frozen_layer,
+                "pipe_len": pipe_len,
+                "dp_width": config.world_size // pipe_len,
+                "relative_epoch_time": epoch_time / epoch_time_without_freezing,
+            })
+    finally:
+        auto_freeze.cleanup()
+        os.remove(config.freeze_history_path)
+    return steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PipeTransformer: replay the freeze decisions of a training run")
+    parser.add_argument("--record", type=str, required=True,
+                        help="the file recorded by config.freeze_grad_norm_record_path")
+
+    parser.add_argument("--scheduler", type=str, default="grad_norm",
+                        help="hand_crafted, grad_norm, or cost_aware")
+
+    parser.add_argument("--alpha", type=float, default=ConfigArgs.freeze_strategy_alpha)
+
+    parser.add_argument("--percentile", type=float, default=ConfigArgs.freeze_grad_norm_percentile)
+
+    parser.add_argument("--cost_tolerance", type=float, default=ConfigArgs.freeze_cost_tolerance)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    profile, records = load_grad_norm_record(args.record)
+    if profile is None:
+        raise Exception("the pipe profile %s.json is not recorded" % args.record)
+
+    steps = replay(profile, records, args.scheduler, args.alpha, args.percentile, args.cost_tolerance)
+    print("%6s %9s %8s %10s %8s %8s %13s" % ("epoch", "num_steps", "frozen", "(recorded)", "pipe_len", "dp_width",
+                                             "relative_time"))
+    for step in steps:
+        print("%6d %9d %8d %10d %8d %8d %13.3f" % (step["epoch"], step["num_steps"], step["num_frozen_layer"],
+                                                   step["recorded_num_frozen_layer"], step["pipe_len"],
+                                                   step["dp_width"], step["relative_epoch_time"]))
+    if len(steps) > 0:
+        print("mean relative epoch time = %.3f" % (sum(step["relative_epoch_time"] for step in steps) / len(steps)))
@@ -0,0 +1,67 @@
+import json
+import logging
+
+import numpy as np
+
+"""
+Record of the gradient norms which the freeze decisions are made on (config.freeze_grad_norm_record_path),
+replayed offline by freeze_replay.py to tune the freeze policy without training.
+
+<path>        one float32 row per freeze decision:
+              [epoch, num_steps, num_frozen_layer, num_layer, grad_norm of layer 0, ..., grad_norm of layer num_layer-1]
+              num_steps is 0 for a decision between epochs (see AutoFreeze.freeze())
+<path>.json   the pipe profile of the run: the parameter size of the sub layers and the pipe shape at the beginning,
+              which the pipe length after freezing is estimated from (see load_balance.compress_pipe_len())
+"""
+
+RECORD_HEADER_LEN = 4
+
+
+class GradNormRecorder:
+    def __init__(self, path):
+        self.path = path
+        # a new run starts a new record
+        open(self.path, "wb").close()
+
+    def write_pipe_profile(self, config, auto_pipe):
+        profile = {
+            "num_layer": config.num_layer,
+            "epochs": config.epochs,
+            "world_size": config.world_size,
+            "pipe_len_at_the_beginning": config.pipe_len_at_the_beginning,
+            "b_cache": config.b_cache,
+            "freeze_step_interval": config.freeze_step_interval,
+            "max_parameter_per_gpu_at_beginning": auto_pipe.get_max_parameter_per_gpu_at_beginning(),
+            "pipe_model_params_size_list_at_beginning": auto_pipe.get_pipe_model_params_size_list(0),
+        }
+        with open(self.path + ".json", "w") as f:
+            json.dump(profile, f)
+
+    def append(self, epoch, num_steps, num_frozen_layer, grad_norm_by_layer):
+        row = [epoch, num_steps, num_frozen_layer, len(grad_norm_by_layer)] + list(grad_norm_by_layer)
+        with open(self.path, "ab") as f:
+            np.asarray(row, dtype=np.float32).tofile(f)
+
+
+def load_grad_norm_record(path):
+    """
+    return the pipe profile (None if it is not recorded), and the list of (epoch, num_steps, num_frozen_layer,
+    grad_norm_by_layer) in the order of the decisions
+    """
+    try:
+        with open(path + ".json") as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        logging.info("%s.json does not exist" % path)
+        profile = None
+    data = np.fromfile(path, dtype=np.float32)
+    if len(data) == 0:
+        return profile, []
+    num_layer = int(data[RECORD_HEADER_LEN - 1])
+    row_len = RECORD_HEADER_LEN + num_layer
+    if len(data) % row_len != 0:
+        # the last row is partly written when the training is killed
+        logging.info("%s: the last %d values are dropped" % (path, len(data) % row_len))
+        data = data[:len(data) - len(data) % row_len]
+    rows = data.reshape(-1, row_len)
+    return profile, [(int(row[0]), int(row[1]), int(row[2]), row[RECORD_HEADER_LEN:].tolist()) for row in rows]
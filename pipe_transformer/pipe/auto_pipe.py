@@ -3,9 +3,12 @@ import logging
 import torch
 
 from . import Pipe
-from .load_balance import generate_parameter_size_wise_balance
+from .chunk_tuner import ChunkTuner
+from .load_balance import generate_parameter_size_wise_balance, compress_pipe_len, get_optimal_chunk_num_by_pipe_len
+from .model_partition.frozen_layer_fusion import fuse_frozen_model
 from .model_partition.pipe_model_builder import convert_to_balanced_model, create_pipe_styled_model, PipeModelWrapper, \
-    freeze_only
+    freeze_only, create_frozen_model
+from .sub_layer_profiler import profile_sub_layers
 
 
 class AutoElasticPipe:
@@ -41,10 +44,23 @@ class AutoElasticPipe:
         # pipe
         self.pipe = None
         self.pipe_model_params_size_list = []
+        # parameter size of the sub layers when no layer is frozen: [embedding, (attention, mlp) * num_layer, ...]
+        self.pipe_model_params_size_list_at_beginning = None
         self.frozen_params = 0.0
         self.max_parameter_per_gpu_at_beginning = 0.0
         self.num_frozen_layers = -1
 
+        # the sub layers of the pipe without any frozen layer, built once and sliced by the later transformations
+        self.pipe_sub_layers = None
+        self.pipe_sub_layers_params_size_list = None
+        # the fused blocks of the frozen layers (layer index -> list), see frozen_layer_fusion.py
+        self.fused_frozen_blocks = dict()
+        # measured forward/backward time per sample of the sub layers (see sub_layer_profiler.py), None: not profiled
+        self.pipe_sub_layers_forward_time_list = None
+        self.pipe_sub_layers_backward_time_list = None
+
+        self.chunk_tuner = ChunkTuner(config)
+
         # switch
         self.b_enable = True
 
@@ -64,19 +80,26 @@ class AutoElasticPipe:
         # frozen_model, parameters_size_frozen, pipe_model, parameters_list_pipe
 
         if self.b_enable:
-            frozen_model, parameters_size_frozen, \
-            model, self.pipe_model_params_size_list = create_pipe_styled_model(self.config, self.model_config,
-                                                                               self.model_backbone,
-                                                                               self.num_layer_in_total,
-                                                                               num_frozen_layers)
+            if self.pipe_sub_layers is None:
+                _, _, self.pipe_sub_layers, self.pipe_sub_layers_params_size_list = create_pipe_styled_model(
+                    self.config, self.model_config, self.model_backbone, self.num_layer_in_total, 0)
+            # the frozen layers are never unfrozen, so the embedding and the frozen layers are the head of the list
+            frozen_model = create_frozen_model(self.config, self.model_backbone, num_frozen_layers,
+                                               self.pipe_sub_layers)
+            num_frozen_sub_layers = num_frozen_layers * 2 + 1 if num_frozen_layers > 0 else 0
+            model = self.pipe_sub_layers[num_frozen_sub_layers:]
+            self.pipe_model_params_size_list = self.pipe_sub_layers_params_size_list[num_frozen_sub_layers:]
             logging.info("len(pipe_model) = %d" % len(model))
             logging.info("len(pipe_model paras_size) = %d" % len(self.pipe_model_params_size_list))
 
             # when b_enable = False, the load balance is not even, may lead to lower training speed.
             if num_frozen_layers == 0:
+                self.pipe_model_params_size_list_at_beginning = list(self.pipe_model_params_size_list)
                 # set the num_frozen_layers = 0 because we put all frozen layers into frozen_model
-                balanced_sub_layer_distribution, balanced_params_size_distribution = self._auto_balanced_elastic_partition(
-                    0)
+                balanced_sub_layer_distribution, _ = self._auto_balanced_elastic_partition(0)
+                # without the virtual stages, as compress_pipe_len() compares with it
+                _, balanced_params_size_distribution, _ = generate_parameter_size_wise_balance(
+                    self.pipe_len, self.pipe_model_params_size_list, 0)
                 self.max_parameter_per_gpu_at_beginning = max(balanced_params_size_distribution.values())
                 logging.info("self.max_parameter_per_gpu_at_beginning = %f" % self.max_parameter_per_gpu_at_beginning)
             else:
@@ -86,9 +109,12 @@ class AutoElasticPipe:
 
             device_idx_start = self.local_rank * self.pipe_len
             model = convert_to_balanced_model(self.local_rank, self.global_rank,
-                                              device_idx_start, model, balanced_sub_layer_distribution)
+                                              device_idx_start, model, balanced_sub_layer_distribution, self.pipe_len)
             # frozen model is always in device 0
             if frozen_model is not None:
+                if self.config.b_fuse_frozen_layers:
+                    frozen_model = fuse_frozen_model(frozen_model, self.config.b_jit_frozen_layers,
+                                                     self.fused_frozen_blocks)
                 frozen_model.to(device_idx_start)
 
             pipe_model = self._get_pipe(model)
@@ -135,52 +161,110 @@ class AutoElasticPipe:
         balanced_sub_layer_distribution, balanced_params_size_distribution, self.frozen_params = generate_parameter_size_wise_balance(
             self.pipe_len,
             self.pipe_model_params_size_list,
-            num_frozen_layers)
+            num_frozen_layers,
+            self._get_num_virtual_stages())
 
         logging.info(balanced_sub_layer_distribution)
         logging.info(balanced_params_size_distribution)
         return balanced_sub_layer_distribution, balanced_params_size_distribution
 
-    def _auto_pipe_length(self, num_frozen_layers):
-        # split the model into a pipe sequential
-        # Note if the pipe len = 1 and the batch size is big, we cannot hold the model in a single GPU
-        # thus we keep the minimum pipe len as 2.
-        # another strategy is using smaller batch size, but this may lead to accuracy drop and convergence uncertainty
-
-        # 8 (pipe) -> 4 (pipe) -> 2 (pipe) -> 1(DP)
-        while self.pipe_len >= 2:
-            # detect the max parameter size per GPU after shrink device number
-            logging.info("----------start to detection---------")
-            balanced_sub_layer_distribution, balanced_params_size_distribution, self.frozen_params = generate_parameter_size_wise_balance(
-                int(self.pipe_len / 2),
-                self.pipe_model_params_size_list, 0)
-            balanced_params_size_distribution[0] -= self.frozen_params * (5.0 / 6.0)
-            max_parameter_per_gpu = max(balanced_params_size_distribution.values())
-            logging.info("max_parameter_per_gpu = %f" % max_parameter_per_gpu)
-            logging.info("self.max_parameter_per_gpu_at_beginning = %f" % self.max_parameter_per_gpu_at_beginning)
-            if max_parameter_per_gpu <= self.max_parameter_per_gpu_at_beginning:
-                logging.info("#########    add pipe    #######")
-                self.pipe_len = int(self.pipe_len / 2)
-            else:
-                break
+    def _get_num_virtual_stages(self):
+        # a single device has nothing to interleave, and each virtual stage needs one sub layer at least
+        if self.pipe_len == 1:
+            return 1
+        return max(1, min(self.config.num_virtual_stages, len(self.pipe_model_params_size_list) // self.pipe_len))
 
+    def _auto_pipe_length(self, num_frozen_layers):
+        self.pipe_len = self.get_compressed_pipe_len(self.pipe_len, self.pipe_model_params_size_list)
         logging.info("current_num_device = %d" % self.pipe_len)
 
+    def get_compressed_pipe_len(self, pipe_len, pipe_model_params_size_list):
+        """
+        The shortest pipe length (halving from pipe_len) with which the max parameter size per GPU
+        does not exceed the one at the beginning. It does not change the pipe, so it is also used to estimate
+        the pipe length after freezing more layers (see estimate_pipe_len_after_freezing()).
+        """
+        return compress_pipe_len(pipe_len, pipe_model_params_size_list, self.max_parameter_per_gpu_at_beginning)
+
+    def get_pipe_model_params_size_list(self, num_frozen_layers):
+        """
+        The parameter size of the sub layers in the pipe after freezing num_frozen_layers layers
+        (the embedding and the frozen layers are moved to the frozen model). None if it is not profiled yet.
+        """
+        if self.pipe_model_params_size_list_at_beginning is None:
+            return None
+        if num_frozen_layers == 0:
+            return list(self.pipe_model_params_size_list_at_beginning)
+        return self.pipe_model_params_size_list_at_beginning[num_frozen_layers * 2 + 1:]
+
+    def get_pipe_model_time_list(self, num_frozen_layers):
+        """
+        The measured forward + backward time of the sub layers in the pipe after freezing num_frozen_layers layers.
+        None if the sub layers are not profiled.
+        """
+        if self.pipe_sub_layers_forward_time_list is None:
+            return None
+        num_frozen_sub_layers = num_frozen_layers * 2 + 1 if num_frozen_layers > 0 else 0
+        return [forward_time + backward_time for forward_time, backward_time in
+                zip(self.pipe_sub_layers_forward_time_list[num_frozen_sub_layers:],
+                    self.pipe_sub_layers_backward_time_list[num_frozen_sub_layers:])]
+
+    def get_frozen_forward_time(self, num_frozen_layers):
+        """
+        The measured forward time of the embedding and the frozen layers. None if the sub layers are not profiled.
+        """
+        if self.pipe_sub_layers_forward_time_list is None:
+            return None
+        if num_frozen_layers == 0:
+            return 0.0
+        return sum(self.pipe_sub_layers_forward_time_list[0:num_frozen_layers * 2 + 1])
+
+    def get_frozen_params_size(self, num_frozen_layers):
+        if self.pipe_model_params_size_list_at_beginning is None or num_frozen_layers == 0:
+            return 0.0
+        return sum(self.pipe_model_params_size_list_at_beginning[0:num_frozen_layers * 2 + 1])
+
+    def estimate_pipe_len_after_freezing(self, num_frozen_layers):
+        pipe_model_params_size_list = self.get_pipe_model_params_size_list(num_frozen_layers)
+        if pipe_model_params_size_list is None or num_frozen_layers == 0:
+            return self.pipe_len
+        return self.get_compressed_pipe_len(self.pipe_len, pipe_model_params_size_list)
+
+    def get_num_chunks(self, pipe_len):
+        return self._get_optimal_chunk_num_by_pipe_len(pipe_len)
+
     def _get_pipe(self, model):
         if self.pipe is not None:
             del self.pipe
             self.pipe = None
         # self.num_chunks_of_micro_batches
-        self.pipe = Pipe(model, chunks=self._get_optimal_chunk_num_by_pipe_len(self.pipe_len), checkpoint="never")
+        num_chunks = self._get_optimal_chunk_num_by_pipe_len(self.pipe_len)
+        if self.config.b_tune_chunks:
+            num_chunks = self.chunk_tuner.start(self.pipe_len, self.num_frozen_layers, self.config.batch_size,
+                                                num_chunks)
+        self.pipe = Pipe(model, chunks=num_chunks, checkpoint="never")
         return self.pipe
 
+    def on_forward(self, is_train, x):
+        """
+        called before the forward of each step, to tune the number of chunks of the pipe (see chunk_tuner.py),
+        and to profile the sub layers for the cost-aware freezing (see sub_layer_profiler.py)
+        """
+        if self.config.b_tune_chunks and self.pipe is not None:
+            self.chunk_tuner.step(self.pipe, is_train)
+        if is_train and self.config.freeze_scheduler == "cost_aware":
+            self._profile_sub_layers(x)
+
+    def _profile_sub_layers(self, x):
+        # all the sub layers are in the pipe only when no layer is frozen
+        if self.pipe_sub_layers_forward_time_list is not None or not self.b_enable or self.num_frozen_layers != 0 \
+                or self.pipe is None:
+            return
+        micro_batch_size = max(1, x.size(0) // self.pipe.chunks)
+        self.pipe_sub_layers_forward_time_list, self.pipe_sub_layers_backward_time_list = profile_sub_layers(
+            self.pipe_sub_layers, x[0:micro_batch_size])
+        logging.info("forward time per sample of the sub layers = %s" % str(self.pipe_sub_layers_forward_time_list))
+        logging.info("backward time per sample of the sub layers = %s" % str(self.pipe_sub_layers_backward_time_list))
+
     def _get_optimal_chunk_num_by_pipe_len(self, pipe_len):
-        if pipe_len == 8:
-            chunk_num = 2 * pipe_len
-        elif pipe_len == 4:
-            chunk_num = 4 * pipe_len
-        elif pipe_len == 2:
-            chunk_num = 8 * pipe_len
-        else:
-            chunk_num = 4 * pipe_len
-        return chunk_num
+        return get_optimal_chunk_num_by_pipe_len(pipe_len)
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import time
+
+import torch
+
+"""
+Measured tuning of the number of micro-batches (chunks) of the pipe (config.b_tune_chunks)
+
+The best number of chunks depends on the batch size, the sequence length and the hardware, so the one of
+get_optimal_chunk_num_by_pipe_len() is only the first candidate.
+When AutoElasticPipe.transform() changes the pipe length, the candidates are tried one by one on the next training
+steps (Pipe.set_chunks() between the steps, without rebuilding the pipe or DDP):
+    - the first step of a candidate is a warm-up, and the next config.chunk_tuner_num_probe_steps steps are timed
+    - a candidate whose peak memory exceeds config.chunk_tuner_max_memory_ratio of a device does not fit
+The fastest candidate which fits is kept, and it is cached by (pipe_len, num_frozen_layers, batch_size)
+in a JSON table (config.chunk_tuner_cache_path), so the later transformations and runs skip the probing.
+"""
+
+
+class ChunkTuner:
+    def __init__(self, config):
+        self.path = config.chunk_tuner_cache_path
+        self.local_rank = config.local_rank
+        self.num_probe_steps = config.chunk_tuner_num_probe_steps
+        self.max_memory_ratio = config.chunk_tuner_max_memory_ratio
+        self.table = self._load_table()
+
+        self.pipe_len = None
+        self.num_chunks = None
+
+        # probing
+        self.key = None
+        self.candidates = []
+        self.candidate_idx = 0
+        self.step_times = []
+        self.time_by_candidate = dict()
+        self.time_last_step = None
+
+    def start(self, pipe_len, num_frozen_layers, batch_size, default_num_chunks):
+        """
+        return the number of chunks to build the pipe with
+        """
+        key = self._build_key(pipe_len, num_frozen_layers, batch_size)
+        is_pipe_len_changed = pipe_len != self.pipe_len
+        # a probing interrupted by a transformation starts again
+        is_probe_interrupted = self.is_probing()
+        self.pipe_len = pipe_len
+        self.key = None
+        if key in self.table:
+            self.num_chunks = self.table[key]
+            logging.info("chunk tuner: %s -> %d chunks (cached)" % (key, self.num_chunks))
+            return self.num_chunks
+        if not is_pipe_len_changed and not is_probe_interrupted and self.num_chunks is not None:
+            return self.num_chunks
+
+        self.key = key
+        self.candidates = self._get_candidates(pipe_len, batch_size, default_num_chunks)
+        self.candidate_idx = 0
+        self.step_times = []
+        self.time_by_candidate = dict()
+        self.time_last_step = None
+        self.num_chunks = self.candidates[0]
+        logging.info("chunk tuner: %s, probing %s" % (key, str(self.candidates)))
+        # the pipe is not built yet
+        self._reset_peak_memory([torch.device("cuda", i) for i in range(torch.cuda.device_count())])
+        return self.num_chunks
+
+    def is_probing(self):
+        return self.key is not None
+
+    def step(self, pipe, is_train):
+        """
+        called before the forward of each step
+        """
+        if not self.is_probing():
+            return
+        if not is_train:
+            # the evaluation is not a part of the step time
+            self.time_last_step = None
+            return
+        now = time.time()
+        if self.time_last_step is not None:
+            self.step_times.append(now - self.time_last_step)
+        self.time_last_step = now
+        # +1: the first step of a candidate is a warm-up
+        if len(self.step_times) < self.num_probe_steps + 1:
+            return
+
+        num_chunks = self.candidates[self.candidate_idx]
+        step_time = sum(self.step_times[1:]) / self.num_probe_steps
+        if self._is_memory_fit(pipe):
+            self.time_by_candidate[num_chunks] = step_time
+        logging.info("chunk tuner: %d chunks, step time = %f, fit = %s" % (num_chunks, step_time,
+                                                                          str(num_chunks in self.time_by_candidate)))
+
+        self.candidate_idx += 1
+        if self.candidate_idx < len(self.candidates):
+            self.num_chunks = self.candidates[self.candidate_idx]
+        else:
+            self._finish()
+        pipe.set_chunks(self.num_chunks)
+        self.step_times = []
+        self.time_last_step = time.time()
+        self._reset_peak_memory(pipe.devices)
+
+    def _finish(self):
+        if len(self.time_by_candidate) == 0:
+            # nothing fits, so the first (the default) one is kept
+            self.num_chunks = self.candidates[0]
+        else:
+            self.num_chunks = min(self.time_by_candidate, key=self.time_by_candidate.get)
+        logging.info("chunk tuner: %s -> %d chunks" % (self.key, self.num_chunks))
+        self.table[self.key] = self.num_chunks
+        self._save_table()
+        self.key = None
+
+    def _get_candidates(self, pipe_len, batch_size, default_num_chunks):
+        # the default first, then the multiples of pipe_len, with one sample per micro-batch at least
+        candidates = [default_num_chunks]
+        for factor in [1, 2, 4, 8]:
+            num_chunks = factor * pipe_len
+            if num_chunks not in candidates and num_chunks <= batch_size:
+                candidates.append(num_chunks)
+        return candidates
+
+    def _is_memory_fit(self, pipe):
+        if not torch.cuda.is_available():
+            return True
+        for device in set(pipe.devices):
+            if device.type != "cuda":
+                continue
+            total_memory = torch.cuda.get_device_properties(device).total_memory
+            if torch.cuda.max_memory_allocated(device) > total_memory * self.max_memory_ratio:
+                return False
+        return True
+
+    def _reset_peak_memory(self, devices):
+        if not torch.cuda.is_available():
+            return
+        for device in set(devices):
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+
+    def _build_key(self, pipe_len, num_frozen_layers, batch_size):
+        return "%d,%d,%d" % (pipe_len, num_frozen_layers, batch_size)
+
+    def _load_table(self):
+        if not self.path or not os.path.exists(self.path):
+            return dict()
+        with open(self.path) as f:
+            table = json.load(f)
+        logging.info("chunk tuner: %d entries are loaded from %s" % (len(table), self.path))
+        return table
+
+    def _save_table(self):
+        # the processes of a node tune the same pipes, and the first one writes the table
+        if not self.path or self.local_rank != 0:
+            return
+        path_tmp = self.path + ".tmp"
+        with open(path_tmp, "w") as f:
+            json.dump(self.table, f, indent=1, sort_keys=True)
+        os.replace(path_tmp, self.path)
@@ -4,16 +4,22 @@ import math
 import numpy as np
 
 
-def generate_parameter_size_wise_balance(num_devices, param_list, num_frozen_layer):
+def generate_parameter_size_wise_balance(num_devices, param_list, num_frozen_layer, num_virtual_stages=1):
+    """
+    num_virtual_stages > 1: B is partitioned into num_devices * num_virtual_stages partitions (virtual stages),
+    which are assigned to the devices round-robin (the i-th one to the device i % num_devices),
+    so balanced_layer_num is keyed by the virtual stage, and balanced_params_size sums the virtual stages by device
+    """
     # B = {b0, ... b11}
     # b0 is real number
     # partition B into N partitions (pipe len)
     #
-    balanced_layer_num = {}  # key: device_id; value: layer_num
-    balanced_params_size = {}  # key: device_id; value: params_size
+    balanced_layer_num = {}  # key: device_id (virtual stage id); value: layer_num
+    balanced_params_size = {}  # key: device_id (virtual stage id); value: params_size
 
+    num_stages = num_devices * num_virtual_stages
     assigned_layer_cnt = 0
-    for i in range(num_devices):
+    for i in range(num_stages):
         balanced_layer_num[i] = 0
         balanced_params_size[i] = 0.0
     # assign all frozen layers to the 1st device:
@@ -39,10 +45,10 @@ def generate_parameter_size_wise_balance(num_devices, param_list, num_frozen_lay
     logging.info("total_param_size_to_be_assigned = %f" % total_param_size_to_be_assigned)
 
     # search a better partition
-    for i in range(num_devices):
-        mean = total_param_size_to_be_assigned / (num_devices - i)
+    for i in range(num_stages):
+        mean = total_param_size_to_be_assigned / (num_stages - i)
         # logging.info("mean = %f" % mean)
-        variance = np.var(param_list[assigned_layer_cnt:]) / (num_devices - i)
+        variance = np.var(param_list[assigned_layer_cnt:]) / (num_stages - i)
         # logging.info("variance = %f" % variance)
 
         for idx in range(assigned_layer_cnt, len(param_list)):
@@ -51,7 +57,10 @@ def generate_parameter_size_wise_balance(num_devices, param_list, num_frozen_lay
                 criterion = balanced_params_size[i] - frozen_params * (1.0 - frozen_layer_cost_factor) + p
             else:
                 criterion = balanced_params_size[i] + p
-            if i == num_devices - 1 or criterion < mean + variance:
+            # every stage has one sub layer at least: an empty partition has no device (Pipe puts it on the CPU)
+            if i < num_stages - 1 and len(param_list) - idx <= num_stages - 1 - i:
+                break
+            if i == num_stages - 1 or balanced_layer_num[i] == 0 or criterion < mean + variance:
                 balanced_params_size[i] += p
                 balanced_layer_num[i] += 1
                 assigned_layer_cnt += 1
@@ -59,6 +68,13 @@ def generate_parameter_size_wise_balance(num_devices, param_list, num_frozen_lay
             else:
                 break
 
+    if num_virtual_stages > 1:
+        balanced_params_size_by_device = {}
+        for i in range(num_devices):
+            balanced_params_size_by_device[i] = sum([balanced_params_size[stage_id]
+                                                     for stage_id in range(i, num_stages, num_devices)])
+        balanced_params_size = balanced_params_size_by_device
+
     # evaluate the theory of "Block Partitions of Sequences"
     check_gap_all(balanced_params_size, frozen_params, frozen_layer_cost_factor)
     check_gap_except_1st_layer(balanced_params_size)
@@ -111,3 +127,44 @@ def generate_layer_wise_balance(num_devices, num_layers):
             balance.append(math.ceil(x))
             layers_assigned += math.ceil(x)
     return balance
+
+
+def compress_pipe_len(pipe_len, pipe_model_params_size_list, max_parameter_per_gpu_at_beginning):
+    """
+    The shortest pipe length (halving from pipe_len) with which the max parameter size per GPU
+    does not exceed the one at the beginning (see AutoElasticPipe.get_compressed_pipe_len()).
+    """
+    # split the model into a pipe sequential
+    # Note if the pipe len = 1 and the batch size is big, we cannot hold the model in a single GPU
+    # thus we keep the minimum pipe len as 2.
+    # another strategy is using smaller batch size, but this may lead to accuracy drop and convergence uncertainty
+
+    # 8 (pipe) -> 4 (pipe) -> 2 (pipe) -> 1(DP)
+    while pipe_len >= 2:
+        # detect the max parameter size per GPU after shrink device number
+        logging.info("----------start to detection---------")
+        balanced_sub_layer_distribution, balanced_params_size_distribution, frozen_params = generate_parameter_size_wise_balance(
+            int(pipe_len / 2),
+            pipe_model_params_size_list, 0)
+        balanced_params_size_distribution[0] -= frozen_params * (5.0 / 6.0)
+        max_parameter_per_gpu = max(balanced_params_size_distribution.values())
+        logging.info("max_parameter_per_gpu = %f" % max_parameter_per_gpu)
+        logging.info("max_parameter_per_gpu_at_beginning = %f" % max_parameter_per_gpu_at_beginning)
+        if max_parameter_per_gpu <= max_parameter_per_gpu_at_beginning:
+            logging.info("#########    add pipe    #######")
+            pipe_len = int(pipe_len / 2)
+        else:
+            break
+    return pipe_len
+
+
+def get_optimal_chunk_num_by_pipe_len(pipe_len):
+    if pipe_len == 8:
+        chunk_num = 2 * pipe_len
+    elif pipe_len == 4:
+        chunk_num = 4 * pipe_len
+    elif pipe_len == 2:
+        chunk_num = 8 * pipe_len
+    else:
+        chunk_num = 4 * pipe_len
+    return chunk_num
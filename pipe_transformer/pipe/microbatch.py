@@ -6,7 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 """Manipulation of micro-batches."""
 import typing
-from typing import Callable, Iterable, Iterator, List, Union, cast, Sequence
+from typing import Callable, Iterable, Iterator, List, Optional, Union, cast, Sequence
 
 import torch
 from torch import Tensor
@@ -149,18 +149,48 @@ def check(input: TensorOrTensors) -> None:
         raise TypeError(f"expected Tensor, but got {input.__class__.__name__}")
 
 
-def scatter(input: TensorOrTensors, chunks: int) -> List[Batch]:
-    """Splits an input mini-batch into multiple micro-batches."""
+def split_sizes(batch_size: int, chunks: int) -> List[int]:
+    """Returns the balanced sizes of the micro-batches: the sizes differ by
+    one at most, and a mini-batch smaller than ``chunks`` (e.g., the last one
+    of an epoch) is split into micro-batches of one sample.
+    """
+    num_micro_batches = max(1, min(chunks, batch_size))
+    size, remainder = divmod(batch_size, num_micro_batches)
+    return [size + 1] * remainder + [size] * (num_micro_batches - remainder)
+
+
+def scatter(input: TensorOrTensors, chunks: int, sizes: Optional[List[int]] = None) -> List[Batch]:
+    """Splits an input mini-batch into multiple micro-batches.
+
+    Unlike ``tensor.chunk(chunks)``, which gives fewer micro-batches than
+    ``chunks`` when the batch size is not divisible (e.g., 10 samples into 5
+    micro-batches of 2 with 8 chunks), the micro-batches are balanced by
+    :func:`split_sizes`, unless their sizes are given explicitly.
+
+    Raises:
+        ValueError: the sizes don't sum up to the batch size, or the tensors
+        don't have the same batch size.
+
+    """
+    tensors = [input] if isinstance(input, Tensor) else list(input)
+    batch_size = tensors[0].size(0)
+    if any(tensor.size(0) != batch_size for tensor in tensors):
+        raise ValueError("tensors must have the same batch size to be split into micro-batches")
+
+    if sizes is None:
+        sizes = split_sizes(batch_size, chunks)
+    elif sum(sizes) != batch_size or any(size <= 0 for size in sizes):
+        raise ValueError(f"micro-batch sizes {sizes} must be positive and sum up to the batch size {batch_size}")
+
     inputs: Iterable[TensorOrTensors]
 
     if isinstance(input, Tensor):
-        inputs = input.chunk(chunks)
+        inputs = input.split(sizes)
     else:
         rotated: List[Tensors] = []
 
         for tensor in input:
-            tensors = tensor.chunk(chunks)
-            rotated.append(cast(Tensors, tensors))
+            rotated.append(cast(Tensors, tensor.split(sizes)))
 
         inputs = zip(*rotated)
 
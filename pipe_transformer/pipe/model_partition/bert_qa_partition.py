@@ -3,6 +3,7 @@ import logging
 from torch import nn
 
 from transformers import apply_chunking_to_forward
+from .layer_registry import freeze_embedding_and_blocks, resolve_layers
 
 """
 For BERT + QA
@@ -69,26 +70,36 @@ class BertFrozenLayerForQA(nn.Module):
 
     def forward(self, x, layer_id=0):
         if layer_id == self.num_frozen_layer:
-            logging.info("no need to recompute")
+            logging.debug("no need to recompute")
             return x
         if layer_id == 0:
-            logging.info("compute from layer 0")
+            logging.debug("compute from layer 0")
             x = self.embedding(x)
             for id in range(0, self.num_frozen_layer * 2):
                 x = self.layers[id](x)
             return x
         else:
-            logging.info("compute from layer %d-%d" % (layer_id, self.num_frozen_layer - 1))
+            logging.debug("compute from layer %d-%d" % (layer_id, self.num_frozen_layer - 1))
             for id in range(layer_id * 2, self.num_frozen_layer * 2):
                 x = self.layers[id](x)
             return x
 
 
+def create_frozen_model_BERT_for_QA(model_backbone, num_frozen_layer, pipe_sub_layers):
+    """
+    The frozen model of the first num_frozen_layer layers, built from the sub layers of the pipe without any frozen
+    layer ([embedding, (attention, FFN) * num_layer, ...]), so that the backbone is not walked again.
+    """
+    freeze_embedding_and_blocks(model_backbone, num_frozen_layer)
+    return BertFrozenLayerForQA(num_frozen_layer, pipe_sub_layers[0], pipe_sub_layers[1:num_frozen_layer * 2 + 1])
+
+
 def create_pipe_styled_model_BERT_for_QA(model_config, model_backbone, num_layer_in_total,
                                          num_frozen_layer):
     logging.info(model_backbone)
     for name, p in model_backbone.named_parameters():
         logging.info(name)
+    layers = resolve_layers(model_backbone)
     frozen_model = None
     pipe_model = nn.Sequential()
 
@@ -96,16 +107,16 @@ def create_pipe_styled_model_BERT_for_QA(model_config, model_backbone, num_layer
     parameters_list_pipe = []
 
     if num_frozen_layer > 0:
-        for param in model_backbone.bert.embeddings.parameters():
+        for param in layers.embedding.parameters():
             param.requires_grad = False
-        frozen_emb = model_backbone.bert.embeddings
+        frozen_emb = layers.embedding
         size_embedding = count_parameters(frozen_emb, False)
         parameters_size_frozen += size_embedding
 
         frozen_model_sequential = nn.Sequential()
         # add transformer blocks needed to be trained
         for frozen_layer_index in range(num_frozen_layer):
-            layer_block = model_backbone.bert.encoder.layer[frozen_layer_index]
+            layer_block = layers.blocks[frozen_layer_index]
             for param in layer_block.parameters():
                 param.requires_grad = False
             size_layer_block = count_parameters(layer_block, False)
@@ -119,25 +130,25 @@ def create_pipe_styled_model_BERT_for_QA(model_config, model_backbone, num_layer
 
         frozen_model = BertFrozenLayerForQA(num_frozen_layer, frozen_emb, frozen_model_sequential)
     else:
-        pipe_model.add_module("embedding", model_backbone.bert.embeddings)
-        size_embedding = count_parameters(model_backbone.bert.embeddings, False)
+        pipe_model.add_module("embedding", layers.embedding)
+        size_embedding = count_parameters(layers.embedding, False)
         parameters_list_pipe.append(size_embedding)
 
-        word_embeddings_size = count_parameters(model_backbone.bert.embeddings.word_embeddings, False)
+        word_embeddings_size = count_parameters(layers.embedding.word_embeddings, False)
         logging.info("word_embeddings_size = %f" % word_embeddings_size)
 
-        position_embeddings_size = count_parameters(model_backbone.bert.embeddings.position_embeddings, False)
+        position_embeddings_size = count_parameters(layers.embedding.position_embeddings, False)
         logging.info("position_embeddings_size = %f" % position_embeddings_size)
 
-        token_type_embeddings_size = count_parameters(model_backbone.bert.embeddings.token_type_embeddings, False)
+        token_type_embeddings_size = count_parameters(layers.embedding.token_type_embeddings, False)
         logging.info("token_type_embeddings_size = %f" % token_type_embeddings_size)
 
-        LayerNorm_size = count_parameters(model_backbone.bert.embeddings.LayerNorm, False)
+        LayerNorm_size = count_parameters(layers.embedding.LayerNorm, False)
         logging.info("LayerNorm_size = %f" % LayerNorm_size)
 
     # add transformer blocks needed to be trained
     for layer_index in range(num_frozen_layer, num_layer_in_total):
-        layer_block = model_backbone.bert.encoder.layer[layer_index]
+        layer_block = layers.blocks[layer_index]
 
         pipe_model.add_module("layer" + str(layer_index) + "attention", layer_block.attention)
         size_layer_block_attention = count_parameters(layer_block.attention, False)
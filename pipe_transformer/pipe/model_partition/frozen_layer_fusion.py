@@ -0,0 +1,188 @@
+import logging
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+"""
+Inference-only frozen layers (config.b_fuse_frozen_layers)
+
+The frozen layers (FrozenLayer, BertFrozenLayer and BertFrozenLayerForQA) only run forward, on the cache misses
+and in the evaluation, but they are built from the training modules of the backbone.
+fuse_frozen_model() converts them into FusedFrozenLayer when the pipe is transformed:
+    - the Q, K and V projections of a block are concatenated into one GEMM
+    - ViT (pre-LN): the affine of attention_norm / ffn_norm is folded into the QKV / fc1 projection:
+          (norm(x) * gamma + beta) W^T + b = norm(x) (W diag(gamma))^T + (W beta + b)
+      BERT (post-LN): the LayerNorm is applied to the residual sum, so it is kept as it is
+    - the dropout and the per-call logging are removed
+    - each fused block is compiled by torch.jit.script (config.b_jit_frozen_layers)
+
+The fused QKV and fc1 weights are copies, and the other weights are shared with the backbone.
+The frozen layers are never unfrozen, so AutoElasticPipe keeps the fused blocks by layer, and a transformation
+only fuses the newly frozen layers.
+The source frozen layers stay registered in FusedFrozenLayer, so that the pipe is rebuilt from (and the frozen weight
+handoff in AutoDataParallel updates) the weights of the backbone.
+A sub layer which cannot be fused (e.g., a BERT with relative position embeddings) runs as it is.
+
+The fused layers run under torch.no_grad() rather than torch.inference_mode(): their output is the input of the pipe,
+which must be saved for the backward, and the handoff copies into the fused weights in place.
+"""
+
+
+class FusedViTBlock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        attn = block.attn
+        self.num_attention_heads = attn.num_attention_heads
+        self.attention_head_size = attn.attention_head_size
+        self.all_head_size = attn.all_head_size
+        self.sqrt_attention_head_size = math.sqrt(self.attention_head_size)
+        self.normalized_shape = list(block.attention_norm.normalized_shape)
+        self.attention_norm_eps = block.attention_norm.eps
+        self.ffn_norm_eps = block.ffn_norm.eps
+
+        qkv_weight = torch.cat([attn.query.weight, attn.key.weight, attn.value.weight], dim=0)
+        qkv_bias = torch.cat([attn.query.bias, attn.key.bias, attn.value.bias], dim=0)
+        self.qkv = _build_linear(*_fold_layer_norm(block.attention_norm, qkv_weight, qkv_bias))
+        self.out = attn.out
+        self.fc1 = _build_linear(*_fold_layer_norm(block.ffn_norm, block.ffn.fc1.weight, block.ffn.fc1.bias))
+        self.fc2 = block.ffn.fc2
+
+    def forward(self, x):
+        batch_size, seq_len = x.shape[0], x.shape[1]
+        h = x
+        x = F.layer_norm(x, self.normalized_shape, None, None, self.attention_norm_eps)
+        qkv = self.qkv(x).view(batch_size, seq_len, 3, self.num_attention_heads, self.attention_head_size)
+        qkv = qkv.permute(2, 0, 3, 1, 4)
+        attention_scores = torch.matmul(qkv[0], qkv[1].transpose(-1, -2)) / self.sqrt_attention_head_size
+        attention_probs = torch.softmax(attention_scores, dim=-1)
+        context_layer = torch.matmul(attention_probs, qkv[2]).permute(0, 2, 1, 3).contiguous()
+        x = self.out(context_layer.view(batch_size, seq_len, self.all_head_size)) + h
+
+        h = x
+        x = F.layer_norm(x, self.normalized_shape, None, None, self.ffn_norm_eps)
+        x = self.fc2(F.gelu(self.fc1(x)))
+        return x + h
+
+
+class FusedBertAttention(nn.Module):
+    """BertAttention without the attention mask, as the frozen layers call it"""
+
+    def __init__(self, attention):
+        super().__init__()
+        self_attention = attention.self
+        self.num_attention_heads = self_attention.num_attention_heads
+        self.attention_head_size = self_attention.attention_head_size
+        self.all_head_size = self_attention.all_head_size
+        self.sqrt_attention_head_size = math.sqrt(self.attention_head_size)
+
+        self.qkv = _build_linear(
+            torch.cat([self_attention.query.weight, self_attention.key.weight, self_attention.value.weight], dim=0),
+            torch.cat([self_attention.query.bias, self_attention.key.bias, self_attention.value.bias], dim=0))
+        self.dense = attention.output.dense
+        self.LayerNorm = attention.output.LayerNorm
+
+    def forward(self, x):
+        batch_size, seq_len = x.shape[0], x.shape[1]
+        qkv = self.qkv(x).view(batch_size, seq_len, 3, self.num_attention_heads, self.attention_head_size)
+        qkv = qkv.permute(2, 0, 3, 1, 4)
+        attention_scores = torch.matmul(qkv[0], qkv[1].transpose(-1, -2)) / self.sqrt_attention_head_size
+        attention_probs = torch.softmax(attention_scores, dim=-1)
+        context_layer = torch.matmul(attention_probs, qkv[2]).permute(0, 2, 1, 3).contiguous()
+        return self.LayerNorm(self.dense(context_layer.view(batch_size, seq_len, self.all_head_size)) + x)
+
+
+class FusedBertFFN(nn.Module):
+    def __init__(self, ffn_layer):
+        super().__init__()
+        self.intermediate_dense = ffn_layer.intermediate.dense
+        self.output_dense = ffn_layer.output.dense
+        self.LayerNorm = ffn_layer.output.LayerNorm
+
+    def forward(self, x):
+        return self.LayerNorm(self.output_dense(F.gelu(self.intermediate_dense(x))) + x)
+
+
+class FusedFrozenLayer(nn.Module):
+    def __init__(self, frozen_model, blocks):
+        super().__init__()
+        self.num_frozen_layer = frozen_model.num_frozen_layer
+        # ViT: one block per layer; BERT: the attention and the FFN of a layer are two sub layers
+        self.num_sub_layer_per_layer = len(frozen_model.layers) // frozen_model.num_frozen_layer
+        self.source_model = frozen_model
+        self.blocks = blocks
+
+    def train(self, mode=True):
+        # there is no dropout to switch in the fused blocks, and the embedding always runs in the evaluation mode
+        return super().train(False)
+
+    def forward(self, x, layer_id=0):
+        if layer_id == self.num_frozen_layer:
+            return x
+        if layer_id == 0:
+            x = self.source_model.embedding(x)
+        for block in self.blocks[layer_id * self.num_sub_layer_per_layer:]:
+            x = block(x)
+        return x
+
+
+def fuse_frozen_model(frozen_model, is_jit, fused_blocks_by_layer=None):
+    """
+    frozen_model: FrozenLayer, BertFrozenLayer or BertFrozenLayerForQA
+    fused_blocks_by_layer: the fused blocks of the layers frozen by the previous transformations (layer index -> list),
+    which are reused, and the ones of the newly frozen layers are added to it
+    """
+    if fused_blocks_by_layer is None:
+        fused_blocks_by_layer = dict()
+    num_sub_layer_per_layer = len(frozen_model.layers) // frozen_model.num_frozen_layer
+    blocks = []
+    for layer_idx in range(frozen_model.num_frozen_layer):
+        if layer_idx not in fused_blocks_by_layer:
+            start = layer_idx * num_sub_layer_per_layer
+            sub_layers = frozen_model.layers[start:start + num_sub_layer_per_layer]
+            with torch.no_grad():
+                if type(frozen_model).__name__ == "FrozenLayer":
+                    layer_blocks = [_fuse_vit_block(sub_layers[0])]
+                else:
+                    layer_blocks = _fuse_bert_layer(sub_layers[0], sub_layers[1])
+            if is_jit:
+                layer_blocks = [torch.jit.script(block) if _is_fused(block) else block for block in layer_blocks]
+            fused_blocks_by_layer[layer_idx] = layer_blocks
+        blocks += fused_blocks_by_layer[layer_idx]
+    num_fused_blocks = sum([1 if _is_fused(block) else 0 for block in blocks])
+    logging.info("%d/%d frozen sub layers are fused (jit = %s)" % (num_fused_blocks, len(blocks), str(is_jit)))
+    return FusedFrozenLayer(frozen_model, nn.ModuleList(blocks)).eval()
+
+
+def _is_fused(block):
+    return isinstance(block, (FusedViTBlock, FusedBertAttention, FusedBertFFN, torch.jit.ScriptModule))
+
+
+def _fuse_vit_block(block):
+    if block.ffn.act_fn is not F.gelu:
+        return block
+    return FusedViTBlock(block)
+
+
+def _fuse_bert_layer(attention, ffn_layer):
+    # the attention of the original layer returns a tuple, which only the original FFN layer takes
+    if getattr(attention.self, "position_embedding_type", "absolute") != "absolute" or \
+            len(attention.pruned_heads) > 0 or ffn_layer.intermediate.intermediate_act_fn is not F.gelu:
+        return [attention, ffn_layer]
+    return [FusedBertAttention(attention), FusedBertFFN(ffn_layer)]
+
+
+def _fold_layer_norm(layer_norm, weight, bias):
+    if not layer_norm.elementwise_affine:
+        return weight, bias
+    return weight * layer_norm.weight.unsqueeze(0), bias + torch.matmul(weight, layer_norm.bias)
+
+
+def _build_linear(weight, bias):
+    linear = nn.Linear(weight.shape[1], weight.shape[0], device=weight.device, dtype=weight.dtype)
+    linear.requires_grad_(False)
+    with torch.no_grad():
+        linear.weight.copy_(weight)
+        linear.bias.copy_(bias)
+    return linear
@@ -0,0 +1,74 @@
+import logging
+from functools import reduce
+
+from torch import nn
+
+"""
+Layer registry
+
+AutoFreeze and the pipe model builders only need three parts of a backbone:
+    embedding - the module which converts the input into the hidden feature of the first block
+    blocks    - nn.ModuleList of the transformer blocks, which are frozen from the first one
+    head      - the task-specific output layer of the backbone
+
+Their attribute paths differ by model (ViT: transformer.encoder.layer, BERT: bert.encoder.layer),
+and the number of blocks differs by model size (12, 24, 32, ...), so they are resolved here by the class name
+of the backbone (or of its base classes), instead of being hard-coded in each user.
+A new backbone is supported by register_layer_paths() without changing AutoFreeze or the pipe model builders.
+"""
+
+# model class name -> (embedding path, blocks path, head path)
+LAYER_PATHS = {
+    "VisionTransformer": ("transformer.embeddings", "transformer.encoder.layer", "head"),
+    "BertForSequenceClassification": ("bert.embeddings", "bert.encoder.layer", "classifier"),
+    "BertForQuestionAnswering": ("bert.embeddings", "bert.encoder.layer", "qa_outputs"),
+}
+
+
+class TransformerLayers:
+    def __init__(self, embedding, blocks, head):
+        self.embedding = embedding
+        self.blocks = blocks
+        self.head = head
+
+    def get_num_layer(self):
+        return len(self.blocks)
+
+
+def register_layer_paths(model_class_name, embedding_path, blocks_path, head_path):
+    LAYER_PATHS[model_class_name] = (embedding_path, blocks_path, head_path)
+
+
+def resolve_layers(model):
+    for model_class in type(model).__mro__:
+        if model_class.__name__ in LAYER_PATHS:
+            embedding_path, blocks_path, head_path = LAYER_PATHS[model_class.__name__]
+            blocks = _get_module_by_path(model, blocks_path)
+            if not isinstance(blocks, nn.ModuleList):
+                raise Exception("%s of %s is not a nn.ModuleList" % (blocks_path, type(model).__name__))
+            return TransformerLayers(_get_module_by_path(model, embedding_path), blocks,
+                                     _get_module_by_path(model, head_path))
+    raise Exception("cannot resolve the layers of %s, please add it by register_layer_paths()" %
+                    type(model).__name__)
+
+
+def freeze_embedding_and_blocks(model, num_frozen_layer):
+    layers = resolve_layers(model)
+    if num_frozen_layer > layers.get_num_layer():
+        raise Exception("num_frozen_layer (%d) > the number of layers (%d)" % (num_frozen_layer,
+                                                                                layers.get_num_layer()))
+    if num_frozen_layer > 0:
+        for param in layers.embedding.parameters():
+            param.requires_grad = False
+    for frozen_layer_index in range(num_frozen_layer):
+        for param in layers.blocks[frozen_layer_index].parameters():
+            param.requires_grad = False
+    logging.info("%s: embedding and %d/%d layers are frozen" % (type(model).__name__, num_frozen_layer,
+                                                                layers.get_num_layer()))
+
+
+def _get_module_by_path(model, path):
+    try:
+        return reduce(getattr, path.split("."), model)
+    except AttributeError:
+        raise Exception("%s does not have %s" % (type(model).__name__, path))
@@ -4,9 +4,10 @@ import time
 import torch
 from torch import nn
 
-from .bert_qa_partition import create_pipe_styled_model_BERT_for_QA
-from .bert_tc_partition import create_pipe_styled_model_BERT_for_TC
-from .vit_partition import create_pipe_styled_model_vit, freeze_vit_only
+from .bert_qa_partition import create_pipe_styled_model_BERT_for_QA, create_frozen_model_BERT_for_QA
+from .bert_tc_partition import create_pipe_styled_model_BERT_for_TC, create_frozen_model_BERT_for_TC
+from .layer_registry import freeze_embedding_and_blocks
+from .vit_partition import create_pipe_styled_model_vit, create_frozen_model_vit
 
 """
 Issues Description:
@@ -47,40 +48,59 @@ def create_pipe_styled_model(config, model_config, model_backbone, num_layer_in_
         raise Exception("does not exist")
 
 
-def freeze_only(config, model_config, model_backbone, num_layer_in_total, num_frozen_layer):
+def create_frozen_model(config, model_backbone, num_frozen_layer, pipe_sub_layers):
+    """
+    pipe_sub_layers: the pipe sub layers without any frozen layer (create_pipe_styled_model(..., num_frozen_layer=0)),
+    which the frozen model shares its layers with
+    """
+    if num_frozen_layer == 0:
+        return None
     if config.learning_task == config.LEARNING_TASK_IMAGE_CLASSIFICATION and \
             config.model_name == config.MODEL_VIT:
-        logging.info("create ViT pipeline")
-        return freeze_vit_only(model_backbone, num_frozen_layer)
+        return create_frozen_model_vit(model_backbone, num_frozen_layer)
 
     elif config.learning_task == config.LEARNING_TASK_TEXT_CLASSIFICATION and \
             config.model_name == config.MODEL_BERT:
-        logging.info("create BERT for text classification pipeline")
+        return create_frozen_model_BERT_for_TC(model_backbone, num_frozen_layer, pipe_sub_layers)
 
     elif config.learning_task == config.LEARNING_TASK_QUESTION_ANSWERING and \
             config.model_name == config.MODEL_BERT:
-        logging.info("create BERT for QA pipeline")
+        return create_frozen_model_BERT_for_QA(model_backbone, num_frozen_layer, pipe_sub_layers)
     else:
         raise Exception("does not exist")
 
 
+def freeze_only(config, model_config, model_backbone, num_layer_in_total, num_frozen_layer):
+    # the embedding and the blocks are resolved by the layer registry, so all the backbones are frozen in the same way
+    freeze_embedding_and_blocks(model_backbone, num_frozen_layer)
+
+
 def convert_to_balanced_model(local_rank, global_rank,
-                              device_idx_start, pipe: nn.Sequential, balance):
+                              device_idx_start, pipe: nn.Sequential, balance, num_devices=None):
     # logging.info("device_idx_start = %d" % device_idx_start)
     # logging.info(pipe)
     # logging.info(balance)
     """
+    balance: the number of sub layers by partition. With virtual stages (more partitions than num_devices),
+    the i-th partition is on the device i % num_devices, and Pipe interleaves them (see pipeline.py).
+
     Optimization:
         Pin Memory: https://pytorch.org/docs/stable/notes/cuda.html#use-pinned-memory-buffers
         Prepare a Pin Memory model
     """
+    if num_devices is None:
+        num_devices = len(balance)
     # logging.info("input = " + str(pipe))
     logging.info("convert_to_balanced_model. local_rank = %d, global_rank = %d" % (local_rank, global_rank))
     time_start_loading = time.time()
     pipe_layer_idx = 0
+    num_moved_layers = 0
     balanced_pipe = []
-    for device_id in balance.keys():
-        num_layers = balance[device_id]
+    for stage_id in balance.keys():
+        num_layers = balance[stage_id]
+        if num_layers == 0:
+            raise Exception("partition %d of the balance %s is empty" % (stage_id, str(balance)))
+        device_id = stage_id % num_devices
         layers = []
         for i in range(num_layers):
             layers.append(pipe[pipe_layer_idx])
@@ -90,9 +110,13 @@ def convert_to_balanced_model(local_rank, global_rank,
             logging.info("######################local_rank = %d, global_rank = %d, device id: %d" % (local_rank,
                                                                                                      global_rank,
                                                                                                      device_id + device_idx_start))
-            balanced_pipe.append(nn.Sequential(*layers).to(device, non_blocking=False))
-        else:
-            balanced_pipe.append(nn.Sequential(*layers))
+            # the sub layers are kept across the transformations, so only the ones assigned to a new device are moved
+            for layer in layers:
+                if _get_device(layer) != device:
+                    layer.to(device, non_blocking=False)
+                    num_moved_layers += 1
+        balanced_pipe.append(nn.Sequential(*layers))
+    logging.info("%d/%d sub layers are moved" % (num_moved_layers, len(pipe)))
     time_end_loading = time.time()
     logging.info("CPU->GPU time cost = " + str(time_end_loading - time_start_loading))
     output_pipe_model = nn.Sequential(*balanced_pipe)
@@ -100,6 +124,14 @@ def convert_to_balanced_model(local_rank, global_rank,
     return output_pipe_model
 
 
+def _get_device(layer):
+    for tensor in layer.parameters():
+        return tensor.device
+    for tensor in layer.buffers():
+        return tensor.device
+    return None
+
+
 def freeze_layers_for_pipe_model(model, num_frozen_layers):
     ddp_ignore_name_list = []
     partition_idx = 0
@@ -120,13 +152,7 @@ def freeze_layers_for_pipe_model(model, num_frozen_layers):
 
 
 def freeze_layers_for_normal_model(model, num_frozen_layers):
-    if num_frozen_layers > 0:
-        for param in model.transformer.embeddings.parameters():
-            param.requires_grad = False
-        for frozen_layer_index in range(num_frozen_layers):
-            layer_block = model.transformer.encoder.layer[frozen_layer_index]
-            for param in layer_block.parameters():
-                param.requires_grad = False
+    freeze_embedding_and_blocks(model, num_frozen_layers)
 
 
 def get_ddp_ignored_params_name(model, num_frozen_layers):
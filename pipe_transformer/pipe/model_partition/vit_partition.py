@@ -2,6 +2,7 @@ import logging
 
 from torch import nn
 
+from .layer_registry import freeze_embedding_and_blocks, resolve_layers
 from .utils import count_parameters
 
 """
@@ -64,16 +65,16 @@ class FrozenLayer(nn.Module):
     def forward(self, x, layer_id=0):
         # logging.info(x)
         if layer_id == self.num_frozen_layer:
-            logging.info("no need to recompute")
+            logging.debug("no need to recompute")
             return x
         if layer_id == 0:
-            logging.info("compute from layer 0")
+            logging.debug("compute from layer 0")
             x = self.embedding(x)
             for id in range(0, self.num_frozen_layer):
                 x = self.layers[id](x)
             return x
         else:
-            logging.info("compute from layer %d-%d" % (layer_id, self.num_frozen_layer - 1))
+            logging.debug("compute from layer %d-%d" % (layer_id, self.num_frozen_layer - 1))
             for id in range(layer_id, self.num_frozen_layer):
                 x = self.layers[id](x)
             return x
@@ -86,6 +87,7 @@ def create_pipe_styled_model_vit(model_config, model_backbone, num_layer_in_tota
         Prepare a Pin Memory model
     """
     #    logging.info(model_backbone)
+    layers = resolve_layers(model_backbone)
     frozen_model = None
     pipe_model = nn.Sequential()
 
@@ -93,17 +95,17 @@ def create_pipe_styled_model_vit(model_config, model_backbone, num_layer_in_tota
     parameters_list_pipe = []
 
     if num_frozen_layer > 0:
-        for param in model_backbone.transformer.embeddings.parameters():
+        for param in layers.embedding.parameters():
             param.requires_grad = False
 
-        frozen_emb = model_backbone.transformer.embeddings
+        frozen_emb = layers.embedding
 
-        size_embedding = count_parameters(model_backbone.transformer.embeddings, False)
+        size_embedding = count_parameters(layers.embedding, False)
         parameters_size_frozen += size_embedding
 
         frozen_layer_list = nn.ModuleList()
         for frozen_layer_index in range(num_frozen_layer):
-            layer_block = model_backbone.transformer.encoder.layer[frozen_layer_index]
+            layer_block = layers.blocks[frozen_layer_index]
             for param in layer_block.parameters():
                 param.requires_grad = False
             frozen_layer_list.append(layer_block)
@@ -113,13 +115,13 @@ def create_pipe_styled_model_vit(model_config, model_backbone, num_layer_in_tota
 
         frozen_model = FrozenLayer(num_frozen_layer, frozen_emb, frozen_layer_list)
     else:
-        pipe_model.add_module("embedding", model_backbone.transformer.embeddings)
-        size_embedding = count_parameters(model_backbone.transformer.embeddings, False)
+        pipe_model.add_module("embedding", layers.embedding)
+        size_embedding = count_parameters(layers.embedding, False)
         parameters_list_pipe.append(size_embedding)
 
     # add transformer blocks needed to be trained
     for layer_index in range(num_frozen_layer, num_layer_in_total):
-        layer_block = model_backbone.transformer.encoder.layer[layer_index]
+        layer_block = layers.blocks[layer_index]
         multihead_attention_layer = MultiHeadAttentionLayer(layer_block.attention_norm, layer_block.attn)
         mlp_layer = MLPLayer(layer_block.ffn_norm, layer_block.ffn)
         pipe_model.add_module("multihead_attention_layer" + str(layer_index), multihead_attention_layer)
@@ -148,15 +150,20 @@ def create_pipe_styled_model_vit(model_config, model_backbone, num_layer_in_tota
     return frozen_model, parameters_size_frozen, pipe_model, parameters_list_pipe
 
 
+def create_frozen_model_vit(model_backbone, num_frozen_layer):
+    """
+    The frozen model of the first num_frozen_layer blocks, which are shared with the backbone (and the pipe sub layers),
+    so that it is built without walking the backbone again when more layers are frozen.
+    """
+    freeze_embedding_and_blocks(model_backbone, num_frozen_layer)
+    layers = resolve_layers(model_backbone)
+    return FrozenLayer(num_frozen_layer, layers.embedding, layers.blocks)
+
+
 def freeze_vit_only(model_backbone, num_frozen_layer):
     """
     Optimization:
         Pin Memory: https://pytorch.org/docs/stable/notes/cuda.html#use-pinned-memory-buffers
         Prepare a Pin Memory model
     """
-    for param in model_backbone.transformer.embeddings.parameters():
-        param.requires_grad = False
-    for frozen_layer_index in range(num_frozen_layer):
-        layer_block = model_backbone.transformer.encoder.layer[frozen_layer_index]
-        for param in layer_block.parameters():
-            param.requires_grad = False
+    freeze_embedding_and_blocks(model_backbone, num_frozen_layer)
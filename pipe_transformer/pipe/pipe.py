@@ -6,7 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 """The Pipe interface."""
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Any, Iterable, List, Optional, Tuple, Union, cast, Sequence
+from typing import TYPE_CHECKING, Any, Callable, Iterable, List, Optional, Tuple, Union, cast, Sequence
 
 import torch
 from torch import Tensor, nn
@@ -16,6 +16,7 @@ import torch.cuda
 
 from . import microbatch
 from .batchnorm import DeferredBatchNorm
+from .microbatch import Batch
 from .pipeline import Pipeline
 from .skip.layout import inspect_skip_layout
 from .skip.skippable import verify_skippables
@@ -172,6 +173,15 @@ class Pipe(Module):
             :data:`False`). If set to :data:`True`, we track statistics across
             multiple micro-batches to update the running statistics per
             mini-batch.
+        schedule (str):
+            the schedule of :meth:`forward_backward`, one of ``'gpipe'`` or
+            ``'1f1b'`` (default: ``'gpipe'``). ``'gpipe'`` runs the forward
+            of all micro-batches, and then their backward (fill-drain), so
+            the activations of all ``chunks`` micro-batches are kept at once.
+            ``'1f1b'`` backpropagates each micro-batch as soon as it leaves
+            the last partition (PipeDream-flush), so the activations of at
+            most as many micro-batches as the partitions are kept.
+            :meth:`forward` always runs the ``'gpipe'`` schedule.
 
     Raises:
         TypeError:
@@ -194,6 +204,19 @@ class Pipe(Module):
         :class:`torch.nn.parallel.DistributedDataParallel` only when the
         checkpoint parameter of :class:`Pipe` is ``'never'``.
 
+    .. note::
+        A device can hold more than one partition (virtual stages) when the
+        partitions are assigned to the devices round-robin, e.g., the
+        partitions on the devices ``0, 1, 0, 1``. Then the micro-batches
+        are scheduled interleaved, which shortens the pipeline bubble by the
+        number of partitions per device.
+
+    .. note::
+        :meth:`forward_backward` runs the backward by itself, so the
+        gradients are not synchronized by
+        :class:`torch.nn.parallel.DistributedDataParallel` wrapping the
+        :class:`Pipe` model.
+
     .. note::
         :class:`Pipe` only supports intra-node pipelining currently, but
         will be expanded to support inter-node pipelining in the future.
@@ -213,16 +236,20 @@ class Pipe(Module):
         chunks: int = 1,
         checkpoint: str = "except_last",
         deferred_batch_norm: bool = False,
+        schedule: str = "gpipe",
     ) -> None:
         super().__init__()
 
         chunks = int(chunks)
         checkpoint = str(checkpoint)
+        schedule = str(schedule)
 
         if chunks <= 0:
             raise ValueError("number of chunks must be positive integer")
         if checkpoint not in ["always", "except_last", "never"]:
             raise ValueError("checkpoint is not one of 'always', 'except_last', or 'never'")
+        if schedule not in ["gpipe", "1f1b"]:
+            raise ValueError("schedule is not one of 'gpipe' or '1f1b'")
 
         _verify_module(module)
 
@@ -232,7 +259,9 @@ class Pipe(Module):
 
         self.chunks = chunks
         self.checkpoint = checkpoint
+        self.schedule = schedule
 
+        self.deferred_batch_norm = deferred_batch_norm
         if deferred_batch_norm:
             module = DeferredBatchNorm.convert_deferred_batch_norm(module, chunks)
 
@@ -309,6 +338,28 @@ class Pipe(Module):
 
         return super().to(*args, **kwargs)
 
+    def set_chunks(self, chunks: int) -> None:
+        """Changes the number of micro-batches between iterations, without
+        rebuilding the partitions.
+
+        Raises:
+            ValueError: invalid number of chunks, or deferred ``BatchNorm``
+            which tracks the statistics by the number of chunks.
+
+        """
+        chunks = int(chunks)
+        if chunks <= 0:
+            raise ValueError("number of chunks must be positive integer")
+        if self.deferred_batch_norm:
+            raise ValueError("number of chunks cannot be changed with deferred_batch_norm")
+        if chunks == self.chunks:
+            return
+
+        self.chunks = chunks
+        self._copy_streams = []
+        checkpoint_stop = {"always": self.chunks, "except_last": self.chunks - 1, "never": 0}[self.checkpoint]
+        self.pipeline.set_copy_streams(self._ensure_copy_streams(), checkpoint_stop)
+
     def _ensure_copy_streams(self) -> List[List[AbstractStream]]:
         """Ensures that :class:`Pipe` caches CUDA streams for copy.
 
@@ -323,7 +374,13 @@ class Pipe(Module):
 
         return self._copy_streams
 
-    def forward(self, input) -> RRef:  # type: ignore
+    def _check_split_sizes(self, split_sizes: Optional[List[int]]) -> None:
+        # The copy streams and the execution plans are built for at most
+        # ``chunks`` micro-batches.
+        if split_sizes is not None and not 0 < len(split_sizes) <= self.chunks:
+            raise ValueError(f"split_sizes must have 1 to {self.chunks} (chunks) micro-batches")
+
+    def forward(self, input, split_sizes: Optional[List[int]] = None) -> RRef:  # type: ignore
         """
         Processes a single input mini-batch through the pipe and returns an
         :class:`~torch.distributed.rpc.RRef` pointing to the output.
@@ -335,28 +392,34 @@ class Pipe(Module):
 
         The input tensor is split into multiple micro-batches based on the
         ``chunks`` parameter used to initialize :class:`Pipe`. The batch size
-        is assumed to be the first dimension of the tensor and if the batch
-        size is less than ``chunks``, the number of micro-batches is equal to
-        the batch size.
+        is assumed to be the first dimension of the tensor and the sizes of
+        the micro-batches differ by one at most. If the batch size is less
+        than ``chunks`` (e.g., the last mini-batch of an epoch), the number of
+        micro-batches is equal to the batch size.
 
         Arguments:
             input (torch.Tensor or sequence of :class:`~torch.Tensor`): input mini-batch
+            split_sizes (list of int): the sizes of the micro-batches, instead
+                of the balanced ones (at most ``chunks`` micro-batches)
 
         Returns:
             :class:`~torch.distributed.rpc.RRef` to the output of the mini-batch
 
         Raises:
             TypeError: input is not a tensor or sequence of tensors.
+            ValueError: split_sizes does not split the mini-batch into at most
+                ``chunks`` micro-batches.
 
         """
         microbatch.check(input)
+        self._check_split_sizes(split_sizes)
 
         if not self.devices:
             # Empty sequential module is not illegal.
             return RRef(input)
 
         # Divide a mini-batch into micro-batches.
-        batches = microbatch.scatter(input, self.chunks)
+        batches = microbatch.scatter(input, self.chunks, split_sizes)
 
         # Run pipeline parallelism.
         self.pipeline.run(batches)
@@ -364,3 +427,83 @@ class Pipe(Module):
         # Merge the micro-batches into one mini-batch.
         output = microbatch.gather(batches)
         return RRef(output)
+
+    def forward_backward(
+        self, input: TensorOrTensors, target: TensorOrTensors, loss_fn: Callable[..., Tensor],
+        split_sizes: Optional[List[int]] = None,
+    ) -> Tuple[TensorOrTensors, Tensor]:
+        """
+        Processes a single input mini-batch through the pipe, and
+        backpropagates ``loss_fn(output, target)`` by the ``schedule`` of
+        :class:`Pipe`.
+
+        With ``'1f1b'``, the target is split into micro-batches as the input,
+        and the loss of each micro-batch is weighted by its size, so the
+        gradients are the same as the ones of the mini-batch when ``loss_fn``
+        returns the mean over the samples (e.g., the default reduction of
+        :class:`torch.nn.CrossEntropyLoss`).
+
+        .. note::
+            :class:`~pipe_transformer.pipe.auto_pipe.AutoElasticPipe` and the
+            trainers of the examples call :meth:`forward` (wrapped by DDP) and
+            backpropagate the loss themselves, so they always run the GPipe
+            schedule: ``'1f1b'`` is only reachable by calling this method
+            directly (see ``pipe_transformer/pipe/test.py``).
+
+        Arguments:
+            input (torch.Tensor or sequence of :class:`~torch.Tensor`): input mini-batch
+            target (torch.Tensor or sequence of :class:`~torch.Tensor`): target mini-batch, on the last device
+            loss_fn (callable): ``loss_fn(output, target)`` returns a scalar loss
+            split_sizes (list of int): the sizes of the micro-batches, as in
+                :meth:`forward`
+
+        Returns:
+            the output of the mini-batch (detached), and the loss (detached)
+
+        Raises:
+            TypeError: input or target is not a tensor or sequence of tensors.
+            ValueError: target does not have the same number of micro-batches
+                as input, or split_sizes is invalid.
+            RuntimeError: gradient computation is disabled.
+
+        """
+        microbatch.check(input)
+        microbatch.check(target)
+        self._check_split_sizes(split_sizes)
+
+        if not torch.is_grad_enabled():
+            raise RuntimeError("forward_backward requires gradient computation to be enabled")
+
+        if self.schedule == "gpipe" or not self.devices:
+            output = self.forward(input, split_sizes).local_value()
+            loss = loss_fn(output, target)
+            loss.backward()
+            return _detach(output), loss.detach()
+
+        batches = microbatch.scatter(input, self.chunks, split_sizes)
+        targets = microbatch.scatter(target, self.chunks, split_sizes)
+        if len(targets) != len(batches):
+            raise ValueError("target must have the same number of micro-batches as input")
+
+        sizes = [batch[0].size(0) for batch in batches]
+        batch_size = sum(sizes)
+        losses: List[Tensor] = []
+
+        def backward(i: int, batch: Batch) -> None:
+            weight = sizes[i] / batch_size
+            loss = loss_fn(batch.tensor_or_tensors, targets[i].tensor_or_tensors) * weight
+            loss.backward()
+            losses.append(loss.detach())
+            # Only the value is returned, and the autograd graph of the
+            # micro-batch is released.
+            batch[:] = tuple(x.detach() for x in batch)
+
+        self.pipeline.run_1f1b(batches, backward)
+
+        return microbatch.gather(batches), torch.stack(losses).sum()
+
+
+def _detach(output: TensorOrTensors) -> TensorOrTensors:
+    if isinstance(output, Tensor):
+        return output.detach()
+    return tuple(x.detach() for x in output)
@@ -7,7 +7,7 @@
 """The pipeline parallelism of Pipe."""
 from queue import Queue
 from types import TracebackType
-from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple, Type, Union, cast, Sequence
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple, Type, Union, cast, Sequence
 
 import torch
 from torch import Tensor, nn
@@ -18,8 +18,9 @@ from .copy import Copy, Wait
 from .dependency import fork, join
 from .microbatch import Batch
 from .skip.layout import SkipLayout
+from .skip.namespace import Namespace
 from .skip.tracker import SkipTrackerThroughPotals, use_skip_tracker
-from .stream import AbstractStream, current_stream, use_device
+from .stream import AbstractStream, current_stream, use_device, use_stream
 from .worker import Task, create_workers, join_workers
 
 __all__: List[str] = []
@@ -30,11 +31,20 @@ TensorOrTensors = Union[Tensor, Tensors]
 
 ExcInfo = Tuple[Type[BaseException], BaseException, TracebackType]
 
+# (i, j, depends_on_previous, [(prev_stream, next_stream, ns, name), ...], (prev_stream, next_stream) or None)
+FenceOp = Tuple[
+    int,
+    int,
+    bool,
+    List[Tuple[AbstractStream, AbstractStream, Namespace, str]],
+    Optional[Tuple[AbstractStream, AbstractStream]],
+]
+
 # Queue is generic only in stubs.
 # https://mypy.readthedocs.io/en/latest/common_issues.html#using-classes-that-are-generic-in-stubs-but-not-at-runtime
 if TYPE_CHECKING:
-    InQueue = Queue[Optional["Task"]]
-    OutQueue = Queue[Tuple[bool, Union[Tuple["Task", Batch], ExcInfo, None]]]
+    InQueue = Queue[Optional[List["Task"]]]
+    OutQueue = Queue[Tuple[bool, Union[List[Batch], ExcInfo, None]]]
 else:
     InQueue = Queue
     OutQueue = Queue
@@ -76,6 +86,163 @@ def _clock_cycles(m: int, n: int) -> Iterable[List[Tuple[int, int]]]:
         yield [(k - j, j) for j in range(max(1 + k - m, 0), min(1 + k, n))]
 
 
+def _interleaved_clock_cycles(m: int, n: int, d: int) -> Iterable[List[Tuple[int, int]]]:
+    """Generates schedules for each clock cycle when the n partitions are
+    assigned to d devices round-robin (virtual stages): the j-th partition
+    is on the (j % d)-th device.
+    """
+    # Each device runs its partitions in the interleaved order of Megatron-LM:
+    # a group of d micro-batches through its 1st partition, then the same
+    # group through its 2nd partition, and so on, then the next group.
+    # A cell runs at the first clock when the device is free and the cell of
+    # the previous partition has run. For example, m = 4, n = 4, d = 2:
+    #
+    # k device 0  device 1
+    # - --------  --------
+    # 0 (0,0)
+    # 1 (1,0)     (0,1)
+    # 2 (0,2)     (1,1)
+    # 3 (1,2)     (0,3)
+    # 4 (2,0)     (1,3)
+    # 5 (3,0)     (2,1)
+    # ...
+    #
+    # A clock is the time of a partition, 1/(n/d) of the time of a device,
+    # so the bubble of (d-1) clocks is n/d times shorter than _clock_cycles(m, d).
+    orders: List[List[Tuple[int, int]]] = []
+    for device in range(d):
+        order = []
+        for group in range(0, m, d):
+            for j in range(device, n, d):
+                order += [(i, j) for i in range(group, min(group + d, m))]
+        orders.append(order)
+
+    done: Dict[Tuple[int, int], int] = {}
+    cursors = [0] * d
+    k = 0
+    while len(done) < m * n:
+        schedule = []
+        for device in range(d):
+            if cursors[device] == len(orders[device]):
+                continue
+            i, j = orders[device][cursors[device]]
+            if j == 0 or done.get((i, j - 1), k) < k:
+                schedule.append((i, j))
+                cursors[device] += 1
+        for cell in schedule:
+            done[cell] = k
+        yield schedule
+        k += 1
+
+
+def _1f1b_clock_cycles(
+    clock_cycles: Iterable[List[Tuple[int, int]]], n: int
+) -> Iterable[Tuple[List[Tuple[int, int]], List[int]]]:
+    """Generates the forward schedule and the micro-batches to backpropagate
+    for each clock cycle of the one-forward-one-backward (PipeDream-flush)
+    schedule.
+    """
+    # The forward follows the given clock cycles. A micro-batch is
+    # backpropagated right after its last partition. With _clock_cycles(m, n),
+    # the next forward on a partition comes after the backward of the
+    # micro-batch which has left the pipe, so at most n micro-batches hold
+    # their activations.
+    #
+    # k (i,j) (i,j) (i,j)  backward
+    # - ----- ----- -----  --------
+    # 0 (0,0)
+    # 1 (1,0) (0,1)
+    # 2 (2,0) (1,1) (0,2)  0
+    # 3 (3,0) (2,1) (1,2)  1
+    # 4       (3,1) (2,2)  2
+    # 5             (3,2)  3
+    for schedule in clock_cycles:
+        yield schedule, [i for i, j in schedule if j == n - 1]
+
+
+def _count_round_robin_devices(devices: List[torch.device]) -> int:
+    """Returns the number of devices if the partitions are assigned to them
+    round-robin with more than one partition per device (virtual stages),
+    otherwise 0.
+    """
+    unique_devices: List[torch.device] = []
+    for device in devices:
+        if device in unique_devices:
+            break
+        unique_devices.append(device)
+
+    d = len(unique_devices)
+    n = len(devices)
+    # A single device has no bubble to shrink, and the cells of a clock
+    # cycle of _clock_cycles() are handed to its worker at once.
+    if d == 1 or n == d or n % d != 0:
+        return 0
+    if any(devices[j] != unique_devices[j % d] for j in range(n)):
+        return 0
+    return d
+
+
+class _ComputeSlot:
+    """A reusable task to compute a micro-batch on a partition without
+    checkpointing. The pipeline keeps a slot for each (micro-batch,
+    partition) cell and only replaces its input on every iteration, so no
+    task or closure is created for the cell.
+    """
+
+    __slots__ = ("stream", "partition", "label", "batch", "skip_tracker", "grad_enabled")
+
+    def __init__(self, stream: AbstractStream, partition: nn.Sequential, chunk_id: int, part_id: int) -> None:
+        self.stream = stream
+        self.partition = partition
+        self.label = "chunk%d-part%d" % (chunk_id, part_id)
+        self.batch: Optional[Batch] = None
+        self.skip_tracker: Optional[SkipTrackerThroughPotals] = None
+        self.grad_enabled = True
+
+    def set_input(self, batch: Batch, skip_tracker: SkipTrackerThroughPotals) -> None:
+        self.batch = batch
+        self.skip_tracker = skip_tracker
+        self.grad_enabled = torch.is_grad_enabled()
+
+    def compute(self) -> Batch:
+        batch = cast(Batch, self.batch)
+        skip_tracker = cast(SkipTrackerThroughPotals, self.skip_tracker)
+        # Don't hold the input and its autograd graph until the next iteration.
+        self.batch = None
+        self.skip_tracker = None
+        with use_stream(self.stream), torch.set_grad_enabled(self.grad_enabled):
+            with use_skip_tracker(skip_tracker), record_function(self.label):
+                return batch.call(self.partition)
+
+    def finalize(self, batch: Batch) -> None:
+        pass
+
+
+class _ClockPlan:
+    """The static operations of a clock cycle, which are resolved once and
+    replayed on every iteration.
+    """
+
+    __slots__ = ("schedule", "fence_ops", "device_cells", "backward_schedule")
+
+    def __init__(
+        self,
+        schedule: List[Tuple[int, int]],
+        fence_ops: List[FenceOp],
+        device_cells: List[Tuple[InQueue, OutQueue, List[Tuple[int, int]]]],
+        backward_schedule: List[int],
+    ) -> None:
+        # The cells of the clock cycle.
+        self.schedule = schedule
+        # (i, j, whether to depend on batches[i-1], the skip tensors to copy,
+        # and the streams to copy the micro-batch from the previous partition)
+        self.fence_ops = fence_ops
+        # The cells by the queues of the device workers.
+        self.device_cells = device_cells
+        # The micro-batches which leave the last partition in the clock cycle.
+        self.backward_schedule = backward_schedule
+
+
 class Pipeline:
     """The pipeline parallelism for Pipe."""
 
@@ -92,57 +259,142 @@ class Pipeline:
         self.copy_streams = copy_streams
         self.skip_layout = skip_layout
         self.checkpoint_stop = checkpoint_stop
+        # The number of devices with the interleaved virtual stages, or 0.
+        self.num_round_robin_devices = _count_round_robin_devices(devices)
         (self.in_queues, self.out_queues) = create_workers(devices)
+        self.compute_slots: Dict[Tuple[int, int], _ComputeSlot] = {}
+
+        # The skip trackers hold the skip tensors of an iteration, so they
+        # are created for each iteration only if there is a skip connection.
+        self.has_skip_routes = len(skip_layout.by_ns_name) > 0
+        self.shared_skip_tracker = SkipTrackerThroughPotals(skip_layout)
+
+        # The execution plans by the number of micro-batches. The one for a
+        # full mini-batch is compiled here, and the others (e.g., for the
+        # last mini-batch of an epoch) at their first iteration.
+        self.plans: Dict[int, List[_ClockPlan]] = {}
+        if partitions and copy_streams:
+            self.plan(len(copy_streams[0]))
 
     def __del__(self) -> None:
         join_workers(self.in_queues, self.out_queues)
 
+    def set_copy_streams(self, copy_streams: List[List[AbstractStream]], checkpoint_stop: int) -> None:
+        """Replaces the copy streams when the number of chunks is changed,
+        which invalidates the execution plans.
+        """
+        self.copy_streams = copy_streams
+        self.checkpoint_stop = checkpoint_stop
+        self.plans = {}
+        if self.partitions and copy_streams:
+            self.plan(len(copy_streams[0]))
+
+    def plan(self, m: int) -> List[_ClockPlan]:
+        """Returns the execution plan for m micro-batches. The schedule, the
+        copy streams, the skip routes to copy, and the device workers only
+        change when the pipe is rebuilt, so they are resolved once.
+        """
+        plan = self.plans.get(m)
+        if plan is not None:
+            return plan
+
+        copy_streams = self.copy_streams
+        n = len(self.partitions)
+        plan = []
+        for schedule, backward_schedule in _1f1b_clock_cycles(self.clock_cycles(m, n), n):
+            fence_ops: List[FenceOp] = []
+            device_cells: Dict[InQueue, Tuple[InQueue, OutQueue, List[Tuple[int, int]]]] = {}
+            for i, j in schedule:
+                next_stream = copy_streams[j][i]
+                skip_copies = [
+                    (copy_streams[prev_j][i], next_stream, ns, name)
+                    for prev_j, ns, name in self.skip_layout.copy_policy(j)
+                ]
+                copy = (copy_streams[j - 1][i], next_stream) if j != 0 else None
+                fence_ops.append((i, j, i != 0 and j != 0, skip_copies, copy))
+
+                in_queue = self.in_queues[j]
+                if in_queue not in device_cells:
+                    device_cells[in_queue] = (in_queue, self.out_queues[j], [])
+                device_cells[in_queue][2].append((i, j))
+            plan.append(_ClockPlan(schedule, fence_ops, list(device_cells.values()), backward_schedule))
+
+        self.plans[m] = plan
+        return plan
+
+    def skip_trackers(self, m: int) -> List[SkipTrackerThroughPotals]:
+        if self.has_skip_routes:
+            return [SkipTrackerThroughPotals(self.skip_layout) for _ in range(m)]
+        return [self.shared_skip_tracker] * m
+
     def run(self, batches: List[Batch]) -> None:
         """Runs pipeline parallelism.
 
         It modifies the given batches in place.
 
         """
-        partitions = self.partitions
-        devices = self.devices
-        skip_layout = self.skip_layout
-
         m = len(batches)
-        n = len(partitions)
+        skip_trackers = self.skip_trackers(m)
+        streams = [current_stream(d) for d in self.devices]
 
-        skip_trackers = [SkipTrackerThroughPotals(skip_layout) for _ in batches]
+        for clock in self.plan(m):
+            self.fence(batches, clock, skip_trackers)
+            self.compute(batches, clock, skip_trackers, streams)
 
-        for schedule in _clock_cycles(m, n):
-            self.fence(batches, schedule, skip_trackers)
-            self.compute(batches, schedule, skip_trackers)
+    def clock_cycles(self, m: int, n: int) -> Iterable[List[Tuple[int, int]]]:
+        if self.num_round_robin_devices > 0:
+            return _interleaved_clock_cycles(m, n, self.num_round_robin_devices)
+        return _clock_cycles(m, n)
+
+    def run_1f1b(self, batches: List[Batch], backward: Callable[[int, Batch], None]) -> None:
+        """Runs pipeline parallelism with the one-forward-one-backward
+        schedule.
+
+        It modifies the given batches in place. ``backward(i, batch)`` is
+        called with the output of the i-th micro-batch as soon as it leaves
+        the last partition, and it must backpropagate the micro-batch.
+
+        """
+        m = len(batches)
+        skip_trackers = self.skip_trackers(m)
+        streams = [current_stream(d) for d in self.devices]
+
+        for clock in self.plan(m):
+            # The micro-batches are backpropagated one by one, so they don't
+            # need the dependency for the order of backpropagation.
+            self.fence(batches, clock, skip_trackers, depend=False)
+            self.compute(batches, clock, skip_trackers, streams)
+            for i in clock.backward_schedule:
+                backward(i, batches[i])
 
     def fence(
-        self, batches: List[Batch], schedule: List[Tuple[int, int]], skip_trackers: List[SkipTrackerThroughPotals],
+        self,
+        batches: List[Batch],
+        clock: _ClockPlan,
+        skip_trackers: List[SkipTrackerThroughPotals],
+        depend: bool = True,
     ) -> None:
         """Copies micro-batches after computation for the previous
         micro-batches.
         """
-        copy_streams = self.copy_streams
-        skip_layout = self.skip_layout
-
-        for i, j in schedule:
+        for i, j, depends_on_previous, skip_copies, copy in clock.fence_ops:
             # Ensure that batches[i-1] is executed after batches[i] in
             # backpropagation by an explicit dependency.
-            if i != 0 and j != 0:
+            if depend and depends_on_previous:
                 _depend(batches[i - 1], batches[i])
 
-            next_stream = copy_streams[j][i]
-
-            for prev_j, ns, name in skip_layout.copy_policy(j):
-                prev_stream = copy_streams[prev_j][i]
+            for prev_stream, next_stream, ns, name in skip_copies:
                 skip_trackers[i].copy(batches[i], prev_stream, next_stream, ns, name)
 
-            if j != 0:
-                prev_stream = copy_streams[j - 1][i]
-                _copy(batches[i], prev_stream, next_stream)
+            if copy is not None:
+                _copy(batches[i], copy[0], copy[1])
 
     def compute(
-        self, batches: List[Batch], schedule: List[Tuple[int, int]], skip_trackers: List[SkipTrackerThroughPotals],
+        self,
+        batches: List[Batch],
+        clock: _ClockPlan,
+        skip_trackers: List[SkipTrackerThroughPotals],
+        streams: List[AbstractStream],
     ) -> None:
         """Runs tasks with synchronization to copy streams."""
         partitions = self.partitions
@@ -155,7 +407,6 @@ class Pipeline:
             checkpoint_stop = 0
 
         n = len(partitions)
-        streams = [current_stream(d) for d in devices]
         exc_info: Optional[ExcInfo] = None
 
         # With checkpointing, the autograd graph looks like this diagram:
@@ -183,52 +434,19 @@ class Pipeline:
         # ┌─────┸──────┐   (fence)
         # │    Copy    │
         # └─────┰──────┘
-        for i, j in schedule:
-            batch = batches[i]
-            partition = partitions[j]
-
-            # Synchronize with the copied input. ([1] in the diagram)
-            if j != 0:
-                _wait(batch, copy_streams[j][i], streams[j])
-
-            # Determine whether checkpointing or not.
-            checkpoint = i < checkpoint_stop
-            if checkpoint:
-
-                def function(
-                    input: TensorOrTensors,
-                    partition: nn.Sequential = partition,
-                    skip_tracker: SkipTrackerThroughPotals = skip_trackers[i],
-                    chunk_id: int = i,
-                    part_id: int = j,
-                ) -> TensorOrTensors:
-                    with use_skip_tracker(skip_tracker), record_function("chunk%d-part%d" % (chunk_id, part_id)):
-                        return partition(input)
-
-                chk = Checkpointing(function, batch)
-                task = Task(streams[j], compute=chk.checkpoint, finalize=chk.recompute)
-                del function, chk
-
-            else:
-
-                def compute(
-                    batch: Batch = batch,
-                    partition: nn.Sequential = partition,
-                    skip_tracker: SkipTrackerThroughPotals = skip_trackers[i],
-                    chunk_id: int = i,
-                    part_id: int = j,
-                ) -> Batch:
-                    with use_skip_tracker(skip_tracker), record_function("chunk%d-part%d" % (chunk_id, part_id)):
-                        return batch.call(partition)
-
-                task = Task(streams[j], compute=compute, finalize=None)
-                del compute
+        # The cells on the same device are handed to its worker at once.
+        tasks_by_device: List[List[Union[Task, _ComputeSlot]]] = []
+        for in_queue, _, cells in clock.device_cells:
+            tasks: List[Union[Task, _ComputeSlot]] = []
+            for i, j in cells:
+                tasks.append(self._prepare_task(batches, i, j, skip_trackers, streams, checkpoint_stop))
 
             # Compute tasks in parallel. ([2] in the diagram)
-            self.in_queues[j].put(task)
+            in_queue.put(tasks)
+            tasks_by_device.append(tasks)
 
-        for i, j in schedule:
-            ok, payload = self.out_queues[j].get()
+        for (_, out_queue, cells), tasks in zip(clock.device_cells, tasks_by_device):
+            ok, payload = out_queue.get()
 
             # Hold the first exception.
             if exc_info is not None:
@@ -237,21 +455,66 @@ class Pipeline:
                 exc_info = cast(ExcInfo, payload)
                 continue
 
-            task, batch = cast(Tuple[Task, Batch], payload)
-
-            # The copy stream synchronizes to copy the output. ([3] in the
-            # diagram)
-            if j != n - 1:
-                _wait(batch, streams[j], copy_streams[j][i])
+            for (i, j), task, batch in zip(cells, tasks, cast(List[Batch], payload)):
+                # The copy stream synchronizes to copy the output. ([3] in the
+                # diagram)
+                if j != n - 1:
+                    _wait(batch, streams[j], copy_streams[j][i])
 
-            # Finalize tasks. If checkpointing is enabled, here the
-            # recomputation is scheduled at backpropagation. ([4] in the
-            # diagram)
-            with use_device(devices[j]):
-                task.finalize(batch)
+                # Finalize tasks. If checkpointing is enabled, here the
+                # recomputation is scheduled at backpropagation. ([4] in the
+                # diagram)
+                with use_device(devices[j]):
+                    task.finalize(batch)
 
-            batches[i] = batch
+                batches[i] = batch
 
         # Fail at the first exception.
         if exc_info is not None:
             raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
+
+    def _prepare_task(
+        self,
+        batches: List[Batch],
+        i: int,
+        j: int,
+        skip_trackers: List[SkipTrackerThroughPotals],
+        streams: List[AbstractStream],
+        checkpoint_stop: int,
+    ) -> Union[Task, _ComputeSlot]:
+        """Prepares the task of a cell, after synchronizing its input."""
+        batch = batches[i]
+        partition = self.partitions[j]
+
+        # Synchronize with the copied input. ([1] in the diagram)
+        if j != 0:
+            _wait(batch, self.copy_streams[j][i], streams[j])
+
+        # Determine whether checkpointing or not.
+        checkpoint = i < checkpoint_stop
+        task: Union[Task, _ComputeSlot]
+        if checkpoint:
+
+            def function(
+                input: TensorOrTensors,
+                partition: nn.Sequential = partition,
+                skip_tracker: SkipTrackerThroughPotals = skip_trackers[i],
+                chunk_id: int = i,
+                part_id: int = j,
+            ) -> TensorOrTensors:
+                with use_skip_tracker(skip_tracker), record_function("chunk%d-part%d" % (chunk_id, part_id)):
+                    return partition(input)
+
+            chk = Checkpointing(function, batch)
+            task = Task(streams[j], compute=chk.checkpoint, finalize=chk.recompute)
+            del function, chk
+
+        else:
+            slot = self.compute_slots.get((i, j))
+            if slot is None or slot.stream != streams[j]:
+                slot = _ComputeSlot(streams[j], partition, i, j)
+                self.compute_slots[(i, j)] = slot
+            slot.set_input(batch, skip_trackers[i])
+            task = slot
+
+        return task
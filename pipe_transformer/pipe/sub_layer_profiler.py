@@ -0,0 +1,80 @@
+import time
+
+import torch
+
+"""
+Measured cost of the sub layers of the pipe, for the cost-aware freeze scheduler (see freeze_cost_model.py)
+
+The parameter size is a poor proxy of the time of a sub layer: the attention grows with the sequence length,
+and the embedding is cheap for its size.
+When no layer is frozen, AutoElasticPipe.on_forward() profiles the sub layers once, on a micro-batch of the first
+training step: the micro-batch runs through the sub layers one by one, and the forward and the backward of each one
+are timed on its device.
+The backward is torch.autograd.grad() of the outputs with respect to the input and the trainable parameters,
+so the .grad of the parameters (the gradients of the training step) is not touched, and the RNG state (dropout)
+of the training is restored afterwards.
+"""
+
+
+def profile_sub_layers(sub_layers, input, num_repeats=3):
+    """
+    return the forward times and the backward times of the sub layers per sample (seconds),
+    averaged over num_repeats runs after a warm-up run
+    """
+    batch_size = _get_tensors(input)[0].size(0)
+    forward_times = [0.0] * len(sub_layers)
+    backward_times = [0.0] * len(sub_layers)
+    cuda_devices = list(set([device for device in [_get_device(layer) for layer in sub_layers]
+                             if device is not None and device.type == "cuda"]))
+    with torch.random.fork_rng(devices=cuda_devices), torch.enable_grad():
+        for repeat in range(num_repeats + 1):
+            x = input
+            for idx, layer in enumerate(sub_layers):
+                device = _get_device(layer)
+                x = _detach(x, device)
+                _synchronize(device)
+                time_start = time.perf_counter()
+                y = layer(x)
+                _synchronize(device)
+                time_forward = time.perf_counter()
+                outputs = [t for t in _get_tensors(y) if t.requires_grad]
+                inputs = [t for t in _get_tensors(x) if t.requires_grad] + \
+                         [p for p in layer.parameters() if p.requires_grad]
+                if len(outputs) > 0 and len(inputs) > 0:
+                    torch.autograd.grad(outputs, inputs, grad_outputs=[torch.ones_like(t) for t in outputs],
+                                        allow_unused=True)
+                _synchronize(device)
+                time_backward = time.perf_counter()
+                # the first run is a warm-up
+                if repeat > 0:
+                    forward_times[idx] += (time_forward - time_start) / num_repeats / batch_size
+                    backward_times[idx] += (time_backward - time_forward) / num_repeats / batch_size
+                x = y
+    return forward_times, backward_times
+
+
+def _get_device(layer):
+    for tensor in layer.parameters():
+        return tensor.device
+    for tensor in layer.buffers():
+        return tensor.device
+    return None
+
+
+def _get_tensors(x):
+    if isinstance(x, torch.Tensor):
+        return [x]
+    return [t for t in x if isinstance(t, torch.Tensor)]
+
+
+def _detach(x, device):
+    # each sub layer is timed alone: the graph of the previous sub layers is cut
+    if isinstance(x, torch.Tensor):
+        x = x.detach() if device is None else x.detach().to(device)
+        return x.requires_grad_() if x.is_floating_point() else x
+    return type(x)(_detach(t, device) if isinstance(t, torch.Tensor) else t for t in x)
+
+
+def _synchronize(device):
+    if device is not None and device.type == "cuda":
+        torch.cuda.synchronize(device)
@@ -0,0 +1,129 @@
+import os
+import socket
+
+import torch
+import torch.distributed.rpc as rpc
+from torch import nn
+
+from pipe_transformer.pipe import Pipe
+
+"""
+Behavioural tests of Pipe.forward_backward() on the CPU (no GPU and no training are needed):
+
+    python -m pytest pipe_transformer/pipe/test.py
+    python -m pipe_transformer.pipe.test
+
+Pipe.forward() returns an RRef, so a single-process RPC is initialized for the tests.
+"""
+
+BATCH_SIZE = 13
+INPUT_SIZE = 8
+HIDDEN_SIZE = 16
+NUM_CLASSES = 4
+NUM_PARTITIONS = 3
+
+is_rpc_initialized = False
+
+
+class LiveActivationCounter(nn.Module):
+    """
+    counts the micro-batches whose activations of the partition are alive:
+    from the forward of a micro-batch to its backward through this module
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.num_live = 0
+        self.peak_num_live = 0
+
+    def forward(self, x):
+        self.num_live += 1
+        self.peak_num_live = max(self.peak_num_live, self.num_live)
+        x = x * 1.0
+        x.register_hook(self._on_backward)
+        return x
+
+    def _on_backward(self, grad):
+        self.num_live -= 1
+        return grad
+
+
+def build_model():
+    torch.manual_seed(0)
+    return nn.Sequential(
+        nn.Sequential(LiveActivationCounter(), nn.Linear(INPUT_SIZE, HIDDEN_SIZE), nn.ReLU()),
+        nn.Sequential(nn.Linear(HIDDEN_SIZE, HIDDEN_SIZE), nn.ReLU()),
+        nn.Sequential(nn.Linear(HIDDEN_SIZE, NUM_CLASSES)),
+    )
+
+
+def build_batch():
+    generator = torch.Generator().manual_seed(1)
+    input = torch.randn([BATCH_SIZE, INPUT_SIZE], generator=generator, requires_grad=True)
+    target = torch.randint(0, NUM_CLASSES, [BATCH_SIZE], generator=generator)
+    return input, target
+
+
+def init_rpc():
+    global is_rpc_initialized
+    if is_rpc_initialized:
+        return
+    # a free port, so that the tests do not collide with a training or another test on the node
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    rpc.init_rpc("test_pipe_%d" % os.getpid(), rank=0, world_size=1)
+    is_rpc_initialized = True
+
+
+def run_forward_backward(schedule, chunks):
+    input, target = build_batch()
+    model = build_model()
+    pipe = Pipe(model, chunks=chunks, checkpoint="never", schedule=schedule)
+    output, loss = pipe.forward_backward(input, target, nn.CrossEntropyLoss())
+    return model, input, output, loss
+
+
+def test_forward_backward_gradients():
+    init_rpc()
+    input, target = build_batch()
+    reference = build_model()
+    reference_output = reference(input)
+    reference_loss = nn.CrossEntropyLoss()(reference_output, target)
+    reference_loss.backward()
+
+    for schedule in ["gpipe", "1f1b"]:
+        for chunks in [1, 3, 5, 13]:
+            model, pipe_input, output, loss = run_forward_backward(schedule, chunks)
+            assert not output.requires_grad and not loss.requires_grad
+            assert torch.allclose(output, reference_output.detach(), atol=1e-6), (schedule, chunks)
+            assert torch.allclose(loss, reference_loss.detach(), atol=1e-6), (schedule, chunks)
+            for (name, p), p_reference in zip(model.named_parameters(), reference.parameters()):
+                assert torch.allclose(p.grad, p_reference.grad, atol=1e-6), (schedule, chunks, name)
+            assert torch.allclose(pipe_input.grad, input.grad, atol=1e-6), (schedule, chunks)
+
+
+def test_forward_backward_live_activations():
+    init_rpc()
+    for chunks in [1, 3, 5, 13]:
+        gpipe_model = run_forward_backward("gpipe", chunks)[0]
+        counter = gpipe_model[0][0]
+        # GPipe runs the forward of all the micro-batches before the backward
+        assert counter.peak_num_live == chunks
+        assert counter.num_live == 0
+
+        model = run_forward_backward("1f1b", chunks)[0]
+        counter = model[0][0]
+        # 1F1B keeps at most one micro-batch in flight per partition (the depth of the pipe)
+        assert counter.peak_num_live == min(chunks, NUM_PARTITIONS), (chunks, counter.peak_num_live)
+        assert counter.num_live == 0
+
+
+if __name__ == "__main__":
+    for test_name, test in list(globals().items()):
+        if test_name.startswith("test_") and callable(test):
+            test()
+            print("%s: passed" % test_name)
+    rpc.shutdown()
@@ -25,8 +25,8 @@ ExcInfo = Tuple[Type[BaseException], BaseException, TracebackType]
 # Queue is generic only in stubs.
 # https://mypy.readthedocs.io/en/latest/common_issues.html#using-classes-that-are-generic-in-stubs-but-not-at-runtime
 if TYPE_CHECKING:
-    InQueue = Queue[Optional["Task"]]
-    OutQueue = Queue[Tuple[bool, Union[Tuple["Task", Batch], ExcInfo, None]]]
+    InQueue = Queue[Optional[List["Task"]]]
+    OutQueue = Queue[Tuple[bool, Union[List[Batch], ExcInfo, None]]]
 else:
     InQueue = Queue
     OutQueue = Queue
@@ -67,22 +67,24 @@ class Task:
 
 
 def worker(in_queue: InQueue, out_queue: OutQueue, device: torch.device) -> None:
-    """The main loop of a worker thread."""
+    """The main loop of a worker thread. It takes the tasks of a clock cycle
+    on its device at once, and puts their output batches at once.
+    """
     with use_device(device):
         while True:
-            task = in_queue.get()
+            tasks = in_queue.get()
 
-            if task is None:
+            if tasks is None:
                 break
 
             try:
-                batch = task.compute()
+                batches = [task.compute() for task in tasks]
             except Exception:
                 exc_info = cast(ExcInfo, sys.exc_info())
                 out_queue.put((False, exc_info))
                 continue
 
-            out_queue.put((True, (task, batch)))
+            out_queue.put((True, batches))
 
     done = (False, None)
     out_queue.put(done)
@@ -1,8 +1,12 @@
 import logging
+import time
+
+import torch
 
 from pipe_transformer.cache.auto_cache import AutoCache
 from pipe_transformer.dp.auto_dp import AutoDataParallel
 from pipe_transformer.freeze.auto_freeze import AutoFreeze
+from pipe_transformer.freeze.freeze_cost_model import FreezeCostModel
 from pipe_transformer.pipe.auto_pipe import AutoElasticPipe
 
 
@@ -18,6 +22,7 @@ class PipeTransformer:
 
         self.auto_freeze = AutoFreeze(config)
         self.auto_pipe = AutoElasticPipe(config, model_config, model)
+        self.auto_freeze.set_cost_model(FreezeCostModel(config, self.auto_pipe))
         self.auto_cache = AutoCache(config, self.auto_freeze, self.auto_dp, self.auto_pipe, data_manager)
 
         self.frozen_model, self.pipe_model = None, None
@@ -25,6 +30,13 @@ class PipeTransformer:
         self.device_first, self.device_last = None, None
 
         self.epoch_start = 0
+        # the epoch of the current data loaders, and its samples trained before the data loaders are re-created
+        # by a transformation in the middle of the epoch (config.freeze_step_interval > 0)
+        self.data_epoch = 0
+        self.num_consumed_samples = 0
+        self.num_data_replicas = 1
+        # the time of an epoch (from a transform to the next one) is measured for the cost-aware freezing
+        self.time_last_transform = None
 
     def start(self):
         freeze_point = dict()
@@ -36,16 +48,27 @@ class PipeTransformer:
                                                                                                         0, freeze_point)
         self.frozen_model = frozen_model
         self.pipe_model = pipe_model
+        self.auto_freeze.record_pipe_profile(self.config, self.auto_pipe)
 
         freeze_point = self.auto_dp.get_freeze_point()
         self.epoch_start = freeze_point['epoch']
-        self._update_data_and_cache(0, True, True)
+        # a newly activated process joins the epoch where the active ones are
+        self.num_consumed_samples = freeze_point.get('num_consumed_samples', 0)
+        self._update_data_and_cache(self.epoch_start, True, True)
         return self.epoch_start
 
     def transform(self, epoch):
+        if self.time_last_transform is not None:
+            self.auto_freeze.record_epoch_time(time.time() - self.time_last_transform)
+        # the data loaders which are resumed in the middle of the last epoch must be re-created for the new epoch
+        is_data_resumed = False
+        if epoch != self.data_epoch:
+            is_data_resumed = self.num_consumed_samples > 0
+            self.num_consumed_samples = 0
         if self.auto_freeze.is_freeze_open():
             new_freeze_point = dict()
             new_freeze_point['epoch'] = epoch
+            new_freeze_point['num_consumed_samples'] = self.num_consumed_samples
 
             frozen_layer_idx = self.auto_freeze.freeze(epoch)
             self.frozen_model, self.pipe_model, \
@@ -55,15 +78,81 @@ class PipeTransformer:
                                                                                   self.pipe_model,
                                                                                   frozen_layer_idx,
                                                                                   new_freeze_point)
-            self._update_data_and_cache(epoch, is_pipe_len_changed, is_frozen_layer_changed)
+            self._update_data_and_cache(epoch, is_pipe_len_changed or is_data_resumed, is_frozen_layer_changed)
+        elif is_data_resumed:
+            self._update_data_and_cache(epoch, True, False)
 
         self.device_first = self.auto_pipe.get_device_first()
         self.device_last = self.auto_pipe.get_device_last()
+        self.time_last_transform = time.time()
+
+    def transform_in_epoch(self, epoch, num_steps):
+        """
+        Freeze and transform the pipe every config.freeze_step_interval training steps.
+        num_steps is the number of steps trained with the current train data loader.
+        Return True if the model and the data loaders are changed, then the trainer continues the epoch with
+        get_new_model_and_dataset(), whose train data loader only contains the samples not trained in this epoch.
+        """
+        interval = self.config.freeze_step_interval
+        if interval <= 0 or num_steps % interval != 0 or not self.auto_freeze.is_freeze_open():
+            return False
+        if num_steps >= len(self.train_dl):
+            # the end of the epoch is handled by transform()
+            return False
+        # every replica trains the same number of full batches, see ResumableDistributedSampler
+        num_consumed_samples = self.num_consumed_samples + num_steps * self.config.batch_size * self.num_data_replicas
+        new_freeze_point = dict()
+        new_freeze_point['epoch'] = epoch
+        new_freeze_point['num_consumed_samples'] = num_consumed_samples
+
+        frozen_layer_idx = self.auto_freeze.freeze(epoch, num_steps)
+        self.frozen_model, self.pipe_model, \
+        is_pipe_len_changed, is_frozen_layer_changed = self.auto_dp.transform(self.auto_pipe,
+                                                                              self.auto_freeze,
+                                                                              self.frozen_model,
+                                                                              self.pipe_model,
+                                                                              frozen_layer_idx,
+                                                                              new_freeze_point)
+        if not is_pipe_len_changed and not is_frozen_layer_changed:
+            return False
+        logging.info("global_rank = %d. transformed in the middle of epoch %d, num_consumed_samples = %d" % (
+            self.auto_dp.get_global_rank(), epoch, num_consumed_samples))
+        # the rest of the epoch is re-sharded even if the pipe length is not changed,
+        # since the trainer restarts the iteration with the new model
+        self.num_consumed_samples = num_consumed_samples
+        self._update_data_and_cache(epoch, True, is_frozen_layer_changed)
+        self.device_first = self.auto_pipe.get_device_first()
+        self.device_last = self.auto_pipe.get_device_last()
+        return True
 
     def get_new_model_and_dataset(self):
         return self.frozen_model, self.pipe_model, self.train_dl, self.test_dl, self.device_first, self.device_last
 
+    def update_optimizer(self, optimizer):
+        """
+        Keep the optimizer of the trainer (its state, and the step count of its scheduler) when the pipe is transformed
+        in the middle of an epoch (transform_in_epoch()): the newly frozen parameters are removed from it,
+        and the state of the other ones is moved to the devices of the new pipe.
+        """
+        params = [p for p in self.pipe_model.parameters() if p.requires_grad]
+        param_set = set(params)
+        for group in optimizer.param_groups:
+            group['params'] = [p for p in group['params'] if p in param_set]
+        # the pipe is built from the same parameters, so nothing is expected here
+        params_in_optimizer = set(p for group in optimizer.param_groups for p in group['params'])
+        optimizer.param_groups[0]['params'] += [p for p in params if p not in params_in_optimizer]
+
+        for p in list(optimizer.state.keys()):
+            if p not in param_set:
+                del optimizer.state[p]
+                continue
+            for key, value in optimizer.state[p].items():
+                # the step count of Adam is a scalar tensor on the CPU
+                if torch.is_tensor(value) and value.dim() > 0 and value.device != p.device:
+                    optimizer.state[p][key] = value.to(p.device)
+
     def forward(self, epoch, batch_idx, sample_index_list, x, is_train_mode, is_train_data):
+        self.auto_pipe.on_forward(is_train_mode and is_train_data, x)
         log_probs = self.auto_cache.forward_with_cache(self.frozen_model, self.pipe_model,
                                                        epoch, batch_idx, sample_index_list, x, is_train_mode, is_train_data)
         return log_probs
@@ -74,13 +163,16 @@ class PipeTransformer:
 
     def _update_data_and_cache(self, epoch, is_pipe_len_changed, is_frozen_layer_changed):
         if is_pipe_len_changed:
-            # epoch, batch_size, node_rank, num_replicas, local_rank
+            self.data_epoch = epoch
+            self.num_data_replicas = self.auto_dp.get_local_data_duplicate_num()
+            # epoch, batch_size, node_rank, num_replicas, local_rank, num_consumed_samples
             self.train_dl, self.test_dl = self.data_manager.get_data_loader_with_node_rank(
                 epoch,
                 self.config.batch_size,
                 self.config.node_rank,
-                self.auto_dp.get_local_data_duplicate_num(),
-                self.auto_dp.get_local_rank()
+                self.num_data_replicas,
+                self.auto_dp.get_local_rank(),
+                self.num_consumed_samples
             )
 
             logging.info("global_rank = %d. is_frozen_layer_changed: %s" % (